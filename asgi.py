@@ -0,0 +1,89 @@
+import asyncio
+import configparser
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+
+from modules import capture, ingest, metrics
+
+# Asynchronous Telegram webhook ingestion.  Run with: uvicorn asgi:app --host 0.0.0.0 --port 5000
+#
+# Every update is acknowledged as soon as it is classified.  Updates the bot ignores never leave the event loop.
+# Anything that touches the DB or disk runs on a thread pool, so the loop never blocks: membership refreshes,
+# /metrics, and updates carrying a command, which ingest.handle_update queues as jobs for the consumers.
+config = configparser.ConfigParser()
+config.read(os.environ['MY_CONF_DIR'] + '/webhooks.ini')
+INGEST_THREADS = int(config.get('webhooks', 'ingest_threads', fallback='32'))
+
+_executor = ThreadPoolExecutor(max_workers=INGEST_THREADS)
+
+
+async def _read_body(receive):
+    body = b''
+    more_body = True
+    while more_body:
+        event = await receive()
+        body += event.get('body', b'')
+        more_body = event.get('more_body', False)
+    return body
+
+
+async def _respond(send, status, body=b'', content_type='text/plain'):
+    await send({
+        'type': 'http.response.start',
+        'status': int(status),
+        'headers': [(b'content-type', content_type.encode())]
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        while True:
+            event = await receive()
+            if event['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif event['type'] == 'lifespan.shutdown':
+                _executor.shutdown(wait=True)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    if scope['type'] != 'http':
+        return
+    if scope['method'] == 'GET' and scope['path'] == '/metrics':
+        body, content_type = await asyncio.get_running_loop(
+        ).run_in_executor(_executor, metrics.render)
+        await _respond(send, HTTPStatus.OK, body, content_type)
+        return
+    if scope['method'] != 'POST':
+        await _respond(send, HTTPStatus.METHOD_NOT_ALLOWED)
+        return
+
+    arrival = time.time()
+    try:
+        request_json = json.loads(await _read_body(receive))
+    except ValueError:
+        await _respond(send, HTTPStatus.BAD_REQUEST)
+        return
+
+    status = HTTPStatus.OK
+    try:
+        update_class = ingest.classify(request_json)
+        if update_class == 'member':
+            await asyncio.get_running_loop().run_in_executor(
+                _executor, ingest.refresh_member, request_json)
+        elif update_class == 'process':
+            response = await asyncio.get_running_loop().run_in_executor(
+                _executor, ingest.handle_update, request_json)
+            if isinstance(response, tuple):
+                status = response[1]
+    except Exception as e:
+        logging.error('Fatal error: {}'.format(e))
+    capture.record(arrival, time.time() - arrival, status, request_json)
+    if status != HTTPStatus.OK:
+        await _respond(send, status)
+        return
+    await _respond(send, HTTPStatus.OK, b'ok')
@@ -0,0 +1,72 @@
+"""
+Compare the database cost of a tip with one connection per query against the pooled helpers in modules.db.
+
+Runs the read queries a single-recipient group tip makes (member check, mention lookup, sender lookup, receiver
+lookup) against the configured schema and reports TCP+auth handshakes and latency per tip.
+
+Usage: MY_CONF_DIR=config python -m benchmarks.db_pool [tips]
+
+MY_CONF_DIR must contain a webhooks.ini pointing at the database; the repository only ships
+config/example_config.ini, copy it to config/webhooks.ini and fill in the database settings first.
+"""
+import statistics
+import sys
+import time
+
+import pymysql
+
+from modules import db
+
+TIP_QUERIES = [
+    ("SELECT member_id, member_name FROM telegram_chat_members WHERE chat_id = %s and member_name = %s",
+     (-1, 'benchmark')),
+    ("SELECT member_id, member_name FROM telegram_chat_members WHERE chat_id = %s and member_name = %s",
+     (-1, 'benchmark')),
+    ("SELECT account, register FROM users where user_id = %s", (-1)),
+    ("SELECT account FROM users where user_id = %s", (-1)),
+]
+
+
+def unpooled_tip():
+    handshakes = 0
+    for query, arguments in TIP_QUERIES:
+        conn = pymysql.connect(
+            host=db.DB_HOST,
+            user=db.DB_USER,
+            passwd=db.DB_PW,
+            port=db.DB_PORT,
+            db=db.DB_SCHEMA,
+            use_unicode=True,
+            charset="utf8")
+        handshakes += 1
+        with conn:
+            cursor = conn.cursor()
+            cursor.execute(query, arguments)
+            cursor.fetchall()
+    return handshakes
+
+
+def pooled_tip():
+    before = db.pool_stats()['connects']
+    for query, arguments in TIP_QUERIES:
+        db.get_db_data(query, arguments)
+    return db.pool_stats()['connects'] - before
+
+
+def run(name, tip, tips):
+    latencies = []
+    handshakes = 0
+    for _ in range(tips):
+        start = time.perf_counter()
+        handshakes += tip()
+        latencies.append((time.perf_counter() - start) * 1000)
+    latencies.sort()
+    print("{:<10} handshakes/tip: {:>5.2f}  mean: {:>7.2f} ms  p50: {:>7.2f} ms  p99: {:>7.2f} ms".format(
+        name, handshakes / tips, statistics.mean(latencies),
+        latencies[len(latencies) // 2], latencies[int(len(latencies) * 0.99) - 1]))
+
+
+if __name__ == "__main__":
+    tips = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    run('unpooled', unpooled_tip, tips)
+    run('pooled', pooled_tip, tips)
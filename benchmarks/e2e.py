@@ -0,0 +1,334 @@
+"""
+End-to-end tip throughput without a node, a bot token or a database server: starts the fake node, the fake Telegram
+API and a throwaway local database, runs the bot (web server, job consumer, outbox dispatcher) against them, posts
+synthetic group tips, DMs and membership traffic to the webhook and reports tips/sec, tip latency percentiles and the
+CPU and memory the bot used.
+
+A tip counts as done when the bot answers in the group; each tip is posted in a chat of its own so the answer can be
+matched to it.
+
+Usage: python -m benchmarks.e2e [--tips 500] [--concurrency 20] [--server flask|asgi] [--ledger] ...
+       python -m benchmarks.e2e --help
+"""
+import argparse
+import asyncio
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from benchmarks import fake_node, fake_telegram, local_db
+from benchmarks.ingest_load import post
+
+BOT_NAME = 'benchbot'
+SENDER_BALANCE = 10**9
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def free_port():
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+
+
+def write_config(directory, args, node_port, telegram_port, db_port):
+    settings = {
+        'min_tip': '1',
+        'node_ip': 'http://127.0.0.1:{}'.format(node_port),
+        'bot_id_telegram': BOT_NAME,
+        'telegram_key': '123456:benchmark',
+        'telegram_base_url': 'http://127.0.0.1:{}/bot'.format(telegram_port),
+        'wallet': 'BENCHMARKWALLET',
+        'server_url': 'http://127.0.0.1/',
+        'host': '127.0.0.1',
+        'user': 'root',
+        'password': '',
+        'schema': 'tipbot_benchmark',
+        'port': str(db_port),
+        'internal_ledger': 'true' if args.ledger else 'false',
+        'worker_count': str(args.workers),
+        'db_pool_size': '20',
+        'job_poll_interval': '0.05',
+        'outbox_poll_interval': '0.02',
+        # Telegram's flood limits would cap the measurement, not the bot
+        'outbox_global_rate': '100000',
+        'outbox_global_burst': '1000',
+        'outbox_private_rate': '100000',
+        'outbox_group_rate': '100000',
+        'outbox_chat_burst': '1000',
+        'tip_notify_window': '1',
+        'metrics_dir': os.path.join(directory, 'metrics'),
+    }
+    with open(os.path.join(directory, 'webhooks.ini'), 'w') as config_file:
+        config_file.write('[webhooks]\n')
+        for key, value in settings.items():
+            config_file.write('{}: {}\n'.format(key, value))
+
+
+def seed(node, tips, users):
+    """
+    Create the schema and users with funded accounts.  Tip i is sent by user i % users to the next user, in chat
+    -(i + 1), where both are members.
+    """
+    from modules import db, migrations
+
+    db.create_db()
+    db.create_tables()
+    migrations.migrate()
+    user_rows = []
+    for user_id in range(1, users + 1):
+        account = node.add_account(SENDER_BALANCE)
+        user_rows.append((user_id, 'user{}'.format(user_id), account))
+    db.set_db_data_many(
+        "INSERT INTO users (user_id, user_name, account, register) VALUES (%s, %s, %s, 1)",
+        user_rows)
+    member_rows = []
+    for tip in range(tips):
+        sender, receiver = tip_users(tip, users)
+        for member in (sender, receiver):
+            member_rows.append((-(tip + 1), 'Benchmark chat', member,
+                                'user{}'.format(member)))
+    db.set_db_data_many(
+        "INSERT INTO telegram_chat_members (chat_id, chat_name, member_id, member_name) VALUES (%s, %s, %s, %s)",
+        member_rows)
+
+
+def tip_users(tip, users):
+    sender = tip % users + 1
+    return sender, sender % users + 1
+
+
+def updates(tips, users, noise):
+    """
+    Yield (tip index or None, update).  Every tip is preceded by noise updates: group chatter, a member joining and
+    a !balance DM.
+    """
+    update_id = 0
+    for tip in range(tips):
+        sender, receiver = tip_users(tip, users)
+        chat = {'id': -(tip + 1), 'type': 'supergroup',
+                'title': 'Benchmark chat'}
+        sender_from = {'id': sender, 'username': 'user{}'.format(sender)}
+        for index in range(noise):
+            update_id += 1
+            kind = index % 3
+            if kind == 0:
+                message = {'message_id': update_id, 'from': sender_from,
+                           'chat': chat, 'text': 'just chatting'}
+            elif kind == 1:
+                message = {'message_id': update_id, 'from': sender_from,
+                           'chat': chat,
+                           'new_chat_member': {
+                               'id': users + update_id,
+                               'username': 'joiner{}'.format(update_id)}}
+            else:
+                message = {'message_id': update_id, 'from': sender_from,
+                           'chat': {'id': sender, 'type': 'private'},
+                           'text': '!balance'}
+            yield None, {'update_id': update_id, 'message': message}
+        update_id += 1
+        yield tip, {
+            'update_id': update_id,
+            'message': {
+                'message_id': update_id,
+                'from': sender_from,
+                'chat': chat,
+                'text': '@{} !tip 1 @user{}'.format(BOT_NAME, receiver)
+            }
+        }
+
+
+async def load(port, stream, concurrency, posted, acks):
+    queue = asyncio.Queue()
+    for item in stream:
+        queue.put_nowait(item)
+
+    async def client():
+        while not queue.empty():
+            tip, update = queue.get_nowait()
+            if tip is not None:
+                posted[tip] = time.monotonic()
+            start = time.perf_counter()
+            try:
+                await post('127.0.0.1', port, '/', json.dumps(update).encode())
+            except OSError:
+                continue
+            acks.append(time.perf_counter() - start)
+
+    await asyncio.gather(*[client() for _ in range(concurrency)])
+
+
+def start_bot(directory, args, web_port):
+    env = dict(os.environ, MY_CONF_DIR=directory, FLASK_APP='webhooks.py')
+    if args.server == 'asgi':
+        web = [sys.executable, '-m', 'uvicorn', 'asgi:app', '--port',
+               str(web_port), '--log-level', 'warning']
+    else:
+        web = [sys.executable, '-m', 'flask', 'run', '--port', str(web_port),
+               '--no-reload', '--with-threads']
+    processes = []
+    for name, command in (('web', web),
+                          ('job_consumer', [sys.executable, '-m', 'flask',
+                                            'job_consumer']),
+                          ('outbox_dispatcher', [sys.executable, '-m', 'flask',
+                                                 'outbox_dispatcher'])):
+        log = open(os.path.join(directory, name + '.log'), 'wb')
+        # A session of its own, so forked workers are stopped and measured with their parent
+        processes.append(subprocess.Popen(command, cwd=REPO_ROOT, env=env,
+                                          stdout=log, stderr=log,
+                                          start_new_session=True))
+    deadline = time.monotonic() + 30
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', web_port), 1).close()
+            return processes
+        except OSError:
+            if time.monotonic() > deadline:
+                stop_bot(processes)
+                raise RuntimeError('bot did not start, see logs in {}'.format(
+                    directory))
+            time.sleep(0.2)
+
+
+def stop_bot(processes):
+    for process in processes:
+        try:
+            os.killpg(process.pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+    for process in processes:
+        process.wait()
+
+
+def usage(processes):
+    """
+    Return (CPU seconds, resident MB) summed over every process in the bot's sessions, read from /proc.
+    """
+    sessions = {process.pid for process in processes}
+    ticks = os.sysconf('SC_CLK_TCK')
+    page = os.sysconf('SC_PAGE_SIZE')
+    cpu = 0.0
+    rss = 0
+    for pid in filter(str.isdigit, os.listdir('/proc')):
+        try:
+            with open('/proc/{}/stat'.format(pid)) as stat_file:
+                fields = stat_file.read().rsplit(')', 1)[1].split()
+        except OSError:
+            continue
+        # fields[3] is the session id, 11/12 user and system time, 21 resident pages
+        if int(fields[3]) in sessions:
+            cpu += (int(fields[11]) + int(fields[12])) / ticks
+            rss += int(fields[21]) * page
+    return cpu, rss / 2**20
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[max(int(len(values) * fraction) - 1, 0)]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Offline end-to-end tip benchmark.')
+    parser.add_argument('--tips', type=int, default=500)
+    parser.add_argument('--users', type=int, default=50,
+                        help='Tips rotate through this many senders.')
+    parser.add_argument('--noise', type=int, default=3,
+                        help='Chatter, join and DM updates posted per tip.')
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--server', choices=('flask', 'asgi'),
+                        default='flask')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--ledger', action='store_true',
+                        help='Run with the internal ledger.')
+    parser.add_argument('--work-latency', type=float, default=0.05,
+                        help='Seconds the fake node spends on work_generate.')
+    parser.add_argument('--send-latency', type=float, default=0.01,
+                        help='Seconds the fake node spends on send.')
+    parser.add_argument('--telegram-latency', type=float, default=0.0)
+    parser.add_argument('--db-port', type=int,
+                        help='Use a MySQL server already running on this port '
+                        '(user root, no password) instead of starting one.')
+    parser.add_argument('--timeout', type=float, default=300)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='tipbot_e2e_')
+    node = fake_node.FakeNode(args.work_latency, args.send_latency)
+    node_server = fake_node.serve(node)
+    telegram = fake_telegram.FakeTelegram(args.telegram_latency)
+    telegram_server = fake_telegram.serve(telegram)
+    database = None
+    db_port = args.db_port
+    if db_port is None:
+        db_port = free_port()
+        database = local_db.start(directory, db_port)
+    web_port = free_port()
+    write_config(directory, args, node_server.server_port,
+                 telegram_server.server_port, db_port)
+    os.environ['MY_CONF_DIR'] = directory
+    processes = []
+    try:
+        seed(node, args.tips, args.users)
+        processes = start_bot(directory, args, web_port)
+
+        peak_rss = [0.0]
+
+        def sample():
+            while processes[0].poll() is None:
+                peak_rss[0] = max(peak_rss[0], usage(processes)[1])
+                time.sleep(0.5)
+
+        threading.Thread(target=sample, daemon=True).start()
+        posted = {}
+        acks = []
+        start = time.monotonic()
+        asyncio.run(load(web_port,
+                         updates(args.tips, args.users, args.noise),
+                         args.concurrency, posted, acks))
+
+        done = {}
+        deadline = start + args.timeout
+        while len(done) < len(posted) and time.monotonic() < deadline:
+            for tip in posted:
+                if tip not in done:
+                    replies = telegram.messages_to(-(tip + 1))
+                    if replies:
+                        done[tip] = replies[0]
+            time.sleep(0.1)
+        cpu, rss = usage(processes)
+    finally:
+        stop_bot(processes)
+        if database is not None:
+            local_db.stop(database)
+
+    succeeded = [tip for tip, reply in done.items()
+                 if 'successfully' in reply[2]]
+    latencies = [done[tip][0] - posted[tip] for tip in succeeded]
+    print("{} tips ({} server{}, {} workers), {} other updates".format(
+        args.tips, args.server, ', internal ledger' if args.ledger else '',
+        args.workers, args.tips * args.noise))
+    print("  succeeded {}, failed {}, unanswered {}".format(
+        len(succeeded), len(done) - len(succeeded), args.tips - len(done)))
+    if latencies:
+        elapsed = max(done[tip][0] for tip in succeeded) - start
+        print("  throughput: {:.1f} tips/sec".format(len(succeeded) / elapsed))
+        for fraction in (0.5, 0.95, 0.99):
+            print("  p{:.0f} tip latency: {:.1f} ms".format(
+                fraction * 100, percentile(latencies, fraction) * 1000))
+    if acks:
+        print("  p99 webhook ack: {:.1f} ms".format(
+            percentile(acks, 0.99) * 1000))
+    print("  node RPCs: {}".format(dict(node.calls)))
+    print("  Telegram messages: {}".format(len(telegram.messages)))
+    print("  bot CPU: {:.1f} s, resident memory: {:.0f} MB (peak {:.0f} MB)".
+          format(cpu, rss, peak_rss[0]))
+    print("  logs and config in {}".format(directory))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,216 @@
+"""
+In-memory stand-in for the Nano node RPC, good enough for the bot's custodial flows: account creation, balances,
+frontiers, pending blocks, send/receive with idempotent ids and work generation.  work_generate and send sleep for
+a configurable time to model PoW and block processing.  Work is tied to the hash it was generated for, and a block
+whose work was not generated for the account's current frontier is rejected, as a real node rejects a block built on
+a stale frontier.
+
+Usage: python -m benchmarks.fake_node [port] [work_latency] [send_latency]
+"""
+import hashlib
+import json
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def _hash():
+    return '{:064X}'.format(random.getrandbits(256))
+
+
+def _work(block_hash):
+    return hashlib.blake2b(block_hash.encode(), digest_size=8).hexdigest()
+
+
+class FakeNode:
+    def __init__(self, work_latency=0.0, send_latency=0.0):
+        self.work_latency = work_latency
+        self.send_latency = send_latency
+        self.lock = threading.Lock()
+        # account -> {'balance': raw, 'frontier': hash or None, 'pending': {hash: raw}}
+        self.accounts = {}
+        self.sends_by_id = {}
+        self.calls = Counter()
+
+    def add_account(self, balance=0, account=None):
+        account = account or 'usd_' + '{:060x}'.format(random.getrandbits(240))
+        with self.lock:
+            self.accounts[account] = {
+                'balance': balance,
+                'frontier': _hash() if balance else None,
+                'pending': {}
+            }
+        return account
+
+    def _account(self, account):
+        return self.accounts.setdefault(account, {
+            'balance': 0,
+            'frontier': None,
+            'pending': {}
+        })
+
+    def handle(self, request):
+        action = request.get('action')
+        self.calls[action] += 1
+        handler = getattr(self, 'rpc_' + str(action), None)
+        if handler is None:
+            return {'error': 'Unknown command'}
+        return handler(request)
+
+    def rpc_account_create(self, request):
+        return {'account': self.add_account()}
+
+    def rpc_accounts_create(self, request):
+        return {
+            'accounts': [self.add_account() for _ in range(int(request['count']))]
+        }
+
+    def rpc_account_key(self, request):
+        return {
+            'key': hashlib.sha256(request['account'].encode()).hexdigest().upper()
+        }
+
+    def rpc_account_balance(self, request):
+        with self.lock:
+            state = self._account(request['account'])
+            return {
+                'balance': str(state['balance']),
+                'pending': str(sum(state['pending'].values()))
+            }
+
+    def rpc_accounts_balances(self, request):
+        with self.lock:
+            return {
+                'balances': {
+                    account: {
+                        'balance': str(self._account(account)['balance']),
+                        'pending':
+                        str(sum(self._account(account)['pending'].values()))
+                    }
+                    for account in request['accounts']
+                }
+            }
+
+    def rpc_accounts_frontiers(self, request):
+        with self.lock:
+            return {
+                'frontiers': {
+                    account: self.accounts[account]['frontier']
+                    for account in request['accounts']
+                    if account in self.accounts
+                    and self.accounts[account]['frontier']
+                }
+            }
+
+    def rpc_accounts_pending(self, request):
+        with self.lock:
+            return {
+                'blocks': {
+                    account: {
+                        block: str(amount)
+                        for block, amount in self._account(account)
+                        ['pending'].items()
+                    }
+                    for account in request['accounts']
+                }
+            }
+
+    def rpc_wallet_balances(self, request):
+        with self.lock:
+            return {
+                'balances': {
+                    account: {
+                        'balance': str(state['balance']),
+                        'pending': str(sum(state['pending'].values()))
+                    }
+                    for account, state in self.accounts.items()
+                }
+            }
+
+    def rpc_block_count(self, request):
+        with self.lock:
+            count = sum(1 for state in self.accounts.values() if state['frontier'])
+        return {'count': str(count), 'unchecked': '0'}
+
+    def rpc_validate_account_number(self, request):
+        return {'valid': '1' if request['account'].startswith('usd_') else '0'}
+
+    def rpc_work_generate(self, request):
+        time.sleep(self.work_latency)
+        return {'work': _work(request['hash'])}
+
+    def _stale_work(self, request, state):
+        # Work is optional (the node generates it), but given work must be for the current frontier
+        return ('work' in request and state['frontier'] is not None
+                and request['work'] != _work(state['frontier']))
+
+    def rpc_send(self, request):
+        time.sleep(self.send_latency)
+        amount = int(request['amount'])
+        with self.lock:
+            if request.get('id') in self.sends_by_id:
+                return {'block': self.sends_by_id[request['id']]}
+            source = self._account(request['source'])
+            if self._stale_work(request, source):
+                self.calls['send_stale_work'] += 1
+                return {'error': 'Block work is invalid for the frontier'}
+            if source['balance'] < amount:
+                self.calls['send_insufficient'] += 1
+                return {'error': 'Insufficient balance'}
+            block = _hash()
+            source['balance'] -= amount
+            source['frontier'] = block
+            self._account(request['destination'])['pending'][block] = amount
+            if request.get('id'):
+                self.sends_by_id[request['id']] = block
+        return {'block': block}
+
+    def rpc_receive(self, request):
+        with self.lock:
+            state = self._account(request['account'])
+            if self._stale_work(request, state):
+                self.calls['receive_stale_work'] += 1
+                return {'error': 'Block work is invalid for the frontier'}
+            amount = state['pending'].pop(request['block'], None)
+            if amount is None:
+                return {'error': 'Block is not pending'}
+            block = _hash()
+            state['balance'] += amount
+            state['frontier'] = block
+        return {'block': block}
+
+
+def serve(node, port=0):
+    """
+    Serve node on 127.0.0.1 from a background thread.  Returns the HTTP server; its server_port is the bound port.
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers['Content-Length']))
+            response = json.dumps(node.handle(json.loads(body))).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(response)))
+            self.end_headers()
+            self.wfile.write(response)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    node = FakeNode(
+        float(sys.argv[2]) if len(sys.argv) > 2 else 0.0,
+        float(sys.argv[3]) if len(sys.argv) > 3 else 0.0)
+    server = serve(node, int(sys.argv[1]) if len(sys.argv) > 1 else 7076)
+    print("fake node on http://127.0.0.1:{}".format(server.server_port))
+    threading.Event().wait()
@@ -0,0 +1,94 @@
+"""
+Minimal Telegram Bot API that accepts sendMessage and setWebhook and records every message with the time it
+arrived.  Point the bot at it with telegram_base_url: http://127.0.0.1:<port>/bot
+
+Usage: python -m benchmarks.fake_telegram [port]
+"""
+import json
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl
+
+
+class FakeTelegram:
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.lock = threading.Lock()
+        # (arrival time, chat_id, text)
+        self.messages = []
+
+    def handle(self, method, params):
+        if method == 'sendMessage':
+            time.sleep(self.latency)
+            with self.lock:
+                self.messages.append(
+                    (time.monotonic(), int(params['chat_id']),
+                     params['text']))
+                message_id = len(self.messages)
+            return {
+                'message_id': message_id,
+                'date': int(time.time()),
+                'chat': {
+                    'id': int(params['chat_id']),
+                    'type': 'private'
+                },
+                'text': params['text']
+            }
+        if method in ('setWebhook', 'deleteWebhook'):
+            return True
+        if method == 'getMe':
+            return {'id': 1, 'is_bot': True, 'first_name': 'bench',
+                    'username': 'benchbot'}
+        return None
+
+    def messages_to(self, chat_id):
+        with self.lock:
+            return [message for message in self.messages
+                    if message[1] == chat_id]
+
+
+def serve(telegram, port=0):
+    """
+    Serve telegram on 127.0.0.1 from a background thread.  Returns the HTTP server.
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            if self.headers.get('Content-Type', '').startswith(
+                    'application/json'):
+                params = json.loads(body or b'{}')
+            else:
+                params = dict(parse_qsl(body.decode()))
+            result = telegram.handle(self.path.rsplit('/', 1)[-1], params)
+            if result is None:
+                response = {'ok': False, 'error_code': 404,
+                            'description': 'Not Found'}
+            else:
+                response = {'ok': True, 'result': result}
+            response = json.dumps(response).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(response)))
+            self.end_headers()
+            self.wfile.write(response)
+
+        do_GET = do_POST
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    server = serve(FakeTelegram(),
+                   int(sys.argv[1]) if len(sys.argv) > 1 else 8081)
+    print("fake Telegram on http://127.0.0.1:{}/bot".format(
+        server.server_port))
+    threading.Event().wait()
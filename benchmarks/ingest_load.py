@@ -0,0 +1,91 @@
+"""
+Load test a Telegram webhook endpoint: post synthetic updates at a fixed concurrency and report updates/sec and
+acknowledgement latency percentiles.  Run it once against the Flask route and once against the ASGI app to compare.
+
+Usage: python -m benchmarks.ingest_load URL [updates] [concurrency]
+    e.g. python -m benchmarks.ingest_load http://127.0.0.1:5000/ 5000 100
+"""
+import asyncio
+import json
+import random
+import sys
+import time
+from urllib.parse import urlsplit
+
+BOT_NAME = 'nollartipbot'
+
+
+def synthetic_update(update_id):
+    """
+    Mostly plain group chatter, with some tips, DMs and membership changes, roughly the mix of a busy group.
+    """
+    user_id = random.randint(1, 5000)
+    sender = {'id': user_id, 'username': 'user{}'.format(user_id)}
+    chat = {'id': -1000 - random.randint(1, 20), 'type': 'supergroup',
+            'title': 'Benchmark chat'}
+    roll = random.random()
+    if roll < 0.85:
+        message = {'message_id': update_id, 'from': sender, 'chat': chat,
+                   'text': 'just chatting about nollar {}'.format(update_id)}
+    elif roll < 0.93:
+        message = {'message_id': update_id, 'from': sender, 'chat': chat,
+                   'text': '@{} !tip 1 @user{}'.format(BOT_NAME, random.randint(1, 5000))}
+    elif roll < 0.98:
+        message = {'message_id': update_id, 'from': sender,
+                   'chat': {'id': user_id, 'type': 'private'}, 'text': '!balance'}
+    else:
+        message = {'message_id': update_id, 'from': sender, 'chat': chat,
+                   'new_chat_member': {'id': user_id + 5000, 'username': 'new{}'.format(user_id)}}
+    return {'update_id': update_id, 'message': message}
+
+
+async def post(host, port, path, body):
+    reader, writer = await asyncio.open_connection(host, port)
+    writer.write(
+        'POST {} HTTP/1.1\r\nHost: {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\n'
+        'Connection: close\r\n\r\n'.format(path, host, len(body)).encode() + body)
+    await writer.drain()
+    status_line = await reader.readline()
+    await reader.read()
+    writer.close()
+    return int(status_line.split()[1])
+
+
+async def run(url, updates, concurrency):
+    parts = urlsplit(url)
+    path = parts.path or '/'
+    queue = asyncio.Queue()
+    for update_id in range(updates):
+        queue.put_nowait(json.dumps(synthetic_update(update_id)).encode())
+    latencies = []
+    errors = []
+
+    async def client():
+        while not queue.empty():
+            body = queue.get_nowait()
+            start = time.perf_counter()
+            try:
+                status = await post(parts.hostname, parts.port or 80, path, body)
+            except OSError as e:
+                errors.append(str(e))
+                continue
+            latencies.append(time.perf_counter() - start)
+            if status != 200:
+                errors.append(status)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[client() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    print("{}: {} updates in {:.2f}s, {:.0f} updates/sec, {} errors".format(
+        url, len(latencies), elapsed, len(latencies) / elapsed, len(errors)))
+    for percentile in (50, 95, 99):
+        print("  p{} ack latency: {:.1f} ms".format(
+            percentile, latencies[max(int(len(latencies) * percentile / 100) - 1, 0)] * 1000))
+
+
+if __name__ == "__main__":
+    asyncio.run(run(sys.argv[1],
+                    int(sys.argv[2]) if len(sys.argv) > 2 else 2000,
+                    int(sys.argv[3]) if len(sys.argv) > 3 else 50))
@@ -0,0 +1,74 @@
+"""
+Throwaway MySQL or MariaDB server in a directory of its own, so benchmarks get a real database without touching an
+existing one.  Needs mysqld (or mariadbd) on the PATH; root has no password and only listens on 127.0.0.1.
+
+Usage: python -m benchmarks.local_db DIRECTORY [port]    (runs until interrupted)
+"""
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+import pymysql
+
+
+def start(directory, port):
+    """
+    Initialise a data directory under directory if needed and start a server on port.  Returns the server process.
+    """
+    datadir = os.path.join(directory, 'data')
+    mysqld = shutil.which('mariadbd') or shutil.which('mysqld')
+    if mysqld is None:
+        raise RuntimeError('mysqld or mariadbd is needed for a local database')
+    as_root = ['--user=root'] if os.geteuid() == 0 else []
+    log = open(os.path.join(directory, 'mysqld.log'), 'ab')
+    if not os.path.isdir(datadir):
+        install = shutil.which('mariadb-install-db') or shutil.which(
+            'mysql_install_db')
+        if install is not None:
+            subprocess.run([install, '--no-defaults', '--datadir=' + datadir,
+                            '--auth-root-authentication-method=normal'] +
+                           as_root, check=True, stdout=log, stderr=log)
+        else:
+            subprocess.run([mysqld, '--no-defaults', '--initialize-insecure',
+                            '--datadir=' + datadir] + as_root,
+                           check=True, stdout=log, stderr=log)
+
+    server = subprocess.Popen(
+        [mysqld, '--no-defaults', '--datadir=' + datadir,
+         '--port={}'.format(port), '--bind-address=127.0.0.1',
+         '--socket=' + os.path.join(directory, 'mysqld.sock'),
+         '--pid-file=' + os.path.join(directory, 'mysqld.pid'),
+         '--skip-log-bin', '--innodb-flush-log-at-trx-commit=2'] + as_root,
+        stdout=log, stderr=log)
+    deadline = time.monotonic() + 60
+    while True:
+        try:
+            pymysql.connect(host='127.0.0.1', port=port, user='root',
+                            passwd='').close()
+            return server
+        except pymysql.MySQLError:
+            if server.poll() is not None or time.monotonic() > deadline:
+                stop(server)
+                raise RuntimeError('local database did not start, see {}'.format(
+                    os.path.join(directory, 'mysqld.log')))
+            time.sleep(0.5)
+
+
+def stop(server):
+    server.terminate()
+    try:
+        server.wait(30)
+    except subprocess.TimeoutExpired:
+        server.kill()
+
+
+if __name__ == "__main__":
+    port = int(sys.argv[2]) if len(sys.argv) > 2 else 3307
+    server = start(sys.argv[1], port)
+    print("local database on 127.0.0.1:{} (user root, no password)".format(port))
+    try:
+        server.wait()
+    except KeyboardInterrupt:
+        stop(server)
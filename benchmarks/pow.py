@@ -0,0 +1,99 @@
+"""
+Hash rate of the local proof-of-work generator in modules.work, per core and for the whole process pool, and the time
+to find work at a threshold low enough to run offline.  Every result is checked with work_value, then the HTTP front
+end is exercised through the same nano RPC client the bot uses: work_generate, work_validate, and a work_cancel that
+stops a search at an unreachable threshold.
+
+Usage: MY_CONF_DIR=config python -m benchmarks.pow [--processes N] [--threshold ffff000000000000] [--blocks 20]
+
+MY_CONF_DIR must contain a webhooks.ini; the repository only ships config/example_config.ini, copy it to
+config/webhooks.ini first.
+"""
+import argparse
+import os
+import random
+import threading
+import time
+
+import nano
+
+from modules import work
+
+
+def hashes_per_second(seconds):
+    root = bytes(random.getrandbits(8) for _ in range(32))
+    count = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < seconds:
+        # An unreachable threshold makes _search try every nonce in the chunk
+        work._search(root, 2**64, count, 10000)
+        count += 10000
+    return count / (time.perf_counter() - start)
+
+
+def block_hash():
+    return '{:064X}'.format(random.getrandbits(256))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local PoW throughput.')
+    parser.add_argument('--processes', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--threshold', default='ffff000000000000',
+                        help='Hex work threshold for the timed blocks.')
+    parser.add_argument('--blocks', type=int, default=20)
+    parser.add_argument('--seconds', type=float, default=2.0)
+    args = parser.parse_args()
+
+    per_core = hashes_per_second(args.seconds)
+    expected = 2**64 / (2**64 - int(args.threshold, 16))
+    print("one core: {:.0f} hashes/sec".format(per_core))
+    print("threshold {}: {:.0f} hashes expected per block, {:.3f}s per block at {} cores".format(
+        args.threshold, expected, expected / per_core / args.processes,
+        args.processes))
+
+    generator = work.Generator(args.processes)
+    work._generator = generator
+    start = time.perf_counter()
+    for _ in range(args.blocks):
+        hash = block_hash()
+        result = generator.generate(hash, args.threshold)
+        assert work.work_value(hash, result) >= int(args.threshold, 16)
+    elapsed = time.perf_counter() - start
+    print("{} processes: {} blocks in {:.2f}s, {:.3f}s per block, ~{:.0f} hashes/sec, {:.0f} per core".format(
+        args.processes, args.blocks, elapsed, elapsed / args.blocks,
+        expected * args.blocks / elapsed,
+        expected * args.blocks / elapsed / args.processes))
+
+    server = work.ThreadingHTTPServer(('127.0.0.1', 0), work._Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    rpc = nano.rpc.Client('http://127.0.0.1:{}'.format(server.server_port))
+    work.WORK_THRESHOLD = args.threshold
+    hash = block_hash()
+    result = rpc.work_generate(hash)
+    assert rpc.work_validate(result, hash)
+    print("HTTP work_generate and work_validate: ok")
+
+    stuck = block_hash()
+    outcome = {}
+
+    def unreachable():
+        try:
+            generator.generate(stuck, 'ffffffffffffffff')
+        except work.WorkCancelled:
+            outcome['cancelled'] = time.perf_counter()
+
+    thread = threading.Thread(target=unreachable)
+    thread.start()
+    time.sleep(0.5)
+    cancel_start = time.perf_counter()
+    rpc.work_cancel(stuck)
+    thread.join()
+    print("HTTP work_cancel: search stopped after {:.3f}s".format(
+        outcome['cancelled'] - cancel_start))
+    generator.close()
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""
+Cost per update of group traffic the bot does not act on (chatter, stickers, photos, edits, mentions without a
+command) through the full parsing path, which is what the Flask webhook ran for every update, and through the
+ingest.classify pre-filter.  Runs in process; members are written to the DB once during warm-up, so the timed passes
+measure the steady state where every member is cached.
+
+Usage: MY_CONF_DIR=config python -m benchmarks.prefilter [updates]
+
+MY_CONF_DIR must contain a webhooks.ini; the repository only ships config/example_config.ini, copy it to
+config/webhooks.ini first.
+"""
+import logging
+import os
+import random
+import sys
+import time
+from collections import Counter
+
+from modules import ingest, social
+
+USERS = 2000
+CHATS = 20
+
+
+def chat_update(update_id, user_id, roll):
+    """
+    A group update from user_id; roll in [0, 1) picks the kind, in roughly the mix of a busy chat.
+    """
+    sender = {'id': user_id, 'is_bot': False, 'first_name': 'User',
+              'username': 'user{}'.format(user_id)}
+    chat = {'id': -1000 - user_id % CHATS, 'type': 'supergroup',
+            'title': 'Nollar chat #{}'.format(user_id % CHATS)}
+    message = {'message_id': update_id, 'from': sender, 'chat': chat,
+               'date': 1600000000}
+    if roll < 0.75:
+        message['text'] = 'just chatting about nollar, price is {} today'.format(
+            update_id)
+    elif roll < 0.83:
+        message['sticker'] = {'file_id': 'sticker{}'.format(update_id),
+                              'emoji': ':)'}
+    elif roll < 0.88:
+        message['photo'] = [{'file_id': 'photo{}'.format(update_id)}]
+        message['caption'] = 'look at this'
+    elif roll < 0.95:
+        message['text'] = 'edited text'
+        return {'update_id': update_id, 'edited_message': message}
+    else:
+        message['text'] = 'thanks {} for the bot!'.format(ingest.BOTNAME)
+    return {'update_id': update_id, 'message': message}
+
+
+def full_path(update):
+    ingest.handle_update(update)
+
+
+def prefiltered(update):
+    update_class = ingest.classify(update)
+    if update_class == 'member':
+        ingest.refresh_member(update)
+    elif update_class == 'process':
+        ingest.handle_update(update)
+
+
+def timed(name, handler, updates):
+    start = time.perf_counter()
+    for update in updates:
+        handler(update)
+    elapsed = time.perf_counter() - start
+    print("  {}: {:.0f} updates/sec, {:.1f} us per update".format(
+        name, len(updates) / elapsed, elapsed / len(updates) * 10**6))
+    return elapsed
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    # Log as the bot does, but to nowhere, so formatting is measured and the terminal stays readable
+    logging.getLogger().handlers[0].setStream(open(os.devnull, 'w'))
+    updates = [
+        chat_update(update_id, random.randint(1, USERS), random.random())
+        for update_id in range(count)
+    ]
+    for user_id in range(1, USERS + 1):
+        ingest.refresh_member(chat_update(0, user_id, 0))
+    social.flush_members()
+
+    print("{} group updates: {}".format(
+        count, dict(Counter(ingest.classify(update) for update in updates))))
+    full = timed('full parse', full_path, updates)
+    fast = timed('pre-filter', prefiltered, updates)
+    print("  speedup: {:.1f}x, membership cache {}".format(
+        full / fast, social.member_cache_stats()))
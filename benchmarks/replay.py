@@ -0,0 +1,207 @@
+"""
+Replay webhook traffic recorded with capture_file against another instance, e.g. a busy production hour against a
+staging build, and compare the outcome of every update with the recorded one.
+
+Updates are sent with their recorded spacing divided by --speed, or as fast as --concurrency allows with --speed max.
+User IDs, usernames and names are replaced by stable pseudonyms unless --keep-users is given; pseudonyms keep the
+length of the original so message entity offsets stay valid, and the same --key gives the same pseudonyms on every run.
+
+Usage: python -m benchmarks.replay CAPTURE_FILE URL [--speed 1|N|max] [--concurrency 50] [--results FILE]
+    e.g. python -m benchmarks.replay /var/log/tipbot/capture.jsonl http://staging:5000/ --speed 10
+"""
+import argparse
+import asyncio
+import copy
+import hashlib
+import hmac
+import json
+import os
+import re
+import time
+from urllib.parse import urlsplit
+
+from benchmarks.ingest_load import post
+
+MENTION = re.compile(r'@(\w+)')
+
+
+def load(path):
+    """
+    Return the captured (arrival, duration, status, update) records in arrival order.  A line cut short by a crash
+    during capture is skipped.
+    """
+    records = []
+    with open(path) as capture_file:
+        for line in capture_file:
+            try:
+                records.append(tuple(json.loads(line)))
+            except ValueError:
+                continue
+    records.sort(key=lambda record: record[0])
+    return records
+
+
+class Anonymiser:
+    def __init__(self, key, bot_name):
+        self.key = key
+        self.bot_name = bot_name.lower()
+
+    def _digest(self, value):
+        return hmac.new(self.key, str(value).encode(),
+                        hashlib.sha256).hexdigest()
+
+    def user_id(self, user_id):
+        return 10**9 + int(self._digest(user_id)[:12], 16) % 10**9
+
+    def username(self, username):
+        if username.lower() == self.bot_name:
+            return username
+        return ('u' + self._digest(username.lower()))[:len(username)]
+
+    def text(self, text):
+        return MENTION.sub(lambda match: '@' + self.username(match.group(1)),
+                           text)
+
+    def update(self, value):
+        """
+        Anonymise a copy of an update: every User object and private chat, and every @mention in message text.
+        """
+        value = copy.deepcopy(value)
+        self._walk(value)
+        return value
+
+    def _walk(self, value):
+        if isinstance(value, list):
+            for item in value:
+                self._walk(item)
+            return
+        if not isinstance(value, dict):
+            return
+        is_user = 'is_bot' in value or 'first_name' in value or (
+            'username' in value and 'type' not in value)
+        is_private_chat = value.get('type') == 'private'
+        if (is_user or is_private_chat) and isinstance(value.get('id'), int):
+            value['id'] = self.user_id(value['id'])
+        for key, item in value.items():
+            if isinstance(item, str):
+                if key == 'username' and (is_user or is_private_chat):
+                    value[key] = self.username(item)
+                elif key in ('first_name', 'last_name') and (is_user or
+                                                             is_private_chat):
+                    value[key] = 'User'
+                elif key in ('text', 'caption'):
+                    value[key] = self.text(item)
+            else:
+                self._walk(item)
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[max(int(len(values) * fraction) - 1, 0)]
+
+
+async def replay(records, url, speed, concurrency, anonymiser):
+    """
+    Send every record and return [(record, replayed status or error, ack seconds, seconds behind schedule)].
+    """
+    parts = urlsplit(url)
+    path = parts.path or '/'
+    semaphore = asyncio.Semaphore(concurrency)
+    results = []
+
+    async def send(record, lag):
+        update = record[3]
+        if anonymiser is not None:
+            update = anonymiser.update(update)
+        body = json.dumps(update).encode()
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                status = await post(parts.hostname, parts.port or 80, path,
+                                    body)
+            except OSError as e:
+                status = str(e)
+            results.append((record, status, time.perf_counter() - start, lag))
+
+    tasks = []
+    start = time.perf_counter()
+    first_arrival = records[0][0] if records else 0
+    for record in records:
+        if speed is not None:
+            due = start + (record[0] - first_arrival) / speed
+            delay = due - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            lag = max(time.perf_counter() - due, 0)
+        else:
+            lag = 0
+            # Keep the number of pending sends bounded when replaying as fast as possible
+            while len(tasks) - len(results) >= concurrency:
+                await asyncio.sleep(0.001)
+        tasks.append(asyncio.ensure_future(send(record, lag)))
+    await asyncio.gather(*tasks)
+    return results, time.perf_counter() - start
+
+
+def report(results, elapsed, results_path):
+    mismatches = [(record, status) for record, status, _, _ in results
+                  if status != record[2]]
+    print("{} updates in {:.2f}s, {:.0f} updates/sec".format(
+        len(results), elapsed, len(results) / elapsed if elapsed else 0))
+    print("  same status as recorded: {}, different: {}".format(
+        len(results) - len(mismatches), len(mismatches)))
+    for record, status in mismatches[:10]:
+        print("    update {}: recorded {}, replayed {}".format(
+            record[3].get('update_id'), record[2], status))
+    if results:
+        for fraction in (0.5, 0.95, 0.99):
+            print("  p{:.0f} recorded handling {:.1f} ms, replayed ack {:.1f} ms".
+                  format(fraction * 100,
+                         percentile([r[0][1] for r in results], fraction) * 1000,
+                         percentile([r[2] for r in results], fraction) * 1000))
+        print("  max lag behind schedule: {:.1f} ms".format(
+            max(r[3] for r in results) * 1000))
+    if results_path:
+        with open(results_path, 'w') as results_file:
+            for record, status, ack, lag in results:
+                results_file.write(json.dumps({
+                    'update_id': record[3].get('update_id'),
+                    'recorded_status': record[2],
+                    'replayed_status': status,
+                    'recorded_seconds': record[1],
+                    'replayed_seconds': round(ack, 4)
+                }) + '\n')
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Replay captured webhook traffic against an instance.')
+    parser.add_argument('capture_file')
+    parser.add_argument('url')
+    parser.add_argument('--speed', default='1',
+                        help='Multiple of the recorded rate, or max.')
+    parser.add_argument('--concurrency', type=int, default=50,
+                        help='Most updates in flight at once.')
+    parser.add_argument('--keep-users', action='store_true',
+                        help='Send user IDs and names unchanged.')
+    parser.add_argument('--key', default=None,
+                        help='Secret for stable pseudonyms; random if unset.')
+    parser.add_argument('--bot-name', default='nollartipbot',
+                        help='Username of the bot, left as is in mentions.')
+    parser.add_argument('--results',
+                        help='Write one JSON line per update to this file.')
+    args = parser.parse_args()
+
+    speed = None if args.speed == 'max' else float(args.speed)
+    anonymiser = None
+    if not args.keep_users:
+        key = args.key.encode() if args.key else os.urandom(16)
+        anonymiser = Anonymiser(key, args.bot_name)
+    records = load(args.capture_file)
+    results, elapsed = asyncio.run(
+        replay(records, args.url, speed, args.concurrency, anonymiser))
+    report(results, elapsed, args.results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,237 @@
+"""
+Stress test for per-account lanes: many concurrent tips from one sender, spread over forked processes and threads,
+against the fake node and a throwaway local database.  The sender can afford only some of the tips.  Checks that
+exactly the affordable tips go through, that the node never rejects a send for stale work or a missing balance, and
+that the tracked balance matches the node's.  Then every receiver withdraws at once, with the tips still pending on
+their accounts, which checks that a withdrawal receives its pending blocks inside its own lane without waiting for
+itself.  Exits with status 1 if any check fails.
+
+Usage: python -m benchmarks.tip_stress [--tips 200] [--affordable 120] [--processes 4] [--threads 8] [--ledger]
+"""
+import argparse
+import multiprocessing
+import os
+import sys
+import tempfile
+import threading
+import time
+
+from benchmarks import e2e, fake_node, local_db
+
+SENDER_ID = 1
+CHAT_ID = -1
+TIP_RAW = 100
+
+
+def seed(node, affordable, receivers):
+    from modules import db, migrations
+
+    db.create_db()
+    db.create_tables()
+    migrations.migrate()
+    users = [(SENDER_ID, 'sender', node.add_account(affordable * TIP_RAW))]
+    for user_id in range(SENDER_ID + 1, SENDER_ID + 1 + receivers):
+        users.append((user_id, 'user{}'.format(user_id), node.add_account()))
+    db.set_db_data_many(
+        "INSERT INTO users (user_id, user_name, account, register) VALUES (%s, %s, %s, 1)",
+        users)
+    db.set_db_data_many(
+        "INSERT INTO telegram_chat_members (chat_id, chat_name, member_id, member_name) VALUES (%s, %s, %s, %s)",
+        [(CHAT_ID, 'Stress chat', user[0], user[1]) for user in users])
+    return users[0][2], len(users) - 1
+
+
+def tip(tip_id, receivers):
+    from modules import orchestration, social
+
+    receiver = SENDER_ID + 1 + tip_id % receivers
+    text = '@{} !tip 1 @user{}'.format(e2e.BOT_NAME, receiver)
+    message = {
+        'id': tip_id,
+        'chat_id': CHAT_ID,
+        'chat_name': 'Stress chat',
+        'sender_id': SENDER_ID,
+        'sender_screen_name': 'sender',
+        'raw_text': text,
+        'entities': [],
+        'text': text.lower().split(' ')
+    }
+    message = social.check_message_action(message)
+    message = social.validate_tip_amount(message)
+    orchestration.tip_process(message, [])
+
+
+def withdraw(receiver_id, destination):
+    from modules import orchestration
+
+    message = {
+        'dm_id': 'stress-{}'.format(receiver_id),
+        'sender_id': receiver_id,
+        'dm_array': ['!withdraw', destination]
+    }
+    orchestration.withdraw_process(message)
+
+
+def withdraw_worker(receiver_ids, destination, errors):
+    threads = []
+    failed = []
+
+    def run(receiver_id):
+        try:
+            withdraw(receiver_id, destination)
+        except Exception as e:
+            failed.append('withdraw {}: {}'.format(receiver_id, e))
+
+    for receiver_id in receiver_ids:
+        threads.append(threading.Thread(target=run, args=(receiver_id, )))
+        threads[-1].start()
+    for thread in threads:
+        thread.join()
+    for failure in failed:
+        errors.put(failure)
+
+
+def worker(tip_ids, threads, receivers, errors):
+    failed = []
+
+    def run(ids):
+        for tip_id in ids:
+            try:
+                tip(tip_id, receivers)
+            except Exception as e:
+                failed.append('tip {}: {}'.format(tip_id, e))
+
+    pool = [
+        threading.Thread(target=run, args=(tip_ids[index::threads], ))
+        for index in range(threads)
+    ]
+    for thread in pool:
+        thread.start()
+    for thread in pool:
+        thread.join()
+    for failure in failed:
+        errors.put(failure)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Concurrent tips from one sender.')
+    parser.add_argument('--tips', type=int, default=200)
+    parser.add_argument('--affordable', type=int, default=120,
+                        help='Tips the sender has the balance for.')
+    parser.add_argument('--receivers', type=int, default=10)
+    parser.add_argument('--processes', type=int, default=4)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--ledger', action='store_true',
+                        help='Run with the internal ledger.')
+    parser.add_argument('--work-latency', type=float, default=0.02)
+    parser.add_argument('--send-latency', type=float, default=0.005)
+    parser.add_argument('--db-port', type=int,
+                        help='Use a MySQL server already running on this port '
+                        '(user root, no password) instead of starting one.')
+    args = parser.parse_args()
+    args.workers = 1
+
+    directory = tempfile.mkdtemp(prefix='tipbot_stress_')
+    node = fake_node.FakeNode(args.work_latency, args.send_latency)
+    node_server = fake_node.serve(node)
+    database = None
+    db_port = args.db_port
+    if db_port is None:
+        db_port = e2e.free_port()
+        database = local_db.start(directory, db_port)
+    e2e.write_config(directory, args, node_server.server_port,
+                     e2e.free_port(), db_port)
+    os.environ['MY_CONF_DIR'] = directory
+    try:
+        sender_account, receivers = seed(node, args.affordable,
+                                         args.receivers)
+        from modules import chain, db, lanes
+
+        errors = multiprocessing.get_context('fork').Queue()
+        processes = [
+            multiprocessing.get_context('fork').Process(
+                target=worker,
+                args=(list(range(args.tips))[index::args.processes],
+                      args.threads, receivers, errors))
+            for index in range(args.processes)
+        ]
+        start = time.monotonic()
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        elapsed = time.monotonic() - start
+
+        failures = []
+        while not errors.empty():
+            failures.append(errors.get())
+        sent = db.get_db_data("SELECT COUNT(*) FROM tip_list", ())[0][0]
+        refused = db.get_db_data(
+            "SELECT COUNT(*) FROM outbox WHERE text LIKE %s",
+            ('You do not have enough%'))[0][0]
+        node_balance = node.accounts[sender_account]['balance']
+        chain.forget(sender_account)
+        tracked_balance = None if args.ledger else chain.get_balance(
+            sender_account)
+
+        # The tips are still pending on the receivers' accounts, nothing consumed the notify jobs
+        destination = node.add_account()
+        receiver_ids = list(range(SENDER_ID + 1, SENDER_ID + 1 + receivers))
+        withdraw_processes = [
+            multiprocessing.get_context('fork').Process(
+                target=withdraw_worker,
+                args=(receiver_ids[index::args.processes], destination,
+                      errors))
+            for index in range(args.processes)
+        ]
+        withdraw_start = time.monotonic()
+        for process in withdraw_processes:
+            process.start()
+        for process in withdraw_processes:
+            process.join()
+        withdraw_elapsed = time.monotonic() - withdraw_start
+        while not errors.empty():
+            failures.append(errors.get())
+        withdrawn = node.accounts[destination]['balance']
+        withdraw_replies = db.get_db_data(
+            "SELECT COUNT(*) FROM outbox WHERE text LIKE %s",
+            ('You have successfully withdrawn%'))[0][0]
+    finally:
+        if database is not None:
+            local_db.stop(database)
+
+    expected = min(args.tips, args.affordable)
+    checks = [
+        ('tips recorded == affordable ({})'.format(expected), sent == expected),
+        ('refused for balance == {}'.format(args.tips - expected),
+         refused == args.tips - expected),
+        ('no send rejected for stale work',
+         node.calls['send_stale_work'] + node.calls['receive_stale_work'] == 0),
+        ('no send rejected for balance', node.calls['send_insufficient'] == 0),
+        ('no tip or withdrawal raised', not failures),
+        ('withdrawn == tipped ({})'.format(sent * TIP_RAW),
+         withdrawn == sent * TIP_RAW),
+        ('every receiver withdrew ({})'.format(receivers),
+         withdraw_replies == receivers),
+        ('withdrawals did not wait out a lane ({:.1f}s)'.format(
+            withdraw_elapsed), withdraw_elapsed < lanes.ACCOUNT_LANE_TIMEOUT),
+    ]
+    if not args.ledger:
+        checks.append(('tracked balance == node balance ({})'.format(
+            node_balance), int(tracked_balance) == node_balance))
+    print("{} tips from one sender in {} processes x {} threads{}: {:.2f}s, {:.1f} tips/sec".format(
+        args.tips, args.processes, args.threads,
+        ', internal ledger' if args.ledger else '', elapsed,
+        args.tips / elapsed))
+    print("  recorded {}, refused {}, node calls {}".format(
+        sent, refused, dict(node.calls)))
+    for failure in failures[:10]:
+        print("  " + failure)
+    for name, passed in checks:
+        print("  {} {}".format('ok  ' if passed else 'FAIL', name))
+    sys.exit(0 if all(passed for name, passed in checks) else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+import configparser
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from . import currency, db, metrics, node
+
+# Read config and parse constants
+config = configparser.ConfigParser()
+config.read(os.environ['MY_CONF_DIR'] + '/webhooks.ini')
+logging.basicConfig(handlers=[logging.StreamHandler()], level=logging.INFO)
+
+# Constants
+WALLET = config.get('webhooks', 'wallet')
+# The refiller tops the pool up to ACCOUNT_POOL_TARGET unclaimed accounts once it falls below ACCOUNT_POOL_LOW,
+# creating ACCOUNT_POOL_BATCH accounts per accounts_create call
+ACCOUNT_POOL_LOW = int(config.get('webhooks', 'account_pool_low',
+                                  fallback='20'))
+ACCOUNT_POOL_TARGET = int(
+    config.get('webhooks', 'account_pool_target', fallback='100'))
+ACCOUNT_POOL_BATCH = int(
+    config.get('webhooks', 'account_pool_batch', fallback='20'))
+ACCOUNT_POOL_INTERVAL = float(
+    config.get('webhooks', 'account_pool_interval', fallback='5'))
+ACCOUNT_POOL_WORK_THREADS = int(
+    config.get('webhooks', 'account_pool_work_threads', fallback='4'))
+
+# Connect to node
+rpc = node.rpc
+
+
+def claim(user_id):
+    """
+    Take an unclaimed account from the pool for user_id, or return None if the pool is empty.  The claim is one
+    UPDATE, so concurrent claims never get the same account; LAST_INSERT_ID(id) hands back the claimed row's id on
+    the same connection.
+    """
+    claim_call = (
+        "UPDATE account_pool SET claimed_by = %s, claimed_at = NOW(6), id = LAST_INSERT_ID(id) "
+        "WHERE claimed_by IS NULL ORDER BY id LIMIT 1")
+    with db.connection() as connection:
+        cursor = connection.cursor()
+        cursor.execute(claim_call, (user_id))
+        if cursor.rowcount == 0:
+            return None
+        cursor.execute("SELECT account FROM account_pool WHERE id = %s",
+                       (cursor.lastrowid))
+        return cursor.fetchone()[0]
+
+
+def new_account(user_id):
+    """
+    Return a fresh custodial account for user_id: a pooled one when available, whose opening block already has work,
+    otherwise one created on the node now.
+    """
+    account = claim(user_id)
+    if account is not None:
+        metrics.ACCOUNT_POOL_CLAIMS.labels('pooled').inc()
+    else:
+        metrics.ACCOUNT_POOL_CLAIMS.labels('created').inc()
+        logging.info("{}: account pool is empty, creating an account".format(
+            datetime.now()))
+        account = rpc.account_create(wallet="{}".format(WALLET), work=False)
+    currency.add_to_account_index(account)
+    return account
+
+
+def unclaimed():
+    free_call = "SELECT COUNT(*) FROM account_pool WHERE claimed_by IS NULL"
+    return db.get_db_data(free_call, ())[0][0]
+
+
+def _opening_work(account):
+    # An account's first block is built on its public key
+    return account, currency.generate_work(rpc.account_key(account))
+
+
+def refill(executor):
+    """
+    Create accounts until the pool holds ACCOUNT_POOL_TARGET unclaimed ones, each with the work for its opening block
+    in the work cache.  Returns the number of accounts added.
+    """
+    added = 0
+    missing = ACCOUNT_POOL_TARGET - unclaimed()
+    while missing > 0:
+        accounts = rpc.accounts_create(wallet="{}".format(WALLET),
+                                       count=min(ACCOUNT_POOL_BATCH, missing),
+                                       work=False)
+        opening_work = list(executor.map(_opening_work, accounts))
+        store_work_call = "REPLACE INTO work_cache (account, frontier, work) VALUES (%s, %s, %s)"
+        db.set_db_data_many(store_work_call,
+                            [(account, currency.OPEN_ROOT, work)
+                             for account, work in opening_work])
+        pool_call = "INSERT INTO account_pool (account, created_at) VALUES (%s, NOW(6))"
+        db.set_db_data_many(pool_call, [(account, ) for account in accounts])
+        added += len(accounts)
+        missing -= len(accounts)
+    return added
+
+
+def refill_forever():
+    """
+    Check the pool every ACCOUNT_POOL_INTERVAL seconds and refill it when it falls below ACCOUNT_POOL_LOW.  Any number
+    of refillers can run; they may overshoot the target by a batch.
+    """
+    executor = ThreadPoolExecutor(max_workers=ACCOUNT_POOL_WORK_THREADS)
+    logging.info("{}: keeping {}-{} accounts in the pool".format(
+        datetime.now(), ACCOUNT_POOL_LOW, ACCOUNT_POOL_TARGET))
+    while True:
+        try:
+            free = unclaimed()
+            metrics.ACCOUNT_POOL_FREE.set(free)
+            if free < ACCOUNT_POOL_LOW:
+                added = refill(executor)
+                metrics.ACCOUNT_POOL_FREE.set(free + added)
+                logging.info("{}: added {} accounts to the pool".format(
+                    datetime.now(), added))
+        except Exception as e:
+            logging.error("{}: account pool refill failed: {}".format(
+                datetime.now(), e))
+        time.sleep(ACCOUNT_POOL_INTERVAL)
@@ -0,0 +1,55 @@
+import configparser
+import json
+import logging
+import os
+import threading
+from datetime import datetime
+
+# Read config and parse constants
+config = configparser.ConfigParser()
+config.read(os.environ['MY_CONF_DIR'] + '/webhooks.ini')
+logging.basicConfig(handlers=[logging.StreamHandler()], level=logging.INFO)
+
+# Opt-in: when set, every update the webhook receives is appended to this file for benchmarks/replay.py.  The file
+# holds one compact JSON array per line, [arrival unix time, seconds to answer, HTTP status, update], and is only
+# ever appended to, so several web server processes can share it.  Restart the web server after moving it away.
+CAPTURE_FILE = config.get('webhooks', 'capture_file', fallback='')
+
+_capture_fd = [None]
+_capture_lock = threading.Lock()
+
+
+def _reset_after_fork():
+    # The descriptor is shared with the parent, which is fine for appends; the lock may have been held at the fork
+    global _capture_lock
+    _capture_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def _open():
+    if _capture_fd[0] is None:
+        _capture_fd[0] = os.open(CAPTURE_FILE,
+                                 os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+    return _capture_fd[0]
+
+
+def record(arrival, duration, status, request_json):
+    """
+    Append one update with its arrival time, handling time and response status to the capture file.  Capture never
+    fails the webhook: errors are logged and the update is skipped.
+    """
+    if not CAPTURE_FILE:
+        return
+    line = json.dumps([round(arrival, 4),
+                       round(duration, 6),
+                       int(status), request_json],
+                      separators=(',', ':')).encode() + b'\n'
+    try:
+        with _capture_lock:
+            # A single write to an O_APPEND file, so lines from several processes never interleave
+            os.write(_open(), line)
+    except OSError as e:
+        logging.error("{}: Capture to {} failed: {}".format(
+            datetime.now(), CAPTURE_FILE, e))
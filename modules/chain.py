@@ -0,0 +1,212 @@
+import configparser
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+
+from . import db, node
+
+# Read config and parse constants
+config = configparser.ConfigParser()
+config.read(os.environ['MY_CONF_DIR'] + '/webhooks.ini')
+logging.basicConfig(handlers=[logging.StreamHandler()], level=logging.INFO)
+
+# Constants
+NODE_IP = config.get('webhooks', 'node_ip')
+# How long tracked state is trusted before it is re-read from the node.  Blocks the bot did not produce (e.g. the
+# node auto-receiving a deposit) are only picked up after this.
+CHAIN_STATE_TTL = int(
+    config.get('webhooks', 'chain_state_ttl', fallback='60'))
+# How long this process trusts its own copy before checking the account_state table written by other workers.
+CHAIN_STATE_MEMORY_TTL = float(
+    config.get('webhooks', 'chain_state_memory_ttl', fallback='1'))
+
+# Connect to the wallet node.  Blocks are built on the frontiers read here, so they are not read from another node
+# that may not have seen the wallet's latest blocks yet.
+rpc = node.Client(NODE_IP)
+
+# account -> (frontier, balance_raw, monotonic time the entry was stored)
+_state = {}
+_state_lock = threading.Lock()
+_state_stats = {
+    'memory_hits': 0,
+    'db_hits': 0,
+    'syncs': 0,
+    'invalidations': 0
+}
+
+
+def _reset_after_fork():
+    global _state_lock
+    _state_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def _remember(account, frontier, balance):
+    with _state_lock:
+        _state[account] = (frontier, balance, time.monotonic())
+
+
+def _store(account, frontier, balance):
+    _remember(account, frontier, balance)
+    store_state_call = "REPLACE INTO account_state (account, frontier, balance, updated_at) VALUES (%s, %s, %s, NOW(6))"
+    db.set_db_data(store_state_call, (account, frontier, balance))
+
+
+def _lookup(account):
+    with _state_lock:
+        cached = _state.get(account)
+    if cached is not None and time.monotonic(
+    ) - cached[2] < CHAIN_STATE_MEMORY_TTL:
+        _state_stats['memory_hits'] += 1
+        return cached[0], cached[1]
+
+    account_state_call = "SELECT frontier, balance FROM account_state WHERE account = %s AND updated_at > NOW(6) - INTERVAL %s SECOND"
+    account_state_data = db.get_db_data(account_state_call,
+                                        (account, CHAIN_STATE_TTL))
+    if account_state_data:
+        _state_stats['db_hits'] += 1
+        frontier, balance = account_state_data[0][0], int(
+            account_state_data[0][1])
+        _remember(account, frontier, balance)
+        return frontier, balance
+
+    return None
+
+
+def get_state(account):
+    """
+    Return (frontier, balance_raw) for a custodial account from the local tracker, falling back to the account_state
+    table and finally the node.
+    """
+    state = _lookup(account)
+    if state is None:
+        state = sync(account)
+    return state
+
+
+def get_frontier(account):
+    """
+    Return the hash of the account's latest block, None if the account is not opened yet.
+    """
+    return get_state(account)[0]
+
+
+def get_frontiers(accounts):
+    """
+    Return {account: frontier} for many accounts, None for those not opened yet.  State this process does not hold is
+    read from the account_state table with one query, and what is not tracked there is synced from the node for all
+    remaining accounts together.
+    """
+    frontiers = {}
+    now = time.monotonic()
+    with _state_lock:
+        for account in accounts:
+            cached = _state.get(account)
+            if cached is not None and now - cached[2] < CHAIN_STATE_MEMORY_TTL:
+                frontiers[account] = cached[0]
+    _state_stats['memory_hits'] += len(frontiers)
+
+    missing = [account for account in accounts if account not in frontiers]
+    if missing:
+        account_states_call = "SELECT account, frontier, balance FROM account_state WHERE account IN ({}) AND updated_at > NOW(6) - INTERVAL %s SECOND".format(
+            ', '.join(['%s'] * len(missing)))
+        for account, frontier, balance in db.get_db_data(
+                account_states_call, missing + [CHAIN_STATE_TTL]):
+            _state_stats['db_hits'] += 1
+            _remember(account, frontier, int(balance))
+            frontiers[account] = frontier
+
+    missing = [account for account in accounts if account not in frontiers]
+    if missing:
+        frontiers.update(sync_many(missing))
+    return frontiers
+
+
+def get_balance(account):
+    """
+    Return the account's balance in raw.
+    """
+    return get_state(account)[1]
+
+
+def sync(account):
+    """
+    Re-read frontier and balance from the node and store them.
+    """
+    _state_stats['syncs'] += 1
+    frontier = rpc.accounts_frontiers([account]).get(account)
+    balance = rpc.account_balance(account='{}'.format(account))['balance']
+    logging.info("{}: synced chain state of {}: frontier {} balance {}".format(
+        datetime.now(), account, frontier, balance))
+    _store(account, frontier, balance)
+    return frontier, balance
+
+
+def sync_many(accounts):
+    """
+    Re-read frontiers and balances of many accounts from the node, with one accounts_frontiers and one
+    accounts_balances call, and store them.  Returns {account: frontier}.
+    """
+    _state_stats['syncs'] += len(accounts)
+    frontiers = rpc.accounts_frontiers(accounts)
+    balances = rpc.accounts_balances(accounts)
+    states = [(account, frontiers.get(account),
+               balances.get(account, {'balance': 0})['balance'])
+              for account in accounts]
+    for account, frontier, balance in states:
+        _remember(account, frontier, balance)
+    store_states_call = "REPLACE INTO account_state (account, frontier, balance, updated_at) VALUES (%s, %s, %s, NOW(6))"
+    db.set_db_data_many(store_states_call, states)
+    logging.info("{}: synced chain state of {} accounts".format(
+        datetime.now(), len(accounts)))
+    return {account: frontier for account, frontier, balance in states}
+
+
+def record_send(account, block_hash, amount_raw):
+    """
+    Track a send block the bot published from account.  Untracked accounts are left for the next read to sync, as
+    the node already includes the block.
+    """
+    state = _lookup(account)
+    # A send retried with the same id returns the block that was already recorded
+    if state is not None and state[0] != block_hash:
+        _store(account, block_hash, state[1] - int(amount_raw))
+
+
+def record_receive(account, block_hash, amount_raw):
+    """
+    Track a receive block the bot published on account.
+    """
+    state = _lookup(account)
+    if state is not None and state[0] != block_hash:
+        _store(account, block_hash, state[1] + int(amount_raw))
+
+
+def forget(account):
+    """
+    Drop this process's copy of the account's state, so the next read goes to the account_state table.
+    """
+    with _state_lock:
+        _state.pop(account, None)
+
+
+def invalidate(account):
+    """
+    Forget the tracked state, e.g. after the node rejected a block built on it.  The next read re-syncs from the node.
+    """
+    _state_stats['invalidations'] += 1
+    with _state_lock:
+        _state.pop(account, None)
+    invalidate_call = "DELETE FROM account_state WHERE account = %s"
+    db.set_db_data(invalidate_call, (account))
+
+
+def chain_state_stats():
+    """
+    Return how often state was served locally, from the DB, or had to be synced from the node.
+    """
+    return dict(_state_stats)
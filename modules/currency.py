@@ -3,12 +3,16 @@ import json
 import logging
 import os
 import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from decimal import localcontext
 
 import nano
-import requests
 
-from . import db, social
+from . import (account_pool, chain, db, jobs, lanes, ledger, metrics, node,
+               outbox, social)
 
 # Read config and parse constants
 config = configparser.ConfigParser()
@@ -17,124 +21,495 @@ logging.basicConfig(handlers=[logging.StreamHandler()], level=logging.INFO)
 # Constants
 WALLET = config.get('webhooks', 'wallet')
 NODE_IP = config.get('webhooks', 'node_ip')
+TIP_SETTLE_THREADS = int(
+    config.get('webhooks', 'tip_settle_threads', fallback='8'))
+WORK_PRECOMPUTE_THREADS = int(
+    config.get('webhooks', 'work_precompute_threads', fallback='2'))
+RECEIVE_BATCH_SIZE = int(
+    config.get('webhooks', 'receive_batch_size', fallback='500'))
+RECEIVE_THREADS = int(config.get('webhooks', 'receive_threads', fallback='8'))
+RECEIVE_TIMEOUT = float(
+    config.get('webhooks', 'receive_timeout', fallback='30'))
+ACCOUNT_INDEX_REFRESH = float(
+    config.get('webhooks', 'account_index_refresh', fallback='30'))
+# Tips to the same receiver within this many seconds are announced in one DM
+TIP_NOTIFY_WINDOW = int(
+    config.get('webhooks', 'tip_notify_window', fallback='10'))
+
+# Node that generates work: the wallet node unless work_node_ip points elsewhere, e.g. at flask work_server
+WORK_NODE_IP = config.get('webhooks', 'work_node_ip', fallback=NODE_IP)
+
+# Seconds work generation is retried before the operation needing the work fails
+WORK_DEADLINE = float(config.get('webhooks', 'work_deadline', fallback='300'))
 
 # Connect to Nano node
-rpc = nano.rpc.Client(NODE_IP)
+rpc = node.rpc
+work_rpc = node.Client(WORK_NODE_IP)
 raw_denominator = 10**2
+# Work cache: account -> (frontier, work) for the account's next block.  Entries are also stored in the work_cache
+# table so every worker and host can use work precomputed by another.
+_work_cache = {}
+_work_cache_lock = threading.Lock()
+_work_in_flight = {}
+# Frontiers whose work is no longer needed, so generate_work stops retrying them
+_work_cancelled = set()
+_work_executor = ThreadPoolExecutor(max_workers=WORK_PRECOMPUTE_THREADS)
+_work_cache_stats = {
+    'hits': 0,
+    'waited': 0,
+    'misses': 0,
+    'stale': 0,
+    'precomputed': 0
+}
+
+
+# work_cache frontier of the work for an account's opening block, which is built on the account's public key
+OPEN_ROOT = 'open'
+
+# Every account in users.account, used to match node callbacks without a DB query per block
+_account_index = set()
+_account_index_loaded = None
+
+
+def _reset_after_fork():
+    """
+    The parent's precompute threads do not exist in the child.
+    """
+    global _work_cache_lock, _work_in_flight, _work_cancelled, _work_executor
+    _work_cache_lock = threading.Lock()
+    _work_in_flight = {}
+    _work_cancelled = set()
+    _work_executor = ThreadPoolExecutor(max_workers=WORK_PRECOMPUTE_THREADS)
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def refresh_account_index():
+    """
+    Reload the set of custodial accounts from the users table.
+    """
+    global _account_index, _account_index_loaded
+    account_data = db.get_db_data("SELECT account FROM users", ())
+    _account_index = {row[0] for row in account_data}
+    _account_index_loaded = time.monotonic()
+    logging.info("{}: account index holds {} accounts".format(
+        datetime.now(), len(_account_index)))
+
+
+def add_to_account_index(account):
+    _account_index.add(account)
+
+
+def is_custodial_account(account):
+    """
+    Check whether account belongs to a bot user.  A miss reloads the index, at most every ACCOUNT_INDEX_REFRESH
+    seconds, to pick up accounts created by other processes.
+    """
+    if account in _account_index:
+        return True
+    if _account_index_loaded is None or time.monotonic(
+    ) - _account_index_loaded > ACCOUNT_INDEX_REFRESH:
+        refresh_account_index()
+        return account in _account_index
+    return False
+
+
+def callback_destination(callback):
+    """
+    Return the account a node HTTP callback paid to, or None if the block is not a send.
+    """
+    block = callback.get('block')
+    if isinstance(block, str):
+        block = json.loads(block)
+    if not isinstance(block, dict):
+        return None
+    if block.get('type') == 'send':
+        return block.get('destination')
+    if block.get('type') == 'state' and (
+            callback.get('is_send') in ('true', True)
+            or block.get('subtype') == 'send'
+            or callback.get('subtype') == 'send'):
+        return block.get('link_as_account')
+    return None
 
 
 def receive_pending(sender_account):
     """
     Check to see if the account has any pending blocks and process them
     """
-    try:
-        logging.info("{}: in receive pending".format(datetime.now()))
-        pending_blocks = rpc.pending(account='{}'.format(sender_account))
+    receive_pending_accounts([sender_account])
+
+
+def receive_pending_accounts(accounts):
+    """
+    Receive the pending blocks of many accounts at once: pending blocks are found with one accounts_pending call per
+    RECEIVE_BATCH_SIZE accounts, accounts are processed in parallel and each account's blocks in order.  Returns the
+    number of blocks received.
+    """
+    logging.info("{}: in receive pending for {} accounts".format(
+        datetime.now(), len(accounts)))
+    received = 0
+    for batch_start in range(0, len(accounts), RECEIVE_BATCH_SIZE):
+        batch = accounts[batch_start:batch_start + RECEIVE_BATCH_SIZE]
+        try:
+            pending_blocks = rpc.accounts_pending(batch, threshold=1)
+        except Exception as e:
+            logging.info("Receive Pending Error: {}".format(e))
+            raise e
+        pending_blocks = {
+            account: blocks
+            for account, blocks in pending_blocks.items() if blocks
+        }
         logging.info("pending blocks: {}".format(pending_blocks))
-        if len(pending_blocks) > 0:
-            for block in pending_blocks:
-                work = get_pow(sender_account)
-                if work == '':
-                    logging.info("{}: processing without pow".format(
-                        datetime.now()))
-                    receive_data = {
-                        'action': "receive",
-                        'wallet': WALLET,
-                        'account': sender_account,
-                        'block': block
-                    }
-                else:
-                    logging.info("{}: processing with pow".format(
-                        datetime.now()))
-                    receive_data = {
-                        'action': "receive",
-                        'wallet': WALLET,
-                        'account': sender_account,
-                        'block': block,
-                        'work': work
-                    }
-                receive_json = json.dumps(receive_data)
-                requests.post('{}'.format(NODE_IP), data=receive_json)
-                logging.info("{}: block {} received".format(
-                    datetime.now(), block))
+        if not pending_blocks:
+            continue
+
+        # Get work going for every account's first receive before any is posted.  The frontiers are read for the
+        # whole batch at once, untracked accounts are synced from the node together.
+        for account, frontier_hash in chain.get_frontiers(
+                list(pending_blocks)).items():
+            if frontier_hash is not None:
+                precompute_work(account, frontier_hash)
 
+        if len(pending_blocks) == 1:
+            # On this thread, so a caller already in the account's lane (a withdrawal) re-enters it instead of
+            # waiting for itself
+            account, blocks = next(iter(pending_blocks.items()))
+            received += receive_blocks(account, blocks)
         else:
-            logging.info('{}: No blocks to receive.'.format(datetime.now()))
+            with ThreadPoolExecutor(
+                    max_workers=min(RECEIVE_THREADS,
+                                    len(pending_blocks))) as executor:
+                received += sum(
+                    executor.map(
+                        lambda account: receive_blocks(
+                            account, pending_blocks[account]), pending_blocks))
+        if ledger.LEDGER_MODE:
+            ledger.credit_deposits(list(pending_blocks))
 
-    except Exception as e:
-        logging.info("Receive Pending Error: {}".format(e))
-        raise e
+    if received == 0:
+        logging.info('{}: No blocks to receive.'.format(datetime.now()))
+    return received
+
+
+def receive_blocks(account, pending_blocks):
+    """
+    Post a receive for each pending block of one account, in order, over the keep-alive node session.  Runs in the
+    account's lane.
+    """
+    with lanes.account_lane(account):
+        for block, amount in pending_blocks.items():
+            work = get_pow(account)
+            receive_data = {
+                'action': "receive",
+                'wallet': WALLET,
+                'account': account,
+                'block': block
+            }
+            if work == '':
+                logging.info("{}: processing without pow".format(datetime.now()))
+            else:
+                logging.info("{}: processing with pow".format(datetime.now()))
+                receive_data['work'] = work
+            try:
+                receive_return = rpc.call('receive', receive_data,
+                                          timeout=RECEIVE_TIMEOUT)
+            except nano.rpc.RPCException as e:
+                # The node answered, e.g. the block was already received; the chain is re-read below
+                logging.info("Receive Pending Error: {}".format(e))
+                receive_return = {}
+            except Exception as e:
+                logging.info("Receive Pending Error: {}".format(e))
+                chain.invalidate(account)
+                raise e
+            if 'block' in receive_return:
+                chain.record_receive(account, receive_return['block'], amount)
+                precompute_work(account, receive_return['block'])
+            else:
+                chain.invalidate(account)
+            logging.info("{}: block {} received".format(datetime.now(), block))
 
-    return
+    return len(pending_blocks)
 
 
 def get_pow(sender_account):
     """
-    Retrieves the frontier (hash of previous transaction) of the provided account and generates work for the next block.
+    Looks up the frontier (hash of previous transaction) of the provided account in the chain tracker and returns work for the next block,
+    from the work cache when it was precomputed.
     """
     logging.info("{}: in get_pow".format(datetime.now()))
     try:
-        account_frontiers = rpc.accounts_frontiers([sender_account])
-        frontier_hash = account_frontiers[sender_account]
+        frontier_hash = chain.get_frontier(sender_account)
     except Exception as e:
         logging.info("{}: Error checking frontier: {}".format(
             datetime.now(), e))
         return ''
-    logging.info("account_frontiers: {}".format(account_frontiers))
+    if frontier_hash is None:
+        # Accounts from the account pool come with work for their opening block, others leave it to the node
+        logging.info("{}: {} has no frontier yet".format(
+            datetime.now(), sender_account))
+        return get_cached_work(sender_account, OPEN_ROOT)
+
+    work = get_cached_work(sender_account, frontier_hash)
+    if work != '':
+        return work
+
+    with _work_cache_lock:
+        in_flight = _work_in_flight.get((sender_account, frontier_hash))
+    if in_flight is not None:
+        # A precompute for this frontier is already running, wait for it rather than starting over
+        _work_cache_stats['waited'] += 1
+        work = in_flight.result()
+        if work != '':
+            return work
 
+    _work_cache_stats['misses'] += 1
+    return generate_work(frontier_hash)
+
+
+def generate_work(frontier_hash):
+    """
+    Ask the work node for work on frontier_hash, retrying with backoff for up to WORK_DEADLINE seconds, or return ''
+    once the work is cancelled.  Raises node.NodeUnavailable at once while the work node's breaker is open.
+    """
     work = ''
+    attempt = 0
+    deadline = time.monotonic() + WORK_DEADLINE
     logging.info("{}: hash: {}".format(datetime.now(), frontier_hash))
     while work == '':
         try:
-            work = rpc.work_generate(frontier_hash)
+            work = work_rpc.work_generate(frontier_hash)
             logging.info("{}: Work generated: {}".format(datetime.now(), work))
         except Exception as e:
+            with _work_cache_lock:
+                if frontier_hash in _work_cancelled:
+                    _work_cancelled.discard(frontier_hash)
+                    logging.info("{}: work for {} cancelled".format(
+                        datetime.now(), frontier_hash))
+                    return ''
             logging.info("{}: ERROR GENERATING WORK: {}".format(
                 datetime.now(), e))
-            pass
+            if isinstance(e, node.NodeUnavailable) or time.monotonic() >= deadline:
+                raise
+            attempt += 1
+            time.sleep(node.backoff(attempt))
 
     return work
 
 
-def send_tip(message, users_to_tip, tip_index):
+def cancel_work(frontier_hash):
     """
-    Process tip for specified user
+    Stop generating work for a frontier that has been built on, freeing the work node for current ones.
     """
-    logging.info("{}: sending tip to {}".format(
-        datetime.now(), users_to_tip[tip_index]['receiver_screen_name']))
-    if str(users_to_tip[tip_index]['receiver_id']) == str(
-            message['sender_id']):
-        self_tip_text = "Self tipping is not allowed.  Please use this bot to spread the NOLLAR to other users!"
-        social.send_reply(message, self_tip_text)
+    with _work_cache_lock:
+        _work_cancelled.add(frontier_hash)
+    try:
+        work_rpc.work_cancel(frontier_hash)
+    except Exception as e:
+        logging.info("{}: Error cancelling work for {}: {}".format(
+            datetime.now(), frontier_hash, e))
 
-        logging.info("{}: User tried to tip themself").format(datetime.now())
-        return
 
-    # Check if the receiver has an account
-    receiver_account_get = "SELECT account FROM users where user_id = %s"
-    arguments = (int(users_to_tip[tip_index]['receiver_id']))
-    receiver_account_data = db.get_db_data(receiver_account_get, arguments)
+def get_cached_work(account, frontier_hash):
+    """
+    Return precomputed work for the account's current frontier, or '' if there is none.  Another process may have
+    stored work for a newer frontier than this one remembers, so the database is read whenever memory has no match.
+    Work cached for an older frontier is dropped.
+    """
+    with _work_cache_lock:
+        cached = _work_cache.get(account)
+    if cached is None or cached[0] != frontier_hash:
+        stale = {cached[0]} if cached is not None else set()
+        cached = None
+        work_cache_call = "SELECT frontier, work FROM work_cache WHERE account = %s"
+        for frontier, work in db.get_db_data(work_cache_call, (account)):
+            if frontier == frontier_hash:
+                cached = (frontier, work)
+                with _work_cache_lock:
+                    _work_cache[account] = cached
+            else:
+                stale.add(frontier)
+        if stale:
+            _work_cache_stats['stale'] += 1
+        for frontier in stale:
+            drop_cached_work(account, frontier)
+
+    if cached is None:
+        return ''
+    _work_cache_stats['hits'] += 1
+    return cached[1]
 
-    # If they don't, create an account for them
-    if not receiver_account_data:
-        users_to_tip[tip_index]['receiver_account'] = rpc.account_create(
-            wallet="{}".format(WALLET), work=True)
-        create_receiver_account = "INSERT INTO users (user_id, user_name, account, register) VALUES(%s, %s, %s, 0)"
-        arguments = (users_to_tip[tip_index]['receiver_id'],
-                     users_to_tip[tip_index]['receiver_screen_name'],
-                     users_to_tip[tip_index]['receiver_account'])
-        db.set_db_data(create_receiver_account, arguments)
-        logging.info(
-            "{}: Sender sent to a new receiving account.  Created  account {}".
-            format(datetime.now(),
-                   users_to_tip[tip_index]['receiver_account']))
 
+def drop_cached_work(account, frontier_hash):
+    """
+    Forget work cached for the account's frontier_hash.  Work another process stored for a different frontier stays.
+    """
+    with _work_cache_lock:
+        if _work_cache.get(account, (None, ))[0] == frontier_hash:
+            del _work_cache[account]
+    drop_work_call = "DELETE FROM work_cache WHERE account = %s AND frontier = %s"
+    db.set_db_data(drop_work_call, (account, frontier_hash))
+
+
+def precompute_work(account, frontier_hash):
+    """
+    Start generating work for the block after frontier_hash in the background, as soon as a block is published.
+    """
+    with _work_cache_lock:
+        if (account, frontier_hash) in _work_in_flight:
+            return
+        stale = [
+            in_flight for in_flight in _work_in_flight
+            if in_flight[0] == account
+        ]
+        future = _work_executor.submit(_precompute, account, frontier_hash)
+        _work_in_flight[(account, frontier_hash)] = future
+    # The account moved past these frontiers, their work can never be used
+    for _, stale_frontier in stale:
+        cancel_work(stale_frontier)
+
+
+def _precompute(account, frontier_hash):
+    try:
+        work = generate_work(frontier_hash)
+        if work == '':
+            return work
+        with _work_cache_lock:
+            _work_cache[account] = (frontier_hash, work)
+        store_work_call = "REPLACE INTO work_cache (account, frontier, work) VALUES (%s, %s, %s)"
+        db.set_db_data(store_work_call, (account, frontier_hash, work))
+        _work_cache_stats['precomputed'] += 1
+        return work
+    except Exception as e:
+        logging.info("{}: Error precomputing work for {}: {}".format(
+            datetime.now(), account, e))
+        return ''
+    finally:
+        with _work_cache_lock:
+            _work_in_flight.pop((account, frontier_hash), None)
+
+
+def work_cache_stats():
+    """
+    Return work cache hit/miss counters and the hit rate.
+    """
+    stats = dict(_work_cache_stats)
+    lookups = stats['hits'] + stats['waited'] + stats['misses']
+    stats['hit_rate'] = (stats['hits'] +
+                         stats['waited']) / lookups if lookups else 0
+    return stats
+
+
+def send_tips(message, users_to_tip):
+    """
+    Send the tip to every user in users_to_tip as a pipeline: resolve all receiver accounts up front, publish the sends
+    in order on the sender's chain (or transfer on the internal ledger), then queue the receivers' notifications.
+    Returns the time spent in each stage.
+    """
+    timings = {}
+    stage_start = time.monotonic()
+    for receiver in users_to_tip:
+        if str(receiver['receiver_id']) == str(message['sender_id']):
+            self_tip_text = "Self tipping is not allowed.  Please use this bot to spread the NOLLAR to other users!"
+            social.send_reply(message, self_tip_text)
+            logging.info("{}: User tried to tip themself".format(
+                datetime.now()))
+    users_to_tip = [
+        receiver for receiver in users_to_tip
+        if str(receiver['receiver_id']) != str(message['sender_id'])
+    ]
+    if not users_to_tip:
+        return timings
+
+    prepare_receivers(users_to_tip)
+    timings['prepare'] = time.monotonic() - stage_start
+
+    stage_start = time.monotonic()
+    if ledger.LEDGER_MODE:
+        # Tips between bot users stay off chain.  Receivers an earlier attempt already credited are recorded too, in
+        # case that attempt stopped before recording them.
+        ledger.transfer_tips(message, users_to_tip)
+        for tip_index in range(0, len(users_to_tip)):
+            message['tip_id'] = users_to_tip[tip_index]['tip_id']
+            db.set_db_data_tip(message, users_to_tip, tip_index)
     else:
-        users_to_tip[tip_index]['receiver_account'] = receiver_account_data[0][
-            0]
+        # Every send extends the sender's chain, so they have to be published one after another
+        for tip_index in range(0, len(users_to_tip)):
+            try:
+                send_tip_block(message, users_to_tip, tip_index)
+            except Exception:
+                # A retry skips the receivers already paid, so they are notified now
+                if tip_index > 0:
+                    queue_tip_notifications(message, users_to_tip[:tip_index])
+                raise
+    timings['send'] = time.monotonic() - stage_start
+
+    # Receiving and the DM happen in the receiver's notify job, coalesced with their other tips
+    stage_start = time.monotonic()
+    queue_tip_notifications(message, users_to_tip)
+    timings['settle'] = time.monotonic() - stage_start
+
+    for stage, seconds in timings.items():
+        metrics.TIP_STAGE_SECONDS.labels(stage).observe(seconds)
+    logging.info("{}: sent {} tips, stage timings: {}".format(
+        datetime.now(), len(users_to_tip), timings))
+    return timings
+
+
+def prepare_receivers(users_to_tip):
+    """
+    Look up the accounts of all receivers in one query, and create accounts for new receivers concurrently.
+    """
+    receiver_ids = list(
+        {int(receiver['receiver_id'])
+         for receiver in users_to_tip})
+    receiver_account_get = "SELECT user_id, account FROM users WHERE user_id IN ({})".format(
+        ', '.join(['%s'] * len(receiver_ids)))
+    receiver_accounts = dict(
+        db.get_db_data(receiver_account_get, receiver_ids))
 
-    # Send the tip
-    message['tip_id'] = "{}{}".format(message['id'], tip_index)
+    new_receivers = []
+    for receiver in users_to_tip:
+        receiver_id = int(receiver['receiver_id'])
+        if receiver_id in receiver_accounts:
+            receiver['receiver_account'] = receiver_accounts[receiver_id]
+        elif receiver_id not in [
+                int(new['receiver_id']) for new in new_receivers
+        ]:
+            new_receivers.append(receiver)
+
+    if new_receivers:
+        with ThreadPoolExecutor(
+                max_workers=min(TIP_SETTLE_THREADS,
+                                len(new_receivers))) as executor:
+            new_accounts = list(
+                executor.map(
+                    lambda receiver: account_pool.new_account(
+                        int(receiver['receiver_id'])), new_receivers))
+        create_receiver_account = "INSERT INTO users (user_id, user_name, account, register) VALUES(%s, %s, %s, 0)"
+        arguments = []
+        for receiver, account in zip(new_receivers, new_accounts):
+            receiver_accounts[int(receiver['receiver_id'])] = account
+            arguments.append((receiver['receiver_id'],
+                              receiver['receiver_screen_name'], account))
+            logging.info(
+                "{}: Sender sent to a new receiving account.  Created  account {}"
+                .format(datetime.now(), account))
+        db.set_db_data_many(create_receiver_account, arguments)
+
+        for receiver in users_to_tip:
+            receiver['receiver_account'] = receiver_accounts[int(
+                receiver['receiver_id'])]
+
+
+def send_tip_block(message, users_to_tip, tip_index):
+    """
+    Publish the send block for one receiver and record the tip
+    """
+    logging.info("{}: sending tip to {}".format(
+        datetime.now(), users_to_tip[tip_index]['receiver_screen_name']))
+    message['tip_id'] = users_to_tip[tip_index]['tip_id']
 
     work = get_pow(message['sender_account'])
     logging.info("Sending Tip:")
@@ -143,58 +518,118 @@ def send_tip(message, users_to_tip, tip_index):
     logging.info("amount: {:f}".format(message['tip_amount_raw']))
     logging.info("id: {}".format(message['tip_id']))
     logging.info("work: {}".format(work))
-    if work == '':
-        message['send_hash'] = rpc.send(
-            wallet="{}".format(WALLET),
-            source="{}".format(message['sender_account']),
-            destination="{}".format(
-                users_to_tip[tip_index]['receiver_account']),
-            amount="{}".format(int(message['tip_amount_raw'])),
-            id="tip-{}".format(message['tip_id']))
-    else:
-        message['send_hash'] = rpc.send(
-            wallet="{}".format(WALLET),
-            source="{}".format(message['sender_account']),
-            destination="{}".format(
-                users_to_tip[tip_index]['receiver_account']),
-            amount="{}".format(int(message['tip_amount_raw'])),
-            work=work,
-            id="tip-{}".format(message['tip_id']))
+    try:
+        if work == '':
+            message['send_hash'] = rpc.send(
+                wallet="{}".format(WALLET),
+                source="{}".format(message['sender_account']),
+                destination="{}".format(
+                    users_to_tip[tip_index]['receiver_account']),
+                amount="{}".format(int(message['tip_amount_raw'])),
+                id="tip-{}".format(message['tip_id']))
+        else:
+            message['send_hash'] = rpc.send(
+                wallet="{}".format(WALLET),
+                source="{}".format(message['sender_account']),
+                destination="{}".format(
+                    users_to_tip[tip_index]['receiver_account']),
+                amount="{}".format(int(message['tip_amount_raw'])),
+                work=work,
+                id="tip-{}".format(message['tip_id']))
+    except Exception:
+        # The tracked frontier or balance may be wrong, re-read it from the node next time
+        chain.invalidate(message['sender_account'])
+        raise
+    users_to_tip[tip_index]['send_hash'] = message['send_hash']
+    chain.record_send(message['sender_account'], message['send_hash'],
+                      message['tip_amount_raw'])
+    precompute_work(message['sender_account'], message['send_hash'])
     # Update the DB
     db.set_db_data_tip(message, users_to_tip, tip_index)
 
-    # Get receiver's new balance
-    try:
-        logging.info("{}: Checking to receive new tip")
-        receive_pending(users_to_tip[tip_index]['receiver_account'])
-        balance_return = rpc.account_balance(
-            account="{}".format(users_to_tip[tip_index]['receiver_account']))
-        users_to_tip[tip_index][
-            'balance'] = balance_return['balance'] / raw_denominator
-
-        # create a string to remove scientific notation from small decimal tips
-        if str(users_to_tip[tip_index]['balance'])[0] == ".":
-            users_to_tip[tip_index]['balance'] = "0{}".format(
-                str(users_to_tip[tip_index]['balance']))
+    logging.info("{}: tip sent to {} via hash {}".format(
+        datetime.now(), users_to_tip[tip_index]['receiver_screen_name'],
+        message['send_hash']))
+
+
+def queue_tip_notifications(message, users_to_tip):
+    """
+    Record a notification for every receiver.  A receiver's first pending notification schedules a notify job
+    TIP_NOTIFY_WINDOW seconds out, which sends one DM for all tips that arrive until then.
+    """
+    notification_call = (
+        "INSERT INTO tip_notifications (receiver_id, receiver_account, sender_name, amount, created_at) "
+        "VALUES (%s, %s, %s, %s, NOW(6))")
+    db.set_db_data_many(notification_call,
+                        [(receiver['receiver_id'], receiver['receiver_account'],
+                          message['sender_screen_name'], message['tip_amount'])
+                         for receiver in users_to_tip])
+
+    schedule_call = "INSERT IGNORE INTO tip_notify_schedule (receiver_id, scheduled_at) VALUES (%s, NOW(6))"
+    for receiver_id in dict.fromkeys(
+            int(receiver['receiver_id']) for receiver in users_to_tip):
+        # Only the insert that creates the row schedules the job, later tips in the window join it
+        if db.set_db_data(schedule_call, (receiver_id)):
+            try:
+                jobs.enqueue('notify', receiver_id, delay=TIP_NOTIFY_WINDOW)
+            except Exception:
+                unschedule_call = "DELETE FROM tip_notify_schedule WHERE receiver_id = %s"
+                db.set_db_data(unschedule_call, (receiver_id))
+                raise
+
+
+def notify_process(receiver_id):
+    """
+    Let a receiver know about every tip queued for them since the last notification: receive them (unless they are
+    ledger transfers), read the balance once and send a single DM with the senders and the combined amount.  The DM is
+    queued in the same transaction that deletes the notifications it covers, so each tip is announced once even when
+    the job is retried or a second notify job for the receiver runs alongside.
+    """
+    # Tips recorded from here on schedule a new job, which waits below until this one is done
+    unschedule_call = "DELETE FROM tip_notify_schedule WHERE receiver_id = %s"
+    db.set_db_data(unschedule_call, (receiver_id))
+    account_call = "SELECT receiver_account FROM tip_notifications WHERE receiver_id = %s ORDER BY id LIMIT 1"
+    account_data = db.get_db_data(account_call, (receiver_id))
+    if not account_data:
+        return
+    receiver_account = account_data[0][0]
+    if not ledger.LEDGER_MODE:
+        receive_pending(receiver_account)
+
+    with db.transaction() as cursor:
+        notifications_call = "SELECT id, receiver_account, sender_name, amount FROM tip_notifications WHERE receiver_id = %s ORDER BY id FOR UPDATE"
+        cursor.execute(notifications_call, (receiver_id))
+        notifications = cursor.fetchall()
+        if not notifications:
+            return
+        logging.info("{}: Notifying {} of {} new tips".format(
+            datetime.now(), receiver_id, len(notifications)))
+        if ledger.LEDGER_MODE:
+            balance_raw = ledger.get_balance(receiver_id, receiver_account)
         else:
-            users_to_tip[tip_index]['balance'] = str(
-                users_to_tip[tip_index]['balance'])
+            balance_raw = chain.get_balance(receiver_account)
+        balance = "{}.{:02d}".format(*divmod(balance_raw, raw_denominator))
+        with localcontext() as context:
+            # Amounts are summed exactly, whatever precision the caller's context uses
+            context.prec = 28
+            total = sum(notification[3] for notification in notifications)
+        senders = list(
+            dict.fromkeys(
+                "@{}".format(notification[2])
+                for notification in notifications))
 
-        # Send a DM to the receiver
+        if len(notifications) == 1:
+            tip_text = "{} just sent you a {:f} NOLLAR tip!".format(
+                senders[0], total)
+        else:
+            tip_text = "{} just sent you {} tips totalling {:f} NOLLAR!".format(
+                ', '.join(senders), len(notifications), total)
         receiver_tip_text = (
-            "@{} just sent you a {} NOLLAR tip! Reply to this DM with !balance to see your new balance.  If you have not "
-            "registered an account, send a reply with !register to get started, or !help to see a list of "
-            "commands! Learn more about NOS (XNOS) & Nollar at https://nos.cash/"
-            .format(message['sender_screen_name'], message['tip_amount_text'],
-                    users_to_tip[tip_index]['balance']))
-        social.send_dm(users_to_tip[tip_index]['receiver_id'],
-                       receiver_tip_text)
-
-    except Exception as e:
-        logging.info(
-            "{}: ERROR IN RECEIVING NEW TIP - POSSIBLE NEW ACCOUNT NOT REGISTERED WITH DPOW: {}"
-            .format(datetime.now(), e))
+            "{} Your balance is now {} NOLLAR.  If you have not registered an account, send a reply with !register to "
+            "get started, or !help to see a list of commands! Learn more about NOS (XNOS) & Nollar at https://nos.cash/"
+            .format(tip_text, balance))
+        outbox.send(receiver_id, receiver_tip_text,
+                    outbox.PRIORITY_NOTIFICATION, cursor)
 
-    logging.info("{}: tip sent to {} via hash {}".format(
-        datetime.now(), users_to_tip[tip_index]['receiver_screen_name'],
-        message['send_hash']))
+        delivered_call = "DELETE FROM tip_notifications WHERE receiver_id = %s AND id <= %s"
+        cursor.execute(delivered_call, (receiver_id, notifications[-1][0]))
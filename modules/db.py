@@ -1,11 +1,16 @@
 import configparser
 import logging
 import os
+import threading
+import time
+from contextlib import contextmanager
 from datetime import datetime
 from decimal import *
 
 import pymysql
 
+from . import metrics
+
 # Read config and parse constants
 config = configparser.ConfigParser()
 config.read(os.environ['MY_CONF_DIR'] + '/webhooks.ini')
@@ -16,8 +21,200 @@ DB_USER = config.get('webhooks', 'user')
 DB_PW = config.get('webhooks', 'password')
 DB_SCHEMA = config.get('webhooks', 'schema')
 DB_PORT = int(config.get('webhooks', 'port'))
+# Connection pool settings
+DB_POOL_SIZE = int(config.get('webhooks', 'db_pool_size', fallback='5'))
+DB_POOL_TIMEOUT = int(config.get('webhooks', 'db_pool_timeout', fallback='10'))
+DB_POOL_IDLE_TIMEOUT = int(
+    config.get('webhooks', 'db_pool_idle_timeout', fallback='300'))
+DB_POOL_PING_INTERVAL = int(
+    config.get('webhooks', 'db_pool_ping_interval', fallback='30'))
 getcontext().prec = 3
 
+# Idle connections are kept as (connection, last_used) pairs.  The semaphore caps the number of connections open at
+# once, whether idle or checked out.
+_pool_lock = threading.Lock()
+_pool_slots = threading.BoundedSemaphore(DB_POOL_SIZE)
+_pool_idle = []
+_pool_stats = {'connects': 0, 'reuses': 0, 'pings_failed': 0, 'evicted': 0}
+# Idle connections for named locks, kept apart from the pool: a lock holder still needs pool connections for its
+# work, so lock connections must not count against DB_POOL_SIZE.
+_lock_idle = []
+
+
+def _connect():
+    _pool_stats['connects'] += 1
+    return pymysql.connect(
+        host=DB_HOST,
+        user=DB_USER,
+        passwd=DB_PW,
+        port=DB_PORT,
+        db=DB_SCHEMA,
+        use_unicode=True,
+        charset="utf8",
+        autocommit=True)
+
+
+def _discard(db):
+    try:
+        db.close()
+    except Exception:
+        # The server already went away, drop the socket without the QUIT handshake
+        db._force_close()
+
+
+def _reset_pool_after_fork():
+    """
+    A forked child shares the parent's sockets, so it must never talk on them.  Forget the inherited connections
+    without sending QUIT (which would kill the parent's sessions) and start with a fresh pool.
+    """
+    global _pool_lock, _pool_slots, _pool_idle, _lock_idle
+    _pool_lock = threading.Lock()
+    _pool_slots = threading.BoundedSemaphore(DB_POOL_SIZE)
+    _pool_idle = []
+    _lock_idle = []
+    for key in _pool_stats:
+        _pool_stats[key] = 0
+
+
+os.register_at_fork(after_in_child=_reset_pool_after_fork)
+
+
+def _checkout():
+    if not _pool_slots.acquire(timeout=DB_POOL_TIMEOUT):
+        raise pymysql.OperationalError(
+            "No database connection available after {}s (pool size {})".format(
+                DB_POOL_TIMEOUT, DB_POOL_SIZE))
+    try:
+        now = time.monotonic()
+        while True:
+            with _pool_lock:
+                if not _pool_idle:
+                    break
+                db, last_used = _pool_idle.pop()
+            idle_for = now - last_used
+            if idle_for > DB_POOL_IDLE_TIMEOUT:
+                _pool_stats['evicted'] += 1
+                _discard(db)
+                continue
+            if idle_for > DB_POOL_PING_INTERVAL:
+                try:
+                    db.ping(reconnect=False)
+                except Exception:
+                    _pool_stats['pings_failed'] += 1
+                    _discard(db)
+                    continue
+            _pool_stats['reuses'] += 1
+            return db
+        return _connect()
+    except Exception:
+        _pool_slots.release()
+        raise
+
+
+def _checkin(db, healthy=True):
+    try:
+        if healthy and db.open:
+            now = time.monotonic()
+            with _pool_lock:
+                # Evict connections that have sat idle too long, oldest first
+                while _pool_idle and now - _pool_idle[0][1] > DB_POOL_IDLE_TIMEOUT:
+                    _pool_stats['evicted'] += 1
+                    _discard(_pool_idle.pop(0)[0])
+                _pool_idle.append((db, now))
+        else:
+            _discard(db)
+    finally:
+        _pool_slots.release()
+
+
+@contextmanager
+def connection():
+    """
+    Borrow a connection to the bot schema from the pool and return it when done.  Connections that raised a
+    connection-level error are closed instead of being returned.
+    """
+    db = _checkout()
+    healthy = True
+    try:
+        yield db
+    except (pymysql.OperationalError, pymysql.InterfaceError):
+        healthy = False
+        raise
+    except Exception:
+        try:
+            db.rollback()
+        except Exception:
+            healthy = False
+        raise
+    finally:
+        _checkin(db, healthy)
+
+
+@contextmanager
+def transaction():
+    """
+    Run the statements issued on the yielded cursor as one transaction, committed when the block finishes and rolled
+    back if it raises.
+    """
+    with connection() as db:
+        db.begin()
+        yield db.cursor()
+        db.commit()
+
+
+@contextmanager
+def named_lock(names, timeout=DB_POOL_TIMEOUT):
+    """
+    Hold MySQL named locks (GET_LOCK) for the block, shared by every process and host using the schema.  Locks are
+    taken in sorted order so callers locking overlapping sets cannot deadlock.  The locks are held on a connection
+    outside the pool.
+    """
+    with _pool_lock:
+        db, last_used = _lock_idle.pop() if _lock_idle else (None, 0)
+    if db is not None and time.monotonic() - last_used > DB_POOL_PING_INTERVAL:
+        try:
+            db.ping(reconnect=False)
+        except Exception:
+            _pool_stats['pings_failed'] += 1
+            _discard(db)
+            db = None
+    if db is None:
+        db = _connect()
+    db_cursor = db.cursor()
+    held = []
+    healthy = True
+    try:
+        for name in sorted(set(names)):
+            db_cursor.execute("SELECT GET_LOCK(%s, %s)", (name, timeout))
+            if db_cursor.fetchone()[0] != 1:
+                raise pymysql.OperationalError(
+                    "Timed out after {}s waiting for lock {}".format(
+                        timeout, name))
+            held.append(name)
+        yield
+    finally:
+        try:
+            for name in held:
+                db_cursor.execute("SELECT RELEASE_LOCK(%s)", (name))
+        except Exception:
+            # Locks die with their session
+            healthy = False
+        if healthy and db.open:
+            with _pool_lock:
+                _lock_idle.append((db, time.monotonic()))
+        else:
+            _discard(db)
+
+
+def pool_stats():
+    """
+    Return the connection pool counters along with the current number of idle connections.
+    """
+    stats = dict(_pool_stats)
+    stats['idle'] = len(_pool_idle)
+    stats['size'] = DB_POOL_SIZE
+    return stats
+
 
 def check_db_exist():
     db = pymysql.connect(
@@ -59,15 +256,7 @@ def delete_db():
 
 
 def check_table_exists(table_name):
-    db = pymysql.connect(
-        host=DB_HOST,
-        user=DB_USER,
-        passwd=DB_PW,
-        db=DB_SCHEMA,
-        port=DB_PORT,
-        use_unicode=True,
-        charset="utf8")
-    with db:
+    with connection() as db:
         db_cursor = db.cursor()
         stmt = "SHOW TABLES LIKE '{}'".format(table_name)
         db_cursor.execute(stmt)
@@ -75,16 +264,9 @@ def check_table_exists(table_name):
         return result
 
 
+@metrics.timed(metrics.DB_SECONDS, metrics.DB_ERRORS, 'execute_sql')
 def execute_sql(sql):
-    db = pymysql.connect(
-        host=DB_HOST,
-        user=DB_USER,
-        passwd=DB_PW,
-        port=DB_PORT,
-        db=DB_SCHEMA,
-        use_unicode=True,
-        charset="utf8")
-    with db:
+    with connection() as db:
         db_cursor = db.cursor()
         db_cursor.execute(sql)
 
@@ -145,43 +327,73 @@ def create_tables():
             """
         res = execute_sql(sql)
 
+    users_exist = check_table_exists('job_queue')
+    if not users_exist:
+        # create job_queue table, see modules/jobs.py for the state machine
+        sql = """
+        CREATE TABLE IF NOT EXISTS job_queue (
+            id BIGINT AUTO_INCREMENT PRIMARY KEY,
+            kind CHAR(32),
+            payload MEDIUMTEXT,
+            status SMALLINT,
+            attempts INT,
+            available_at DATETIME(6),
+            lease_owner CHAR(64),
+            lease_expires DATETIME(6),
+            last_error TEXT,
+            created_at DATETIME(6),
+            KEY ix_job_queue_ready (status, available_at),
+            KEY ix_job_queue_owner (lease_owner))
+            """
+        res = execute_sql(sql)
+
+    users_exist = check_table_exists('work_cache')
+    if not users_exist:
+        # create work_cache table, holds precomputed work for each account's next block
+        sql = """
+        CREATE TABLE IF NOT EXISTS work_cache (
+            account CHAR(128) PRIMARY KEY,
+            frontier CHAR(64),
+            work CHAR(16))
+            """
+        res = execute_sql(sql)
+
+    users_exist = check_table_exists('account_state')
+    if not users_exist:
+        # create account_state table, tracks the frontier and balance of custodial accounts
+        sql = """
+        CREATE TABLE IF NOT EXISTS account_state (
+            account CHAR(128) PRIMARY KEY,
+            frontier CHAR(64),
+            balance DECIMAL(39, 0),
+            updated_at DATETIME(6))
+            """
+        res = execute_sql(sql)
+
 
+@metrics.timed(metrics.DB_SECONDS, metrics.DB_ERRORS, 'get_db_data')
 def get_db_data(db_call, arguments):
     """
     Retrieve data from DB
     """
-    db = pymysql.connect(
-        host=DB_HOST,
-        user=DB_USER,
-        port=DB_PORT,
-        passwd=DB_PW,
-        db=DB_SCHEMA,
-        use_unicode=True,
-        charset="utf8")
-    with db:
+    with connection() as db:
         db_cursor = db.cursor()
         db_cursor.execute(db_call, arguments)
         db_data = db_cursor.fetchall()
         return db_data
 
 
+@metrics.timed(metrics.DB_SECONDS, metrics.DB_ERRORS, 'set_db_data')
 def set_db_data(db_call, arguments):
     """
-    Enter data into DB
+    Enter data into DB, returns the number of affected rows
     """
-    db = pymysql.connect(
-        host=DB_HOST,
-        user=DB_USER,
-        passwd=DB_PW,
-        port=DB_PORT,
-        db=DB_SCHEMA,
-        use_unicode=True,
-        charset="utf8")
     try:
-        with db:
+        with connection() as db:
             db_cursor = db.cursor()
             db_cursor.execute(db_call, arguments)
             logging.info("{}: record inserted into DB".format(datetime.now()))
+            return db_cursor.rowcount
     except pymysql.ProgrammingError as e:
         logging.info("{}: Exception entering data into database".format(
             datetime.now()))
@@ -189,25 +401,37 @@ def set_db_data(db_call, arguments):
         raise e
 
 
+@metrics.timed(metrics.DB_SECONDS, metrics.DB_ERRORS, 'set_db_data_many')
+def set_db_data_many(db_call, arguments_list):
+    """
+    Enter several rows into DB with one statement
+    """
+    try:
+        with connection() as db:
+            db_cursor = db.cursor()
+            db_cursor.executemany(db_call, arguments_list)
+            logging.info("{}: {} records inserted into DB".format(
+                datetime.now(), len(arguments_list)))
+    except pymysql.ProgrammingError as e:
+        logging.info("{}: Exception entering data into database".format(
+            datetime.now()))
+        logging.info("{}: {}".format(datetime.now(), e))
+        raise e
+
+
+@metrics.timed(metrics.DB_SECONDS, metrics.DB_ERRORS, 'set_db_data_tip')
 def set_db_data_tip(message, users_to_tip, t_index):
     """
     Special case to update DB information to include tip data
     """
     logging.info("{}: inserting tip into DB.".format(datetime.now()))
-    db = pymysql.connect(
-        host=DB_HOST,
-        user=DB_USER,
-        passwd=DB_PW,
-        port=DB_PORT,
-        db=DB_SCHEMA,
-        use_unicode=True,
-        charset="utf8")
     try:
-        with db:
+        with connection() as db:
             db_cursor = db.cursor()
             message_text = ' '.join(message['text']).replace('!', '').replace(
                 '@', '')
-            sql = "INSERT INTO tip_list VALUES ({dm_id}, {tx_id}, 2, {sender_id}, {receiver_id}, '{dm_text}', {amount})".format(
+            # A retried tip job records each receiver once, see uq_tip_list_dm_receiver
+            sql = "INSERT IGNORE INTO tip_list (dm_id, tx_id, processed, sender_id, receiver_id, dm_text, amount) VALUES ({dm_id}, {tx_id}, 2, {sender_id}, {receiver_id}, '{dm_text}', {amount})".format(
                 dm_id=message['id'],
                 tx_id=message['tip_id'],
                 sender_id=message['sender_id'],
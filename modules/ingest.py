@@ -0,0 +1,217 @@
+import configparser
+import functools
+import logging
+import os
+import re
+from datetime import datetime
+from http import HTTPStatus
+
+from . import metrics, orchestration, social
+
+# Read config and parse constants
+config = configparser.ConfigParser()
+config.read(os.environ['MY_CONF_DIR'] + '/webhooks.ini')
+logging.basicConfig(handlers=[logging.StreamHandler()], level=logging.INFO)
+
+# IDs
+BOT_ID_TELEGRAM = config.get('webhooks', 'bot_id_telegram')
+BOTNAME = "@{}".format(BOT_ID_TELEGRAM).lower()
+
+
+# Group updates that change membership, and so always take the full path
+MEMBERSHIP_EVENTS = ('new_chat_member', 'left_chat_member', 'group_chat_created')
+
+
+def classify(request_json):
+    """
+    Cheap first look at a Telegram update, without parsing or DB access: 'ignore' for updates the bot never acts on
+    (edits, channel posts, DMs without text), 'member' for group messages that only tell us the sender is a member
+    (chatter, stickers, photos, mentions of the bot without a command), 'process' for everything else.
+    """
+    message = request_json.get('message')
+    if message is None:
+        return 'ignore'
+    chat_type = message.get('chat', {}).get('type')
+    if chat_type == 'private':
+        return 'process' if 'text' in message else 'ignore'
+    if chat_type not in ('group', 'supergroup'):
+        return 'ignore'
+    text = message.get('text')
+    if text is None:
+        for event in MEMBERSHIP_EVENTS:
+            if event in message:
+                return 'process'
+        return 'member'
+    text = text.lower()
+    if BOTNAME in text and '!tip' in text:
+        return 'process'
+    return 'member'
+
+
+@functools.lru_cache(maxsize=4096)
+def _chat_name(title):
+    return re.sub(r'\W+', ' ', title)
+
+
+@metrics.WEBHOOK_SECONDS.labels('refresh_member').time()
+def refresh_member(request_json):
+    """
+    Record the sender of a group message as a chat member.  Goes through the membership cache, so known members cost
+    no DB access, and new ones are queued for a batched write.  Senders without a username cannot be tipped and are
+    skipped.
+    """
+    message = request_json['message']
+    sender = message.get('from', {})
+    if sender.get('username') is None:
+        return
+    chat = message['chat']
+    social.check_telegram_member(chat['id'], _chat_name(chat.get('title', '')),
+                                 sender['id'], sender['username'])
+
+
+@metrics.WEBHOOK_SECONDS.labels('handle_update').time()
+def handle_update(request_json):
+    """
+    Parse a Telegram update, record chat membership and queue any command it carries.  Shared by the Flask webhook,
+    the ASGI ingestion app and the long-polling loop.
+    """
+    response = 'ok'
+    try:
+        message = {
+            # id:                     ID of the received message - Error logged through None value
+            # text:                   A list containing the text of the received message, split by ' '
+            # sender_account:         Nano account of sender - Error logged through None value
+            # sender_register:        Registration status with Tip Bot of sender account
+            # sender_balance_raw:     Amount of Nano in sender's account, stored in raw
+            # sender_balance:         Amount of Nano in sender's account, stored in Nano
+
+            # action_index:           Location of key action value *(currently !tip only)
+            # action:                 Action found in the received message - Error logged through None value
+
+            # starting_point:         Location of action sent via message (currently !tip only)
+
+            # tip_amount:             Value of tip to be sent to receiver(s) - Error logged through -1
+            # tip_amount_text:        Value of the tip stored in a string to prevent formatting issues
+            # total_tip_amount:       Equal to the tip amount * number of users to tip
+            # tip_id:                 ID of the tip, used to prevent double sending of tips.  Comprised of
+            #                         message['id'] + index of user in users_to_tip
+            # send_hash:              Hash of the send RPC transaction
+        }
+
+        users_to_tip = [
+            # List including dictionaries for each user to send a tip.  Each index will include
+            # the below parameters
+            #    receiver_account:       Nano account of receiver
+            #    receiver_register:      Registration status with Tip Bot of receiver account
+        ]
+
+        logging.debug("request_json: %s", request_json)
+
+        if 'message' in request_json.keys():
+            if request_json['message']['chat']['type'] == 'private':
+                logging.info(
+                    "Direct message received in Telegram.  Processing.")
+                message['sender_id'] = request_json['message']['from']['id']
+
+                message['sender_screen_name'] = request_json['message'][
+                    'from']['username']
+
+                message['dm_id'] = request_json['update_id']
+                message['text'] = request_json['message']['text']
+                message['dm_array'] = message['text'].split(" ")
+                message['dm_action'] = message['dm_array'][0].lower(
+                )  # TODO: use regex!
+
+                logging.info("{}: action identified: {}".format(
+                    datetime.now(), message['dm_action']))
+
+                response = orchestration.parse_action(message)
+
+            elif (request_json['message']['chat']['type'] == 'supergroup'
+                  or request_json['message']['chat']['type'] == 'group'):
+                if 'text' in request_json['message']:
+                    message['sender_id'] = request_json['message']['from'][
+                        'id']
+
+                    message['sender_screen_name'] = request_json['message'][
+                        'from']['username']
+
+                    message['id'] = request_json['message']['message_id']
+                    message['chat_id'] = request_json['message']['chat']['id']
+                    chat_name = re.sub(
+                        '\W+', ' ', request_json['message']['chat']['title'])
+                    message['chat_name'] = chat_name
+                    social.check_telegram_member(
+                        message['chat_id'], message['chat_name'],
+                        message['sender_id'], message['sender_screen_name'])
+
+                    message['raw_text'] = request_json['message']['text']
+                    message['entities'] = request_json['message'].get(
+                        'entities', [])
+                    message['text'] = request_json['message']['text']
+                    message['text'] = message['text'].replace('\n', ' ')
+                    message['text'] = message['text'].lower()
+                    message['text'] = message['text'].split(' ')
+
+                    message = social.check_message_action(message)
+                    if message['action'] is None:
+                        logging.debug(
+                            "{}: Mention of nano tip bot without a !tip command."
+                            .format(datetime.now()))
+                        return '', HTTPStatus.OK
+
+                    message = social.validate_tip_amount(message)
+                    if message['tip_amount'] <= 0:
+                        return '', HTTPStatus.OK
+
+                    if message['action'] != -1 and str(
+                            message['sender_id']) != str(BOT_ID_TELEGRAM):
+                        response = orchestration.submit_process(
+                            'tip', message, users_to_tip)
+
+                elif 'new_chat_member' in request_json['message']:
+                    logging.info("new member joined chat, adding to DB")
+                    chat_id = request_json['message']['chat']['id']
+                    chat_name = request_json['message']['chat']['title']
+                    member_id = request_json['message']['new_chat_member'][
+                        'id']
+                    member_name = request_json['message']['new_chat_member'][
+                        'username']
+
+                    social.add_telegram_member(chat_id, chat_name, member_id,
+                                               member_name)
+
+                elif 'left_chat_member' in request_json['message']:
+                    chat_id = request_json['message']['chat']['id']
+                    chat_name = request_json['message']['chat']['title']
+                    member_id = request_json['message']['left_chat_member'][
+                        'id']
+                    member_name = request_json['message']['left_chat_member'][
+                        'username']
+
+                    logging.info(
+                        "member {}-{} left chat {}-{}, removing from DB.".
+                        format(member_id, member_name, chat_id, chat_name))
+
+                    social.remove_telegram_member(chat_id, member_id)
+
+                elif 'group_chat_created' in request_json['message']:
+                    chat_id = request_json['message']['chat']['id']
+                    chat_name = request_json['message']['chat']['title']
+                    member_id = request_json['message']['from']['id']
+                    member_name = request_json['message']['from']['username']
+
+                    logging.info(
+                        "member {} created chat {}, inserting creator into DB."
+                        .format(member_name, chat_name))
+
+                    social.add_telegram_member(chat_id, chat_name, member_id,
+                                               member_name)
+
+            else:
+                logging.debug("Unhandled update: %s", request_json)
+
+    except Exception as e:
+        logging.error('Fatal error: {} in request: {}'.format(e, request_json))
+    finally:
+        return response
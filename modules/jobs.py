@@ -0,0 +1,217 @@
+import configparser
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from datetime import datetime
+from decimal import Decimal
+
+from . import db, metrics, workers
+
+# Read config and parse constants
+config = configparser.ConfigParser()
+config.read(os.environ['MY_CONF_DIR'] + '/webhooks.ini')
+logging.basicConfig(handlers=[logging.StreamHandler()], level=logging.INFO)
+
+# Job queue settings
+JOB_LEASE_SECONDS = int(
+    config.get('webhooks', 'job_lease_seconds', fallback='60'))
+JOB_LEASE_BATCH = int(config.get('webhooks', 'job_lease_batch', fallback='10'))
+JOB_POLL_INTERVAL = float(
+    config.get('webhooks', 'job_poll_interval', fallback='0.5'))
+JOB_MAX_ATTEMPTS = int(
+    config.get('webhooks', 'job_max_attempts', fallback='5'))
+JOB_BACKOFF_BASE = int(
+    config.get('webhooks', 'job_backoff_base', fallback='2'))
+JOB_BACKOFF_MAX = int(
+    config.get('webhooks', 'job_backoff_max', fallback='300'))
+# A running job extends its lease this often, so a job that outlives JOB_LEASE_SECONDS is not leased to another
+# consumer while it runs
+JOB_HEARTBEAT_INTERVAL = JOB_LEASE_SECONDS / 3
+
+# Job states
+JOB_PENDING = 0
+JOB_LEASED = 1
+JOB_DEAD = 3
+
+# Processes a consumer can run, keyed by job kind.  Set by consume() before the workers fork.
+_processes = {}
+# The job the current thread is running
+_running = threading.local()
+
+
+def _encode(value):
+    if isinstance(value, Decimal):
+        return {'__decimal__': str(value)}
+    raise TypeError("Cannot queue value of type {}".format(type(value)))
+
+
+def _decode(value):
+    if len(value) == 1 and '__decimal__' in value:
+        return Decimal(value['__decimal__'])
+    return value
+
+
+def enqueue(kind, *args, delay=0):
+    """
+    Persist a job that will call the process registered for kind with args.  Payloads are stored as JSON, Decimals
+    survive the round trip.
+    """
+    enqueue_call = (
+        "INSERT INTO job_queue (kind, payload, status, attempts, available_at, created_at) "
+        "VALUES (%s, %s, %s, 0, NOW(6) + INTERVAL %s SECOND, NOW(6))")
+    arguments = (kind, json.dumps(list(args), default=_encode), JOB_PENDING,
+                 int(delay))
+    db.set_db_data(enqueue_call, arguments)
+
+
+def lease(count):
+    """
+    Claim up to count jobs that are due, or whose previous lease expired, for JOB_LEASE_SECONDS.  Safe to run from
+    any number of consumers on any number of hosts.
+    """
+    owner = "{}-{}-{}".format(socket.gethostname()[:32], os.getpid(),
+                              uuid.uuid4().hex[:12])
+    lease_call = (
+        "UPDATE job_queue SET status = %s, lease_owner = %s, lease_expires = NOW(6) + INTERVAL %s SECOND, "
+        "attempts = attempts + 1 "
+        "WHERE (status = %s AND available_at <= NOW(6)) OR (status = %s AND lease_expires < NOW(6)) "
+        "ORDER BY id LIMIT %s")
+    arguments = (JOB_LEASED, owner, JOB_LEASE_SECONDS, JOB_PENDING,
+                 JOB_LEASED, count)
+    db.set_db_data(lease_call, arguments)
+
+    # Time queued so far is measured on the DB's clock, which created_at was written with
+    leased_call = (
+        "SELECT id, kind, payload, attempts, lease_owner, TIMESTAMPDIFF(MICROSECOND, created_at, NOW(6)) "
+        "FROM job_queue WHERE lease_owner = %s AND status = %s ORDER BY id")
+    rows = db.get_db_data(leased_call, (owner, JOB_LEASED))
+    leased_at = time.monotonic()
+    return [{
+        'id': row[0],
+        'kind': row[1],
+        'args': json.loads(row[2], object_hook=_decode),
+        'attempts': row[3],
+        'lease_owner': row[4],
+        'queued_seconds': row[5] / 1e6,
+        'leased_at': leased_at
+    } for row in rows]
+
+
+def _heartbeat(job, done):
+    """
+    Extend the job's lease every JOB_HEARTBEAT_INTERVAL seconds until done is set.
+    """
+    extend_call = "UPDATE job_queue SET lease_expires = NOW(6) + INTERVAL %s SECOND WHERE id = %s AND lease_owner = %s"
+    while not done.wait(JOB_HEARTBEAT_INTERVAL):
+        try:
+            db.set_db_data(extend_call,
+                           (JOB_LEASE_SECONDS, job['id'], job['lease_owner']))
+        except Exception as e:
+            logging.info("{}: job {} lease not extended: {}".format(
+                datetime.now(), job['id'], e))
+
+
+def complete(job):
+    """
+    Remove a finished job, provided our lease on it has not been taken over.
+    """
+    complete_call = "DELETE FROM job_queue WHERE id = %s AND lease_owner = %s"
+    db.set_db_data(complete_call, (job['id'], job['lease_owner']))
+
+
+def release(job):
+    """
+    Give a leased job back without counting the attempt, e.g. when the local worker pool is full.
+    """
+    release_call = "UPDATE job_queue SET status = %s, lease_owner = NULL, attempts = attempts - 1 WHERE id = %s AND lease_owner = %s"
+    db.set_db_data(release_call, (JOB_PENDING, job['id'], job['lease_owner']))
+
+
+def fail(job, error):
+    """
+    Schedule a retry with exponential backoff, or move the job to the dead-letter state after JOB_MAX_ATTEMPTS.
+    """
+    if job['attempts'] >= JOB_MAX_ATTEMPTS:
+        logging.info("{}: job {} ({}) dead after {} attempts: {}".format(
+            datetime.now(), job['id'], job['kind'], job['attempts'], error))
+        fail_call = "UPDATE job_queue SET status = %s, lease_owner = NULL, last_error = %s WHERE id = %s AND lease_owner = %s"
+        arguments = (JOB_DEAD, str(error), job['id'], job['lease_owner'])
+    else:
+        backoff = min(JOB_BACKOFF_BASE**job['attempts'], JOB_BACKOFF_MAX)
+        logging.info("{}: job {} ({}) failed, retrying in {}s: {}".format(
+            datetime.now(), job['id'], job['kind'], backoff, error))
+        fail_call = (
+            "UPDATE job_queue SET status = %s, lease_owner = NULL, last_error = %s, "
+            "available_at = NOW(6) + INTERVAL %s SECOND WHERE id = %s AND lease_owner = %s"
+        )
+        arguments = (JOB_PENDING, str(error), backoff, job['id'],
+                     job['lease_owner'])
+    db.set_db_data(fail_call, arguments)
+
+
+def requeue_dead():
+    """
+    Move every dead-lettered job back to pending with a fresh attempt count.
+    """
+    requeue_call = "UPDATE job_queue SET status = %s, attempts = 0, available_at = NOW(6) WHERE status = %s"
+    db.set_db_data(requeue_call, (JOB_PENDING, JOB_DEAD))
+
+
+def run(job):
+    """
+    Execute a leased job in a worker and record the outcome.
+    """
+    if job['attempts'] > JOB_MAX_ATTEMPTS:
+        # The lease expired on the final attempt, most likely because the worker died mid-job
+        fail(job, 'lease expired on the final attempt')
+        return
+    start = time.perf_counter()
+    _running.job = job
+    done = threading.Event()
+    threading.Thread(target=_heartbeat, args=(job, done), daemon=True).start()
+    try:
+        _processes[job['kind']](*job['args'])
+    except Exception as e:
+        metrics.JOB_SECONDS.labels(job['kind'],
+                                   'failed').observe(time.perf_counter() -
+                                                     start)
+        fail(job, e)
+        return
+    finally:
+        done.set()
+    metrics.JOB_SECONDS.labels(job['kind'],
+                               'done').observe(time.perf_counter() - start)
+    complete(job)
+    metrics.JOB_LATENCY.labels(job['kind']).observe(
+        job['queued_seconds'] + time.monotonic() - job['leased_at'])
+
+
+def first_attempt():
+    """
+    Whether the job running in this thread is on its first attempt, so a process can tell the user about a delay once
+    rather than on every retry.  True outside of jobs.
+    """
+    job = getattr(_running, 'job', None)
+    return job is None or job['attempts'] <= 1
+
+
+def consume(processes):
+    """
+    Lease due jobs and hand them to the worker pool, only as many as idle workers can start at once, so no lease
+    runs down while its job waits in the queue.
+    """
+    _processes.update(processes)
+    workers.start()
+    logging.info("{}: consuming jobs".format(datetime.now()))
+    while True:
+        free = workers.idle()
+        leased = lease(min(free, JOB_LEASE_BATCH)) if free > 0 else []
+        for job in leased:
+            if not workers.submit(run, job):
+                release(job)
+        if not leased:
+            time.sleep(JOB_POLL_INTERVAL)
@@ -0,0 +1,51 @@
+import configparser
+import hashlib
+import logging
+import os
+import threading
+from contextlib import contextmanager
+
+from . import chain, db
+
+# Read config and parse constants
+config = configparser.ConfigParser()
+config.read(os.environ['MY_CONF_DIR'] + '/webhooks.ini')
+logging.basicConfig(handlers=[logging.StreamHandler()], level=logging.INFO)
+
+# Seconds an operation waits for its account's lane before failing (and its job being retried)
+ACCOUNT_LANE_TIMEOUT = int(
+    config.get('webhooks', 'account_lane_timeout', fallback='60'))
+
+# Accounts whose lane the current thread holds, so nested operations on the same account do not wait for themselves
+_held = threading.local()
+
+
+def _lane_name(account):
+    # MySQL lock names are limited to 64 characters, an account alone can take all of them
+    return 'lane-{}'.format(hashlib.sha1(account.encode()).hexdigest())
+
+
+@contextmanager
+def account_lane(account):
+    """
+    Run the block as the only chain-mutating operation on a custodial account: sends and receives on one account
+    happen one after another, in every thread, process and host sharing the DB, while different accounts run in
+    parallel.  The lane is a MySQL named lock.  Re-entering the lane of an account the thread already holds is a
+    no-op.
+
+    Entering the lane drops this process's copy of the account's chain state, as another process may have moved the
+    chain while this one waited; reads inside the block see what the previous holder stored.
+    """
+    held = getattr(_held, 'accounts', None)
+    if held is None:
+        held = _held.accounts = set()
+    if account in held:
+        yield
+        return
+    with db.named_lock([_lane_name(account)], ACCOUNT_LANE_TIMEOUT):
+        held.add(account)
+        try:
+            chain.forget(account)
+            yield
+        finally:
+            held.discard(account)
@@ -0,0 +1,379 @@
+import configparser
+import logging
+import os
+import uuid
+from datetime import datetime
+
+from . import chain, currency, db, lanes, node
+
+# Read config and parse constants
+config = configparser.ConfigParser()
+config.read(os.environ['MY_CONF_DIR'] + '/webhooks.ini')
+logging.basicConfig(handlers=[logging.StreamHandler()], level=logging.INFO)
+
+# Constants
+WALLET = config.get('webhooks', 'wallet')
+# Keep balances in MySQL and move funds on chain only for deposits, withdrawals and settlement
+LEDGER_MODE = config.getboolean('webhooks', 'internal_ledger', fallback=False)
+# Differences between an account's ledger and chain balance below this many raw are left for a later settlement
+LEDGER_SETTLE_MIN = int(
+    config.get('webhooks', 'ledger_settle_min', fallback='100'))
+LEDGER_LOCK_TIMEOUT = int(
+    config.get('webhooks', 'ledger_lock_timeout', fallback='30'))
+# Seconds a debited withdrawal may stay unsent before reconcile() reports it as a failure rather than in flight
+LEDGER_UNPAID_GRACE = int(
+    config.get('webhooks', 'ledger_unpaid_grace', fallback='600'))
+
+# Counterparty of every entry that moves funds in or out of custody: deposits, withdrawals and opening balances
+EXTERNAL_USER = 0
+SETTLE_LOCK = 'ledger-settle'
+
+# Connect to node
+rpc = node.rpc
+
+
+class LedgerError(Exception):
+    pass
+
+
+class InsufficientBalance(LedgerError):
+    pass
+
+
+def _user_lock(user_id):
+    return 'ledger-user-{}'.format(user_id)
+
+
+def _entries(cursor, transfer_id, kind, debit_user, credit_user, amount):
+    """
+    Write both sides of a transfer.  Returns False if the transfer was already recorded, so retried jobs apply it once.
+    """
+    entry_call = (
+        "INSERT IGNORE INTO ledger_entries (transfer_id, kind, user_id, amount, created_at) "
+        "VALUES (%s, %s, %s, %s, NOW(6)), (%s, %s, %s, %s, NOW(6))")
+    cursor.execute(entry_call, (transfer_id, kind, debit_user, -amount,
+                                transfer_id, kind, credit_user, amount))
+    return cursor.rowcount > 0
+
+
+def _apply(cursor, changes):
+    """
+    Add each change to the user's balance, in user_id order to keep lock order stable.  A change that would take a
+    balance below zero aborts the transaction.
+    """
+    for user_id in sorted(changes):
+        if user_id == EXTERNAL_USER or changes[user_id] == 0:
+            continue
+        debit_call = "UPDATE ledger_balances SET balance = balance + %s, updated_at = NOW(6) WHERE user_id = %s AND balance + %s >= 0"
+        cursor.execute(debit_call, (changes[user_id], user_id,
+                                    changes[user_id]))
+        if cursor.rowcount == 0:
+            raise InsufficientBalance(
+                "Insufficient ledger balance for user {}".format(user_id))
+
+
+def sync_account(user_id, account):
+    """
+    Compare the account's balance on the node with the chain balance the ledger accounts for.  Anything more is a
+    deposit and is credited; an account seen for the first time is opened with its current balance.
+    """
+    with db.named_lock([_user_lock(user_id)], LEDGER_LOCK_TIMEOUT):
+        frontier, chain_balance = chain.sync(account)
+        chain_balance = int(chain_balance)
+        with db.transaction() as cursor:
+            cursor.execute(
+                "SELECT chain_balance FROM ledger_balances WHERE user_id = %s FOR UPDATE",
+                (user_id))
+            row = cursor.fetchone()
+            if row is None:
+                _entries(cursor, 'open-{}'.format(user_id), 'open',
+                         EXTERNAL_USER, user_id, chain_balance)
+                open_call = (
+                    "INSERT INTO ledger_balances (user_id, account, balance, chain_balance, updated_at) "
+                    "VALUES (%s, %s, %s, %s, NOW(6))")
+                cursor.execute(open_call, (user_id, account, chain_balance,
+                                           chain_balance))
+                logging.info(
+                    "{}: opened ledger for user {} with {} raw".format(
+                        datetime.now(), user_id, chain_balance))
+                return
+            deposit = chain_balance - int(row[0])
+            if deposit <= 0:
+                # Nothing new, or a settlement into the account is not received yet
+                return
+            _entries(cursor, 'deposit-{}'.format(frontier), 'deposit',
+                     EXTERNAL_USER, user_id, deposit)
+            deposit_call = "UPDATE ledger_balances SET balance = balance + %s, chain_balance = %s, updated_at = NOW(6) WHERE user_id = %s"
+            cursor.execute(deposit_call, (deposit, chain_balance, user_id))
+    logging.info("{}: credited deposit of {} raw to user {}".format(
+        datetime.now(), deposit, user_id))
+
+
+def credit_deposits(accounts):
+    """
+    Credit whatever was just received on custodial accounts to their owners.
+    """
+    if not accounts:
+        return
+    users_call = "SELECT user_id, account FROM users WHERE account IN ({})".format(
+        ', '.join(['%s'] * len(accounts)))
+    for user_id, account in db.get_db_data(users_call, list(accounts)):
+        sync_account(user_id, account)
+
+
+def sync_drifted():
+    """
+    Credit deposits that never passed through receive_pending_accounts, e.g. blocks the node wallet received on its
+    own: every account holding more on the node than the chain balance the ledger accounts for is synced.  Returns
+    the synced accounts.
+    """
+    node_balances = rpc.wallet_balances(wallet="{}".format(WALLET))
+    balances_call = "SELECT user_id, account, chain_balance FROM ledger_balances"
+    drifted = [(user_id, account)
+               for user_id, account, chain_balance in db.get_db_data(
+                   balances_call, ())
+               if int(node_balances.get(account, {'balance': 0})['balance']) >
+               int(chain_balance)]
+    for user_id, account in drifted:
+        sync_account(user_id, account)
+    return [account for user_id, account in drifted]
+
+
+def get_balance(user_id, account):
+    """
+    Return the user's ledger balance in raw, opening their ledger from the chain on first use.
+    """
+    balance_call = "SELECT balance FROM ledger_balances WHERE user_id = %s"
+    balance_data = db.get_db_data(balance_call, (user_id))
+    if not balance_data:
+        currency.receive_pending(account)
+        sync_account(user_id, account)
+        balance_data = db.get_db_data(balance_call, (user_id))
+    return int(balance_data[0][0])
+
+
+def transfer_tips(message, users_to_tip):
+    """
+    Move the tip from the sender to every receiver in one transaction, without touching the chain.  Tips recorded by
+    an earlier attempt of the same job are skipped.  Returns the receivers that were credited.
+    """
+    for receiver in users_to_tip:
+        get_balance(receiver['receiver_id'], receiver['receiver_account'])
+    amount = int(message['tip_amount_raw'])
+    credited = []
+    changes = {}
+    with db.transaction() as cursor:
+        for receiver in users_to_tip:
+            receiver_id = int(receiver['receiver_id'])
+            if _entries(cursor, 'tip-{}'.format(receiver['tip_id']), 'tip',
+                        int(message['sender_id']), receiver_id, amount):
+                changes[int(message['sender_id'])] = changes.get(
+                    int(message['sender_id']), 0) - amount
+                changes[receiver_id] = changes.get(receiver_id, 0) + amount
+                credited.append(receiver)
+        _apply(cursor, changes)
+    logging.info("{}: ledger tips from {} to {} receivers".format(
+        datetime.now(), message['sender_id'], len(credited)))
+    return credited
+
+
+def _send(source, destination, amount, send_id):
+    with lanes.account_lane(source):
+        work = currency.get_pow(source)
+        try:
+            if work == '':
+                send_hash = rpc.send(
+                    wallet="{}".format(WALLET),
+                    source="{}".format(source),
+                    destination="{}".format(destination),
+                    amount=amount,
+                    id=send_id)
+            else:
+                send_hash = rpc.send(
+                    wallet="{}".format(WALLET),
+                    source="{}".format(source),
+                    destination="{}".format(destination),
+                    amount=amount,
+                    work=work,
+                    id=send_id)
+        except Exception:
+            chain.invalidate(source)
+            raise
+        chain.record_send(source, send_hash, amount)
+        currency.precompute_work(source, send_hash)
+        return send_hash
+
+
+def _move(move_id, source_user, source, destination_user, destination,
+          amount):
+    """
+    Publish a send between accounts and move the chain balances the ledger accounts for.  Idempotent on move_id: the
+    node returns the same block for a repeated id and the chain balances are moved once.
+    """
+    locks = [_user_lock(source_user)]
+    if destination_user is not None:
+        locks.append(_user_lock(destination_user))
+    with db.named_lock(locks, LEDGER_LOCK_TIMEOUT):
+        send_hash = _send(source, destination, amount, move_id)
+        with db.transaction() as cursor:
+            move_call = (
+                "INSERT IGNORE INTO ledger_moves (id, hash, source_user, destination_user, amount, created_at) "
+                "VALUES (%s, %s, %s, %s, %s, NOW(6))")
+            cursor.execute(move_call, (move_id, send_hash, source_user,
+                                       destination_user, amount))
+            if cursor.rowcount:
+                chain_balance_call = "UPDATE ledger_balances SET chain_balance = chain_balance + %s WHERE user_id = %s"
+                cursor.execute(chain_balance_call, (-amount, source_user))
+                if destination_user is not None:
+                    cursor.execute(chain_balance_call,
+                                   (amount, destination_user))
+    return send_hash
+
+
+def settle(user_ids=None):
+    """
+    Net settlement: send funds from accounts holding more on chain than their owners' ledger balance to accounts
+    holding less, largest differences first.  With user_ids, only those users' shortfalls are covered.  Returns the
+    number of sends.  Deposits the ledger missed are credited first.
+    """
+    synced = sync_drifted()
+    if synced:
+        logging.info("{}: credited missed deposits on {}".format(
+            datetime.now(), synced))
+    with db.named_lock([SETTLE_LOCK], LEDGER_LOCK_TIMEOUT):
+        balances_call = "SELECT user_id, account, balance, chain_balance FROM ledger_balances"
+        rows = [(row[0], row[1], int(row[2]), int(row[3]))
+                for row in db.get_db_data(balances_call, ())]
+        surplus = sorted([[row[3] - row[2], row[0], row[1]] for row in rows
+                          if row[3] - row[2] >= LEDGER_SETTLE_MIN],
+                         reverse=True)
+        if user_ids is None:
+            shortfall = [[row[2] - row[3], row[0], row[1]] for row in rows
+                         if row[2] - row[3] >= LEDGER_SETTLE_MIN]
+        else:
+            shortfall = [[row[2] - row[3], row[0], row[1]] for row in rows
+                         if row[2] > row[3] and row[0] in user_ids]
+        shortfall.sort(reverse=True)
+        sends = 0
+        destinations = []
+        for needed in shortfall:
+            while needed[0] > 0 and surplus:
+                available = surplus[0]
+                amount = min(needed[0], available[0])
+                try:
+                    _move('settle-{}'.format(uuid.uuid4().hex), available[1],
+                          available[2], needed[1], needed[2], amount)
+                except Exception as e:
+                    logging.info(
+                        "{}: settlement send from {} failed: {}".format(
+                            datetime.now(), available[2], e))
+                    surplus.pop(0)
+                    continue
+                sends += 1
+                needed[0] -= amount
+                available[0] -= amount
+                if available[0] < LEDGER_SETTLE_MIN:
+                    surplus.pop(0)
+            destinations.append(needed[2])
+        if destinations:
+            # Received under the settle lock so the next settlement sees the funds on chain
+            currency.receive_pending_accounts(destinations)
+    logging.info("{}: settlement sent {} blocks".format(
+        datetime.now(), sends))
+    return sends
+
+
+def withdraw(user_id, account, destination, amount, withdraw_id):
+    """
+    Debit the ledger and send amount raw to an external account, first pulling funds from other custodial accounts if
+    the user's own account holds less on chain.  Returns the send hash.
+    """
+    with db.transaction() as cursor:
+        if _entries(cursor, withdraw_id, 'withdraw', user_id, EXTERNAL_USER,
+                    amount):
+            _apply(cursor, {user_id: -amount})
+
+    # Settlements and withdrawals are serialised so the funds pulled for this withdrawal stay put until it is sent
+    with db.named_lock([SETTLE_LOCK], LEDGER_LOCK_TIMEOUT):
+        chain_balance_call = "SELECT chain_balance FROM ledger_balances WHERE user_id = %s"
+        chain_balance = int(
+            db.get_db_data(chain_balance_call, (user_id))[0][0])
+        if chain_balance < amount:
+            _cover(user_id, account, amount - chain_balance)
+        return _move(withdraw_id, user_id, account, None, destination, amount)
+
+
+def _cover(user_id, account, amount):
+    balances_call = "SELECT user_id, account, balance, chain_balance FROM ledger_balances WHERE chain_balance > balance AND user_id != %s ORDER BY chain_balance - balance DESC"
+    for source_user, source, balance, chain_balance in db.get_db_data(
+            balances_call, (user_id)):
+        if amount <= 0:
+            break
+        pulled = min(amount, int(chain_balance) - int(balance))
+        _move('settle-{}'.format(uuid.uuid4().hex), source_user, source,
+              user_id, account, pulled)
+        amount -= pulled
+    if amount > 0:
+        raise LedgerError(
+            "Custodial accounts are {} raw short of covering a withdrawal".
+            format(amount))
+    currency.receive_pending_accounts([account])
+
+
+def reconcile():
+    """
+    Check the ledger against itself and the node: every transfer nets to zero, every balance equals the sum of its
+    entries, the chain balances the ledger accounts for match the node, and custody covers what users are owed.
+    Returns a report; report['ok'] is False if the ledger is inconsistent, an account's chain balance drifted from the
+    node (a deposit the ledger missed, until settle() syncs it), a withdrawal stayed unsent for LEDGER_UNPAID_GRACE
+    seconds, or custody falls short.
+    """
+    report = {}
+    report['entries_sum'] = int(
+        db.get_db_data("SELECT COALESCE(SUM(amount), 0) FROM ledger_entries",
+                       ())[0][0])
+    mismatch_call = (
+        "SELECT b.user_id, b.balance, COALESCE(SUM(e.amount), 0) FROM ledger_balances b "
+        "LEFT JOIN ledger_entries e ON e.user_id = b.user_id GROUP BY b.user_id, b.balance "
+        "HAVING b.balance != COALESCE(SUM(e.amount), 0)")
+    report['balance_mismatches'] = [(row[0], int(row[1]), int(row[2]))
+                                    for row in db.get_db_data(
+                                        mismatch_call, ())]
+
+    rows = db.get_db_data(
+        "SELECT account, balance, chain_balance FROM ledger_balances", ())
+    node_balances = rpc.wallet_balances(wallet="{}".format(WALLET))
+    report['ledger_total'] = sum(int(row[1]) for row in rows)
+    report['chain_total'] = sum(int(row[2]) for row in rows)
+    report['node_balance_total'] = 0
+    report['node_pending_total'] = 0
+    report['chain_drift'] = []
+    for account, balance, chain_balance in rows:
+        node = node_balances.get(account, {'balance': 0, 'pending': 0})
+        report['node_balance_total'] += int(node['balance'])
+        report['node_pending_total'] += int(node['pending'])
+        # Funds sent to the account but not received yet are not drift
+        if int(node['balance']) != int(chain_balance) and int(
+                node['balance']) + int(node['pending']) != int(chain_balance):
+            report['chain_drift'].append((account, int(chain_balance),
+                                          int(node['balance'])))
+    # Debited but not sent yet: in flight, or a withdrawal job that gave up
+    unpaid_call = (
+        "SELECT e.transfer_id, e.user_id, -e.amount, e.created_at < NOW(6) - INTERVAL %s SECOND "
+        "FROM ledger_entries e WHERE e.kind = 'withdraw' "
+        "AND e.user_id != %s AND NOT EXISTS (SELECT 1 FROM ledger_moves m WHERE m.id = e.transfer_id)"
+    )
+    unpaid = db.get_db_data(unpaid_call, (LEDGER_UNPAID_GRACE, EXTERNAL_USER))
+    report['unpaid_withdrawals'] = [(row[0], row[1], int(row[2]))
+                                    for row in unpaid]
+    report['overdue_withdrawals'] = [(row[0], row[1], int(row[2]))
+                                     for row in unpaid if row[3]]
+    # Uncredited deposits and settlements in flight show up as pending, neither is owed to anyone yet
+    report['shortfall'] = report['ledger_total'] - (
+        report['node_balance_total'] + report['node_pending_total'])
+    report['ok'] = (report['entries_sum'] == 0
+                    and not report['balance_mismatches']
+                    and not report['chain_drift']
+                    and not report['overdue_withdrawals']
+                    and report['shortfall'] <= 0)
+    return report
@@ -0,0 +1,59 @@
+import configparser
+import os
+import re
+
+# Read config and parse constants
+config = configparser.ConfigParser()
+config.read(os.environ['MY_CONF_DIR'] + '/webhooks.ini')
+
+BOT_ID_TELEGRAM = config.get('webhooks', 'bot_id_telegram')
+
+TIP_COMMAND = re.compile(r'(?<!\S)!tip(?!\S)', re.IGNORECASE)
+
+
+def _utf16_offset(text, index):
+    """
+    Telegram counts entity offsets in UTF-16 code units, which differ from str indexes past the Basic Multilingual
+    Plane (most emoji).
+    """
+    return len(text[:index].encode('utf-16-le')) // 2
+
+
+def _entity_text(encoded, entity):
+    start = entity['offset'] * 2
+    return encoded[start:start + entity['length'] * 2].decode('utf-16-le')
+
+
+def tip_mentions(text, entities):
+    """
+    Return the recipients of a !tip command, in order, as (user_id, username) pairs built from the message entities.
+    A text_mention (a user picked without a username) carries the user id and the user's username or first name;
+    an @username mention has no id yet.  Mentions before !tip and of the bot itself are left out.
+    """
+    command = TIP_COMMAND.search(text)
+    if command is None:
+        return []
+    command_offset = _utf16_offset(text, command.end())
+    encoded = text.encode('utf-16-le')
+    recipients = []
+    for entity in sorted(entities, key=lambda entity: entity['offset']):
+        if entity['offset'] < command_offset:
+            continue
+        if entity['type'] == 'text_mention':
+            user = entity['user']
+            recipients.append(
+                (user['id'], user.get('username') or user.get('first_name')))
+        elif entity['type'] == 'mention':
+            username = _entity_text(encoded, entity)[1:]
+            if username.lower() != BOT_ID_TELEGRAM.lower():
+                recipients.append((None, username))
+    return recipients
+
+
+def token_mentions(tokens):
+    """
+    Recipients from the whitespace-split text alone, for messages that arrived or were queued without entities.
+    """
+    return [(None, token[1:]) for token in tokens
+            if len(token) > 1 and token[0] == '@'
+            and token[1:].lower() != BOT_ID_TELEGRAM.lower()]
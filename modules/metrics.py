@@ -0,0 +1,136 @@
+import atexit
+import configparser
+import functools
+import os
+import tempfile
+import time
+
+# Read config and parse constants
+config = configparser.ConfigParser()
+config.read(os.environ['MY_CONF_DIR'] + '/webhooks.ini')
+
+# Every process (web server, job consumers and their workers, outbox dispatcher) writes its samples to files in this
+# directory and /metrics adds them up.  flask metrics_reset empties it; run it before starting the bot's processes.
+METRICS_DIR = config.get('webhooks', 'metrics_dir',
+                         fallback=os.path.join(tempfile.gettempdir(),
+                                               'tipbot_metrics'))
+# prometheus_client chooses multiprocess mode from the environment when it is first imported
+os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', METRICS_DIR)
+os.makedirs(os.environ['PROMETHEUS_MULTIPROC_DIR'], exist_ok=True)
+
+from prometheus_client import (CONTENT_TYPE_LATEST, CollectorRegistry,
+                               Counter, Gauge, Histogram, generate_latest,
+                               multiprocess)
+
+# Seconds, from a cached DB lookup up to a slow work_generate
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5,
+                   10, 30, 60, 120, float('inf'))
+
+WEBHOOK_SECONDS = Histogram('tipbot_webhook_seconds',
+                            'Time spent parsing a Telegram update', ['step'],
+                            buckets=LATENCY_BUCKETS)
+DB_SECONDS = Histogram('tipbot_db_seconds', 'Duration of DB helper calls',
+                       ['helper'], buckets=LATENCY_BUCKETS)
+DB_ERRORS = Counter('tipbot_db_errors', 'DB helper calls that raised',
+                    ['helper'])
+RPC_SECONDS = Histogram('tipbot_rpc_seconds', 'Duration of node RPC calls',
+                        ['action'], buckets=LATENCY_BUCKETS)
+RPC_ERRORS = Counter('tipbot_rpc_errors', 'Node RPC calls that failed',
+                     ['action'])
+RPC_RETRIES = Counter('tipbot_rpc_retries',
+                      'Node RPC calls repeated after a timeout or connection error',
+                      ['action'])
+RPC_REJECTED = Counter('tipbot_rpc_breaker_rejections',
+                       'Node RPC calls failed at once because the breaker was open',
+                       ['action'])
+RPC_BREAKER_STATE = Gauge('tipbot_rpc_breaker_state',
+                          'Breaker state per node: 0 closed, 1 half open, 2 open',
+                          ['node'], multiprocess_mode='livemax')
+NODE_HEALTHY = Gauge('tipbot_node_healthy',
+                     'Whether the node answered its last health check',
+                     ['node'], multiprocess_mode='livemin')
+NODE_LATENCY = Gauge('tipbot_node_latency_seconds',
+                     'Duration of the node\'s last health check', ['node'],
+                     multiprocess_mode='livemax')
+NODE_READS = Counter('tipbot_node_reads', 'Read RPC calls routed to each node',
+                     ['node'])
+TELEGRAM_SECONDS = Histogram('tipbot_telegram_send_seconds',
+                             'Duration of Telegram sendMessage calls',
+                             buckets=LATENCY_BUCKETS)
+TELEGRAM_MESSAGES = Counter('tipbot_telegram_messages',
+                            'Outbox delivery attempts by outcome',
+                            ['outcome'])
+OUTBOX_LATENCY = Histogram('tipbot_outbox_latency_seconds',
+                           'Time from queueing a message to its delivery',
+                           buckets=LATENCY_BUCKETS)
+JOB_SECONDS = Histogram('tipbot_job_seconds', 'Time a worker spent on a job',
+                        ['kind', 'outcome'], buckets=LATENCY_BUCKETS)
+JOB_LATENCY = Histogram('tipbot_job_latency_seconds',
+                        'Time from queueing a job to its completion, end to end',
+                        ['kind'], buckets=LATENCY_BUCKETS)
+TIP_STAGE_SECONDS = Histogram('tipbot_tip_stage_seconds',
+                              'Duration of each stage of the tip pipeline',
+                              ['stage'], buckets=LATENCY_BUCKETS)
+ACCOUNT_POOL_CLAIMS = Counter('tipbot_account_pool_claims',
+                              'New user accounts, taken from the pool or created on the spot',
+                              ['outcome'])
+ACCOUNT_POOL_FREE = Gauge('tipbot_account_pool_free',
+                          'Unclaimed accounts in the pool, as last seen by the refiller',
+                          multiprocess_mode='livemax')
+
+
+def timed(histogram, errors, label):
+    """
+    Decorator recording the duration of every call in histogram and the calls that raised in errors, under label.
+    """
+
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            except Exception:
+                errors.labels(label).inc()
+                raise
+            finally:
+                histogram.labels(label).observe(time.perf_counter() - start)
+
+        return wrapper
+
+    return decorate
+
+
+def mark_dead(pid):
+    """
+    Drop the live gauge samples (livemax/livemin) of a process that exited, so /metrics stops reporting them.
+    """
+    multiprocess.mark_process_dead(pid)
+
+
+# Processes that exit normally drop their own; forked workers skip atexit and are marked by workers._supervise
+atexit.register(lambda: mark_dead(os.getpid()))
+
+
+def reset():
+    """
+    Delete the sample files of every process.  Files left by an earlier run would keep adding its counters and
+    histograms to /metrics, and be taken over by any new process that gets one of its PIDs.  Call it only while no
+    other process of the bot is running.
+    """
+    directory = os.environ['PROMETHEUS_MULTIPROC_DIR']
+    removed = 0
+    for name in os.listdir(directory):
+        if name.endswith('.db'):
+            os.remove(os.path.join(directory, name))
+            removed += 1
+    return removed
+
+
+def render():
+    """
+    Return the samples of every process in the Prometheus text format, with its content type.
+    """
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return generate_latest(registry), CONTENT_TYPE_LATEST
@@ -0,0 +1,337 @@
+import configparser
+import logging
+import os
+from datetime import datetime
+
+from . import db
+
+# Read config and parse constants
+config = configparser.ConfigParser()
+config.read(os.environ['MY_CONF_DIR'] + '/webhooks.ini')
+logging.basicConfig(handlers=[logging.StreamHandler()], level=logging.INFO)
+
+# Rows removed per statement while deduplicating, keeps lock times short on a live table
+DEDUPE_BATCH_SIZE = int(
+    config.get('webhooks', 'migration_dedupe_batch', fallback='1000'))
+
+
+def _column_exists(table, column):
+    column_call = "SELECT 1 FROM information_schema.columns WHERE table_schema = %s AND table_name = %s AND column_name = %s"
+    return bool(db.get_db_data(column_call, (db.DB_SCHEMA, table, column)))
+
+
+def _index_exists(table, index):
+    index_call = "SELECT 1 FROM information_schema.statistics WHERE table_schema = %s AND table_name = %s AND index_name = %s"
+    return bool(db.get_db_data(index_call, (db.DB_SCHEMA, table, index)))
+
+
+def _add_row_id(table):
+    """
+    Give a legacy table a surrogate AUTO_INCREMENT primary key, numbering existing rows in insertion order.
+    """
+    if not _column_exists(table, 'id'):
+        db.execute_sql(
+            "ALTER TABLE {} ADD COLUMN id BIGINT AUTO_INCREMENT PRIMARY KEY FIRST"
+            .format(table))
+
+
+def _add_index(table, index, definition):
+    """
+    Add an index without blocking reads or writes on the table.
+    """
+    if not _index_exists(table, index):
+        db.execute_sql(
+            "ALTER TABLE {} ADD {} {}, ALGORITHM=INPLACE, LOCK=NONE".format(
+                table, index, definition))
+
+
+def _dedupe(table, columns, keep):
+    """
+    Delete rows that repeat the values of columns, keeping the row with the lowest id (keep='first') or the highest
+    (keep='last').  Runs in small batches so the table stays available.
+    """
+    join = ' AND '.join(
+        ['t1.{0} = t2.{0}'.format(column) for column in columns])
+    order = '<' if keep == 'last' else '>'
+    duplicate_call = "SELECT DISTINCT t1.id FROM {0} t1 JOIN {0} t2 ON {1} AND t1.id {2} t2.id LIMIT %s".format(
+        table, join, order)
+    removed = 0
+    while True:
+        duplicates = [
+            row[0]
+            for row in db.get_db_data(duplicate_call, (DEDUPE_BATCH_SIZE))
+        ]
+        if not duplicates:
+            break
+        delete_call = "DELETE FROM {} WHERE id IN ({})".format(
+            table, ', '.join(['%s'] * len(duplicates)))
+        db.set_db_data(delete_call, duplicates)
+        removed += len(duplicates)
+    logging.info("{}: removed {} duplicate rows from {}".format(
+        datetime.now(), removed, table))
+
+
+def _add_unique(table, index, columns, keep):
+    """
+    Deduplicate on columns and add a unique index over them.  A plain index is built first so finding the duplicates
+    does not need a full self-join.
+    """
+    if not _index_exists(table, index):
+        _add_index(table, 'KEY ix_dedupe', '({})'.format(', '.join(columns)))
+        _dedupe(table, columns, keep)
+        _add_index(table, 'UNIQUE KEY {}'.format(index),
+                   '({})'.format(', '.join(columns)))
+    if _index_exists(table, 'ix_dedupe'):
+        db.execute_sql("ALTER TABLE {} DROP INDEX ix_dedupe".format(table))
+
+
+def _users_keys():
+    _add_row_id('users')
+    # Every lookup used the first row stored for a user, so later duplicates are archived before they are removed
+    db.execute_sql("CREATE TABLE IF NOT EXISTS users_duplicates LIKE users")
+    db.execute_sql(
+        "INSERT IGNORE INTO users_duplicates SELECT DISTINCT t1.* FROM users t1 JOIN users t2 "
+        "ON t1.user_id = t2.user_id AND t1.id > t2.id")
+    _add_unique('users', 'uq_users_user_id', ['user_id'], keep='first')
+
+
+def _telegram_chat_members_keys():
+    _add_row_id('telegram_chat_members')
+    # The newest row carries the member's current username
+    _add_unique('telegram_chat_members', 'uq_members_chat_member',
+                ['chat_id', 'member_id'],
+                keep='last')
+    _add_index('telegram_chat_members', 'KEY ix_members_chat_name',
+               '(chat_id, member_name)')
+
+
+def _tip_list_keys():
+    _add_row_id('tip_list')
+    _add_index('tip_list', 'KEY ix_tip_list_tx', '(tx_id)')
+    _add_index('tip_list', 'KEY ix_tip_list_sender', '(sender_id)')
+    _add_index('tip_list', 'KEY ix_tip_list_receiver', '(receiver_id)')
+
+
+def _outbox_table():
+    """
+    Queue of outgoing Telegram messages, see modules/outbox.py.
+    """
+    db.execute_sql("""
+        CREATE TABLE IF NOT EXISTS outbox (
+            id BIGINT AUTO_INCREMENT PRIMARY KEY,
+            chat_id BIGINT,
+            text TEXT,
+            priority SMALLINT,
+            status SMALLINT,
+            attempts INT,
+            available_at DATETIME(6),
+            lease_owner CHAR(64),
+            lease_expires DATETIME(6),
+            last_error TEXT,
+            created_at DATETIME(6),
+            KEY ix_outbox_ready (status, priority, available_at),
+            KEY ix_outbox_owner (lease_owner))
+            """)
+
+
+def _tip_notification_tables():
+    """
+    Tips waiting to be announced, and the receivers that already have a notify job scheduled.
+    """
+    db.execute_sql("""
+        CREATE TABLE IF NOT EXISTS tip_notifications (
+            id BIGINT AUTO_INCREMENT PRIMARY KEY,
+            receiver_id INT,
+            receiver_account CHAR(128),
+            sender_name CHAR(128),
+            amount DECIMAL(20, 2),
+            created_at DATETIME(6),
+            KEY ix_tip_notifications_receiver (receiver_id, id))
+            """)
+    db.execute_sql("""
+        CREATE TABLE IF NOT EXISTS tip_notify_schedule (
+            receiver_id INT PRIMARY KEY,
+            scheduled_at DATETIME(6))
+            """)
+
+
+def _ledger_tables():
+    """
+    Internal ledger, see modules/ledger.py: double-entry transfers, balances per user, and the sends that moved funds
+    between or out of custodial accounts.
+    """
+    db.execute_sql("""
+        CREATE TABLE IF NOT EXISTS ledger_entries (
+            id BIGINT AUTO_INCREMENT PRIMARY KEY,
+            transfer_id CHAR(96),
+            kind CHAR(16),
+            user_id INT,
+            amount DECIMAL(39, 0),
+            created_at DATETIME(6),
+            UNIQUE KEY uq_ledger_entries_transfer (transfer_id, user_id),
+            KEY ix_ledger_entries_user (user_id))
+            """)
+    db.execute_sql("""
+        CREATE TABLE IF NOT EXISTS ledger_balances (
+            user_id INT PRIMARY KEY,
+            account CHAR(128),
+            balance DECIMAL(39, 0),
+            chain_balance DECIMAL(39, 0),
+            updated_at DATETIME(6))
+            """)
+    db.execute_sql("""
+        CREATE TABLE IF NOT EXISTS ledger_moves (
+            id CHAR(96) PRIMARY KEY,
+            hash CHAR(64),
+            source_user INT,
+            destination_user INT,
+            amount DECIMAL(39, 0),
+            created_at DATETIME(6))
+            """)
+
+
+def _telegram_offsets_table():
+    """
+    Offset of the next update to fetch with getUpdates, per bot, see modules/polling.py.
+    """
+    db.execute_sql("""
+        CREATE TABLE IF NOT EXISTS telegram_offsets (
+            bot_id CHAR(64) PRIMARY KEY,
+            update_offset BIGINT,
+            updated_at DATETIME(6))
+            """)
+
+
+def _account_pool_table():
+    """
+    Accounts created ahead of time for new users, see modules/account_pool.py.
+    """
+    db.execute_sql("""
+        CREATE TABLE IF NOT EXISTS account_pool (
+            id BIGINT AUTO_INCREMENT PRIMARY KEY,
+            account CHAR(128),
+            claimed_by INT,
+            claimed_at DATETIME(6),
+            created_at DATETIME(6),
+            UNIQUE KEY uq_account_pool_account (account),
+            KEY ix_account_pool_free (claimed_by, id))
+            """)
+
+
+def _telegram_chat_generations_table():
+    """
+    Membership generation per chat, bumped whenever a member leaves, so every process can tell its cached members are
+    out of date.
+    """
+    db.execute_sql("""
+        CREATE TABLE IF NOT EXISTS telegram_chat_generations (
+            chat_id BIGINT PRIMARY KEY,
+            generation BIGINT NOT NULL)
+            """)
+
+
+def _tip_list_unique():
+    # Several rows for one receiver of a message are a tip job that was retried after recording them
+    _add_unique('tip_list', 'uq_tip_list_dm_receiver', ['dm_id', 'receiver_id'],
+                keep='first')
+
+
+# Ordered (version, description, step).  Steps are idempotent so a migration interrupted half way can be rerun.
+MIGRATIONS = [
+    (1, 'users primary key and unique user_id', _users_keys),
+    (2,
+     'telegram_chat_members primary key, unique (chat_id, member_id), name index',
+     _telegram_chat_members_keys),
+    (3, 'tip_list primary key and lookup indexes', _tip_list_keys),
+    (4, 'outbox table for outgoing Telegram messages', _outbox_table),
+    (5, 'tip_notifications and tip_notify_schedule tables',
+     _tip_notification_tables),
+    (6, 'ledger_entries, ledger_balances and ledger_moves tables',
+     _ledger_tables),
+    (7, 'telegram_offsets table for long polling', _telegram_offsets_table),
+    (8, 'account_pool table of accounts created ahead of time',
+     _account_pool_table),
+    (9, 'telegram_chat_generations table for member cache coherence',
+     _telegram_chat_generations_table),
+    (10, 'tip_list unique (dm_id, receiver_id)', _tip_list_unique),
+]
+
+# Queries on the hot paths, checked by explain_hot_queries()
+HOT_QUERIES = [
+    ('users by user_id',
+     "SELECT account, register FROM users WHERE user_id = %s", (1)),
+    ('users by user_id list',
+     "SELECT user_id, account FROM users WHERE user_id IN (%s, %s)", (1, 2)),
+    ('members by name',
+     "SELECT member_id, member_name FROM telegram_chat_members WHERE chat_id = %s and member_name IN (%s, %s)",
+     (1, 'user', 'other')),
+    ('member by id',
+     "SELECT chat_id, member_id, member_name FROM telegram_chat_members WHERE (chat_id = %s AND member_id = %s)",
+     (1, 1)),
+    ('chat generation',
+     "SELECT generation FROM telegram_chat_generations WHERE chat_id = %s",
+     (1)),
+    ('tips of a message',
+     "SELECT receiver_id FROM tip_list WHERE dm_id = %s", (1)),
+    ('member removal',
+     "DELETE FROM telegram_chat_members WHERE chat_id = %s AND member_id = %s",
+     (1, 1)),
+]
+
+
+def current_version():
+    db.execute_sql("""
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INT PRIMARY KEY,
+            description CHAR(128),
+            applied_at DATETIME)
+            """)
+    version_data = db.get_db_data(
+        "SELECT COALESCE(MAX(version), 0) FROM schema_version", ())
+    return version_data[0][0]
+
+
+def migrate():
+    """
+    Apply every migration newer than the recorded schema version, in order.
+    """
+    version = current_version()
+    for migration_version, description, step in MIGRATIONS:
+        if migration_version <= version:
+            continue
+        logging.info("{}: applying migration {}: {}".format(
+            datetime.now(), migration_version, description))
+        step()
+        version_call = "INSERT INTO schema_version (version, description, applied_at) VALUES (%s, %s, NOW())"
+        db.set_db_data(version_call, (migration_version, description))
+    logging.info("{}: schema is at version {}".format(datetime.now(),
+                                                      current_version()))
+
+
+def explain_hot_queries():
+    """
+    EXPLAIN every hot query and return (name, table, access type, possible keys, key) rows, see full_scans().
+    """
+    plans = []
+    with db.connection() as conn:
+        db_cursor = conn.cursor()
+        for name, query, arguments in HOT_QUERIES:
+            db_cursor.execute("EXPLAIN " + query, arguments)
+            columns = [column[0] for column in db_cursor.description]
+            for row in db_cursor.fetchall():
+                plan = dict(zip(columns, row))
+                plans.append((name, plan['table'], plan['type'],
+                              plan['possible_keys'], plan['key']))
+    return plans
+
+
+def full_scans(plans):
+    """
+    Return the plans from explain_hot_queries() that read a table without an index: access type ALL, or no key chosen
+    even if possible_keys lists some.  Rows without a table, where the optimizer answered from the index alone or found
+    nothing to read, are fine.
+    """
+    return [
+        plan for plan in plans
+        if plan[1] is not None and (plan[2] == 'ALL' or plan[4] is None)
+    ]
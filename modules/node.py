@@ -0,0 +1,375 @@
+import configparser
+import logging
+import os
+import random
+import threading
+import time
+from datetime import datetime
+
+import nano
+import requests
+
+from . import metrics
+
+# Read config and parse constants
+config = configparser.ConfigParser()
+config.read(os.environ['MY_CONF_DIR'] + '/webhooks.ini')
+logging.basicConfig(handlers=[logging.StreamHandler()], level=logging.INFO)
+
+# The node holding WALLET, which gets every call that touches the wallet
+NODE_IP = config.get('webhooks', 'node_ip')
+# Nodes that may answer reads, comma separated; the wallet node is always one of them
+NODE_IPS = [
+    host.strip()
+    for host in config.get('webhooks', 'node_ips', fallback=NODE_IP).split(',')
+    if host.strip()
+]
+if NODE_IP not in NODE_IPS:
+    NODE_IPS.insert(0, NODE_IP)
+# Every NODE_PROBE_INTERVAL seconds each node's block_count is fetched, which gives its latency and how far it is synced
+NODE_PROBE_INTERVAL = float(
+    config.get('webhooks', 'node_probe_interval', fallback='5'))
+NODE_PROBE_TIMEOUT = float(
+    config.get('webhooks', 'node_probe_timeout', fallback='2'))
+# Blocks a node may be behind the best synced node and still answer reads
+NODE_MAX_LAG = int(config.get('webhooks', 'node_max_lag', fallback='10'))
+# Keep-alive connections kept open to each node by the shared session
+NODE_CONNECTIONS = int(
+    config.get('webhooks', 'node_connections', fallback='32'))
+
+# Seconds an RPC call may take, with per-action overrides given as "action:seconds, ..."
+RPC_TIMEOUT = float(config.get('webhooks', 'rpc_timeout', fallback='10'))
+RPC_TIMEOUTS = {
+    entry.split(':')[0].strip(): float(entry.split(':')[1])
+    for entry in config.get('webhooks', 'rpc_timeouts',
+                            fallback='send:30, receive:30, work_generate:60').split(',')
+    if entry.strip()
+}
+# Retries after a timeout or connection error, for actions that are safe to repeat, with jittered exponential backoff
+RPC_RETRIES = int(config.get('webhooks', 'rpc_retries', fallback='2'))
+RPC_RETRY_BASE = float(
+    config.get('webhooks', 'rpc_retry_base', fallback='0.2'))
+RPC_RETRY_MAX = float(config.get('webhooks', 'rpc_retry_max', fallback='2'))
+# Each call earns this fraction of a retry, so retries never add more than that share of load to a struggling node
+RPC_RETRY_BUDGET = float(
+    config.get('webhooks', 'rpc_retry_budget', fallback='0.1'))
+RPC_RETRY_BUDGET_MAX = 10.0
+# Consecutive failures that open a node's breaker, and seconds it stays open before a trial call is let through
+RPC_BREAKER_FAILURES = int(
+    config.get('webhooks', 'rpc_breaker_failures', fallback='5'))
+RPC_BREAKER_COOLDOWN = float(
+    config.get('webhooks', 'rpc_breaker_cooldown', fallback='30'))
+
+# Actions that do not publish blocks, so repeating one after a timeout is harmless.  A send is also safe to repeat when
+# it carries an id, as the node returns the original block for a known id.
+IDEMPOTENT_ACTIONS = {
+    'account_balance', 'account_key', 'accounts_balances', 'accounts_frontiers',
+    'accounts_pending', 'validate_account_number', 'wallet_balances',
+    'work_cancel', 'work_generate', 'work_validate'
+}
+
+# Reads any synced node can answer.  Chain state of the custodial accounts is read from the wallet node, see chain.py.
+# So are their pending blocks: a lagging node would not list blocks the wallet node can already receive.
+READ_ACTIONS = {
+    'account_balance', 'accounts_balances', 'accounts_frontiers',
+    'validate_account_number'
+}
+
+CLOSED = 'closed'
+HALF_OPEN = 'half_open'
+OPEN = 'open'
+# Breaker state as exported in tipbot_rpc_breaker_state
+_STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class NodeUnavailable(Exception):
+    pass
+
+
+def backoff(attempt):
+    """
+    Seconds to wait before retry number attempt: a random share of an exponentially growing, capped interval, so
+    callers that failed together do not retry together.
+    """
+    return random.uniform(0, min(RPC_RETRY_MAX, RPC_RETRY_BASE * 2**attempt))
+
+
+class Breaker:
+    """
+    Circuit breaker for one node.  After RPC_BREAKER_FAILURES consecutive timeouts or connection errors the breaker
+    opens and calls fail at once with NodeUnavailable.  After RPC_BREAKER_COOLDOWN seconds a single trial call is let
+    through: it closes the breaker if it succeeds and opens it again if not.  Error replies from the node count as
+    success, the node answered.
+    """
+
+    def __init__(self, host):
+        self.host = host
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0
+        self.lock = threading.Lock()
+        metrics.RPC_BREAKER_STATE.labels(host).set(_STATE_VALUES[CLOSED])
+
+    def _set(self, state):
+        if state != self.state:
+            logging.info("{}: node {} breaker {} -> {}".format(
+                datetime.now(), self.host, self.state, state))
+        self.state = state
+        metrics.RPC_BREAKER_STATE.labels(self.host).set(_STATE_VALUES[state])
+
+    def allow(self):
+        with self.lock:
+            if self.state == OPEN and time.monotonic(
+            ) - self.opened_at >= RPC_BREAKER_COOLDOWN:
+                self._set(HALF_OPEN)
+                return True
+            return self.state == CLOSED
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self._set(CLOSED)
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == HALF_OPEN or self.failures >= RPC_BREAKER_FAILURES:
+                self.opened_at = time.monotonic()
+                self._set(OPEN)
+
+
+class RetryBudget:
+    """
+    Token bucket for retries to one node: every call adds RPC_RETRY_BUDGET tokens, every retry takes one.
+    """
+
+    def __init__(self):
+        self.tokens = RPC_RETRY_BUDGET_MAX
+        self.lock = threading.Lock()
+
+    def deposit(self):
+        with self.lock:
+            self.tokens = min(RPC_RETRY_BUDGET_MAX,
+                              self.tokens + RPC_RETRY_BUDGET)
+
+    def withdraw(self):
+        with self.lock:
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+def _new_session():
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=len(NODE_IPS) + 1, pool_maxsize=NODE_CONNECTIONS)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+# Every Client in the process posts through one keep-alive session, and every Client for the same node shares its
+# breaker and retry budget
+_session = _new_session()
+_breakers = {}
+_budgets = {}
+_registry_lock = threading.Lock()
+# node -> {'latency': smoothed probe seconds, 'count': block count, 'healthy': last probe succeeded}
+_health = {}
+_health_lock = threading.Lock()
+_prober_pid = None
+
+
+def _reset_after_fork():
+    # A child must not reuse the parent's sockets, and starts with closed breakers, its own locks and no prober
+    global _session, _breakers, _budgets, _registry_lock, _health, _health_lock, _prober_pid
+    _session = _new_session()
+    _breakers = {}
+    _budgets = {}
+    _registry_lock = threading.Lock()
+    _health = {}
+    _health_lock = threading.Lock()
+    _prober_pid = None
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def breaker(host):
+    with _registry_lock:
+        if host not in _breakers:
+            _breakers[host] = Breaker(host)
+            _budgets[host] = RetryBudget()
+        return _breakers[host]
+
+
+def breaker_states():
+    """
+    Return {node: breaker state} for the nodes this process has called.
+    """
+    with _registry_lock:
+        return {host: breaker.state for host, breaker in _breakers.items()}
+
+
+def probe(host):
+    """
+    Fetch the node's block count and record its latency and whether it answered.
+    """
+    start = time.perf_counter()
+    try:
+        count = int(
+            _session.post(host, json={'action': 'block_count'},
+                          timeout=NODE_PROBE_TIMEOUT).json()['count'])
+    except Exception as e:
+        with _health_lock:
+            state = _health.setdefault(host, {'latency': None, 'count': 0})
+            if state.get('healthy', True):
+                logging.info("{}: node {} failed its health check: {}".format(
+                    datetime.now(), host, e))
+            state['healthy'] = False
+        metrics.NODE_HEALTHY.labels(host).set(0)
+        return
+    latency = time.perf_counter() - start
+    with _health_lock:
+        state = _health.setdefault(host, {'latency': None, 'count': 0})
+        # Smoothed, so one slow probe does not send every read elsewhere
+        state['latency'] = latency if state['latency'] is None else (
+            0.7 * state['latency'] + 0.3 * latency)
+        state['count'] = count
+        state['healthy'] = True
+    metrics.NODE_HEALTHY.labels(host).set(1)
+    metrics.NODE_LATENCY.labels(host).set(latency)
+
+
+def _probe_forever(hosts):
+    while _prober_pid == os.getpid():
+        for host in hosts:
+            probe(host)
+        time.sleep(NODE_PROBE_INTERVAL)
+
+
+def _start_prober(hosts):
+    global _prober_pid
+    with _health_lock:
+        if _prober_pid == os.getpid():
+            return
+        _prober_pid = os.getpid()
+    threading.Thread(target=_probe_forever, args=(hosts, ), daemon=True).start()
+
+
+def node_health():
+    """
+    Return {node: {'latency', 'count', 'healthy'}} from this process's health checks.
+    """
+    with _health_lock:
+        return {host: dict(state) for host, state in _health.items()}
+
+
+class Client(nano.rpc.Client):
+    """
+    Node RPC client with a deadline on every call, retries within a budget, a breaker per node, and latency and
+    failure metrics for every action.
+    """
+
+    def __init__(self, host):
+        self.host = host
+
+    @property
+    def session(self):
+        return _session
+
+    def call(self, action, params=None, timeout=None):
+        return self._call(self.host, action, params, timeout)
+
+    def _call(self, host, action, params=None, timeout=None):
+        params = params or {}
+        params['action'] = action
+        timeout = timeout or RPC_TIMEOUTS.get(action, RPC_TIMEOUT)
+        node_breaker = breaker(host)
+        budget = _budgets[host]
+        budget.deposit()
+        retryable = action in IDEMPOTENT_ACTIONS or (action == 'send'
+                                                     and 'id' in params)
+        attempt = 0
+        while True:
+            if not node_breaker.allow():
+                metrics.RPC_REJECTED.labels(action).inc()
+                raise NodeUnavailable("node {} is unavailable, {} not sent".format(
+                    host, action))
+            start = time.perf_counter()
+            try:
+                result = _session.post(host, json=params,
+                                           timeout=timeout).json()
+            except (requests.RequestException, ValueError) as e:
+                metrics.RPC_ERRORS.labels(action).inc()
+                node_breaker.failure()
+                if (retryable and attempt < RPC_RETRIES
+                        and node_breaker.state == CLOSED and budget.withdraw()):
+                    attempt += 1
+                    metrics.RPC_RETRIES.labels(action).inc()
+                    logging.info("{}: {} failed, retry {}: {}".format(
+                        datetime.now(), action, attempt, e))
+                    time.sleep(backoff(attempt))
+                    continue
+                raise NodeUnavailable("{} failed: {}".format(action, e)) from e
+            finally:
+                metrics.RPC_SECONDS.labels(action).observe(
+                    time.perf_counter() - start)
+            node_breaker.success()
+            if 'error' in result:
+                metrics.RPC_ERRORS.labels(action).inc()
+                raise nano.rpc.RPCException(result['error'])
+            return result
+
+
+class NodePool(Client):
+    """
+    Client for the wallet node and any number of read nodes.  READ_ACTIONS go to the fastest healthy node that is
+    within NODE_MAX_LAG blocks of the best synced one, falling back to the next on NodeUnavailable and finally to the
+    wallet node; everything else stays on the wallet node.  Nodes are health checked from a background thread in
+    each process.
+    """
+
+    def __init__(self, wallet_host=NODE_IP, hosts=NODE_IPS):
+        super().__init__(wallet_host)
+        self.hosts = hosts
+
+    def read_hosts(self):
+        """
+        Nodes to try for a read, fastest first.  Until the first health check, only the wallet node.
+        """
+        with _health_lock:
+            checked = {
+                host: _health[host]
+                for host in self.hosts
+                if _health.get(host, {}).get('healthy')
+            }
+        best = max([state['count'] for state in checked.values()], default=0)
+        synced = sorted(
+            (host for host, state in checked.items()
+             if state['count'] >= best - NODE_MAX_LAG
+             and breaker(host).state != OPEN),
+            key=lambda host: checked[host]['latency'])
+        if self.host not in synced:
+            synced.append(self.host)
+        return synced
+
+    def call(self, action, params=None, timeout=None):
+        if action not in READ_ACTIONS or len(self.hosts) == 1:
+            return self._call(self.host, action, params, timeout)
+        _start_prober(self.hosts)
+        hosts = self.read_hosts()
+        for host in hosts[:-1]:
+            try:
+                metrics.NODE_READS.labels(host).inc()
+                return self._call(host, action, dict(params or {}), timeout)
+            except NodeUnavailable as e:
+                logging.info("{}: read {} failed on {}, trying the next node: {}".format(
+                    datetime.now(), action, host, e))
+        metrics.NODE_READS.labels(hosts[-1]).inc()
+        return self._call(hosts[-1], action, params, timeout)
+
+
+# The client every module uses for the nodes in the config
+rpc = NodePool()
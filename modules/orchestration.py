@@ -1,13 +1,13 @@
 import configparser
+import contextlib
 import logging
 import os
 from datetime import datetime
 from decimal import Decimal, getcontext
 from http import HTTPStatus
 
-import nano
-
-from . import currency, db, social
+from . import (account_pool, chain, currency, db, jobs, lanes, ledger, node,
+               social)
 
 # Read config and parse constants
 config = configparser.ConfigParser()
@@ -16,116 +16,83 @@ logging.basicConfig(handlers=[logging.StreamHandler()], level=logging.INFO)
 
 # Set constants
 BULLET = u"\u2022"
-NODE_IP = config.get('webhooks', 'node_ip')
 WALLET = config.get('webhooks', 'wallet')
 MIN_TIP = config.get('webhooks', 'min_tip')
+NODE_BUSY_TEXT = ("The node is busy right now.  Your {} is queued and will go through as soon as it "
+                  "recovers.")
 
 # Connect to global functions
-rpc = nano.rpc.Client(NODE_IP)
+rpc = node.rpc
 raw_denominator = 10**2
 getcontext().prec = 3
 
 
 def parse_action(message):
+    """
+    Queue the DM command as a job and acknowledge the update.
+    """
     if message['dm_action'] == '!help' or message[
             'dm_action'] == '/help' or message['dm_action'] == '/start':
-        new_pid = os.fork()
-        if new_pid == 0:
-            try:
-                help_process(message)
-            except Exception as e:
-                logging.info("Exception: {}".format(e))
-                raise e
-            os._exit(0)
-        else:
-            return '', HTTPStatus.OK
+        return submit_process('help', message)
 
     elif message['dm_action'] == '!balance' or message[
             'dm_action'] == '/balance':
-        new_pid = os.fork()
-        if new_pid == 0:
-            try:
-                balance_process(message)
-            except Exception as e:
-                logging.info("Exception: {}".format(e))
-                raise e
-            os._exit(0)
-        else:
-            return '', HTTPStatus.OK
+        return submit_process('balance', message)
 
     elif message['dm_action'] == '!register' or message[
             'dm_action'] == '/register':
-        new_pid = os.fork()
-        if new_pid == 0:
-            try:
-                register_process(message)
-            except Exception as e:
-                logging.info("Exception: {}".format(e))
-                raise e
-            os._exit(0)
-        else:
-            return '', HTTPStatus.OK
+        return submit_process('register', message)
 
     elif message['dm_action'] == '!tip' or message['dm_action'] == '/tip':
-        new_pid = os.fork()
-        if new_pid == 0:
-            try:
-                redirect_tip_text = (
-                    "Tips are processed through public messages now.  Please send this message in group chat in the format "
-                    "@NOLLARTipBot !tip 1 @user1.")
-                social.send_dm(message['sender_id'], redirect_tip_text)
-            except Exception as e:
-                logging.info("Exception: {}".format(e))
-                raise e
-            os._exit(0)
-        else:
-            return '', HTTPStatus.OK
+        return submit_process('tip_redirect', message)
 
     elif message['dm_action'] == '!withdraw' or message[
             'dm_action'] == '/withdraw':
-        new_pid = os.fork()
-        if new_pid == 0:
-            try:
-                withdraw_process(message)
-            except Exception as e:
-                logging.info("Exception: {}".format(e))
-                raise e
-            os._exit(0)
-        else:
-            return '', HTTPStatus.OK
+        return submit_process('withdraw', message)
 
     elif message['dm_action'] == '!account' or message[
             'dm_action'] == '/account':
-        new_pid = os.fork()
-        if new_pid == 0:
-            try:
-                account_process(message)
-            except Exception as e:
-                logging.info("Exception: {}".format(e))
-                raise e
-            os._exit(0)
-        else:
-            return '', HTTPStatus.OK
+        return submit_process('account', message)
 
     else:
-        new_pid = os.fork()
-        if new_pid == 0:
-            try:
-                wrong_format_text = (
-                    "The command or syntax you sent is not recognized.  Please send !help for a list "
-                    "of commands and what they do.")
-                social.send_dm(message['sender_id'], wrong_format_text)
-                logging.info('unrecognized syntax')
-            except Exception as e:
-                logging.info("Exception: {}".format(e))
-                raise e
-            os._exit(0)
-        else:
-            return '', HTTPStatus.OK
+        return submit_process('unrecognized', message)
+
 
+def submit_process(kind, *args):
+    """
+    Persist the work as a job for the consumers.  If the queue cannot be written, answer 503 so Telegram redelivers
+    the update instead of it being lost.
+    """
+    try:
+        jobs.enqueue(kind, *args)
+    except Exception as e:
+        logging.info("{}: Failed to queue {} job: {}".format(
+            datetime.now(), kind, e))
+        return '', HTTPStatus.SERVICE_UNAVAILABLE
     return '', HTTPStatus.OK
 
 
+def tip_redirect_process(message):
+    """
+    Tips are only accepted in group chats, so point the user there.
+    """
+    redirect_tip_text = (
+        "Tips are processed through public messages now.  Please send this message in group chat in the format "
+        "@NOLLARTipBot !tip 1 @user1.")
+    social.send_dm(message['sender_id'], redirect_tip_text)
+
+
+def unrecognized_process(message):
+    """
+    Reply to a DM that did not contain a known command.
+    """
+    wrong_format_text = (
+        "The command or syntax you sent is not recognized.  Please send !help for a list "
+        "of commands and what they do.")
+    social.send_dm(message['sender_id'], wrong_format_text)
+    logging.info('unrecognized syntax')
+
+
 def help_process(message):
     """
     Reply to the sender with help commands
@@ -175,10 +142,14 @@ def balance_process(message):
             db.set_db_data(set_register_call, arguments)
 
         currency.receive_pending(message['sender_account'])
-        balance_return = rpc.account_balance(
-            account="{}".format(message['sender_account']))
-        message['sender_balance_raw'] = balance_return['balance']
-        message['sender_balance'] = balance_return['balance'] / raw_denominator
+        if ledger.LEDGER_MODE:
+            message['sender_balance_raw'] = ledger.get_balance(
+                message['sender_id'], message['sender_account'])
+        else:
+            message['sender_balance_raw'] = chain.get_balance(
+                message['sender_account'])
+        message['sender_balance'] = message[
+            'sender_balance_raw'] / raw_denominator
 
         balance_text = "Your balance is {} NOLLAR.".format(
             message['sender_balance'])
@@ -198,8 +169,7 @@ def register_process(message):
 
     if not data:
         # Create an account for the user
-        sender_account = rpc.account_create(
-            wallet="{}".format(WALLET), work=False)
+        sender_account = account_pool.new_account(message['sender_id'])
         account_create_call = "INSERT INTO users (user_id, user_name, account, register) VALUES(%s, %s, %s, 1)"
         arguments = (message['sender_id'], message['sender_screen_name'],
                      sender_account)
@@ -247,12 +217,11 @@ def account_process(message):
     arguments = (message['sender_id'])
     account_data = db.get_db_data(sender_account_call, arguments)
     if not account_data:
-        sender_account = rpc.account_create(
-            wallet="{}".format(WALLET), work=True)
+        sender_account = account_pool.new_account(message['sender_id'])
         account_create_call = "INSERT INTO users (user_id, user_name, account, register) VALUES(%s, %s, %s, 1)"
         arguments = (message['sender_id'], message['sender_screen_name'],
                      sender_account)
-        db.set_db_data(account_create_call)
+        db.set_db_data(account_create_call, arguments)
 
         account_text = "You didn't have an account set up, so I set one up for you.  Your account number is:"
         social.send_account_message(account_text, message, sender_account)
@@ -276,6 +245,29 @@ def account_process(message):
             datetime.now()))
 
 
+def _chain_lane(account):
+    """
+    The account's lane for sends published here.  With the internal ledger, balances are checked in the same UPDATE
+    that debits them and ledger sends take the lane themselves, under locks that must be taken first.
+    """
+    if ledger.LEDGER_MODE:
+        return contextlib.nullcontext()
+    return lanes.account_lane(account)
+
+
+@contextlib.contextmanager
+def _queued_while_node_busy(notify, operation):
+    """
+    Fail the job so the queue retries it when the node is unavailable, and tell the user once, on the first attempt.
+    """
+    try:
+        yield
+    except node.NodeUnavailable:
+        if jobs.first_attempt():
+            notify(NODE_BUSY_TEXT.format(operation))
+        raise
+
+
 def withdraw_process(message):
     """
     When the user sends !withdraw, send their entire balance to the provided account.  If there is no provided account
@@ -297,88 +289,129 @@ def withdraw_process(message):
 
         else:
             sender_account = withdraw_data[0][0]
-            currency.receive_pending(sender_account)
-            balance_return = rpc.account_balance(
-                account='{}'.format(sender_account))
-
-            if len(message['dm_array']) == 2:
-                receiver_account = message['dm_array'][1].lower()
-            else:
-                receiver_account = message['dm_array'][2].lower()
-
-            if rpc.validate_account_number(receiver_account) == 0:
-                invalid_account_text = (
-                    "The account number you provided is invalid.  Please double check and "
-                    "resend your request.")
-                social.send_dm(message['sender_id'], invalid_account_text)
-                logging.info(
-                    "{}: The nollar account number is invalid: {}".format(
-                        datetime.now(), receiver_account))
-
-            elif balance_return['balance'] == 0:
-                no_balance_text = (
-                    "You have 0 balance in your account.  Please deposit to your address {} to "
-                    "send more tips!".format(sender_account))
-                social.send_dm(message['sender_id'], no_balance_text)
-                logging.info(
-                    "{}: The user tried to withdraw with 0 balance".format(
-                        datetime.now()))
-
-            else:
-                if len(message['dm_array']) == 3:
-                    try:
-                        withdraw_amount = Decimal(message['dm_array'][1])
-                    except Exception as e:
-                        logging.info("{}: withdraw no number ERROR: {}".format(
-                            datetime.now(), e))
-                        invalid_amount_text = (
-                            "You did not send a number to withdraw.  Please resend with the format"
-                            "!withdraw <account> or !withdraw <amount> <account>"
-                        )
-                        social.send_dm(message['sender_id'],
-                                       invalid_amount_text)
-                        return
-                    withdraw_amount_raw = int(
-                        withdraw_amount * raw_denominator)
-                    if Decimal(withdraw_amount_raw) > Decimal(
-                            balance_return['balance']):
-                        not_enough_balance_text = (
-                            "You do not have that much NOLLAR in your account.  To withdraw your "
-                            "full amount, send !withdraw <account>")
-                        social.send_dm(message['sender_id'],
-                                       not_enough_balance_text)
-                        return
+            # The balance is read and spent in the account's lane, so concurrent tips cannot spend it in between
+            with _queued_while_node_busy(
+                    lambda text: social.send_dm(message['sender_id'], text),
+                    'withdrawal'), _chain_lane(sender_account):
+                currency.receive_pending(sender_account)
+                if ledger.LEDGER_MODE:
+                    balance_return = {
+                        'balance':
+                        ledger.get_balance(message['sender_id'], sender_account)
+                    }
                 else:
-                    withdraw_amount_raw = balance_return['balance']
-                    withdraw_amount = balance_return[
-                        'balance'] / raw_denominator
-                # send the total balance to the provided account
-                work = currency.get_pow(sender_account)
-                if work == '':
-                    logging.info("{}: processed without work".format(
-                        datetime.now()))
-                    send_hash = rpc.send(
-                        wallet="{}".format(WALLET),
-                        source="{}".format(sender_account),
-                        destination="{}".format(receiver_account),
-                        amount=withdraw_amount_raw)
+                    balance_return = {
+                        'balance': chain.get_balance(sender_account)
+                    }
+
+                if len(message['dm_array']) == 2:
+                    receiver_account = message['dm_array'][1].lower()
                 else:
-                    logging.info("{}: processed with work: {}".format(
-                        datetime.now(), work))
-                    send_hash = rpc.send(
-                        wallet="{}".format(WALLET),
-                        source="{}".format(sender_account),
-                        destination="{}".format(receiver_account),
-                        amount=withdraw_amount_raw,
-                        work=work)
-                logging.info("{}: send_hash = {}".format(
-                    datetime.now(), send_hash))
-                # respond that the withdraw has been processed
-                withdraw_text = ("You have successfully withdrawn {} NOLLAR!".
-                                 format(withdraw_amount))
-                social.send_dm(message['sender_id'], withdraw_text)
-                logging.info("{}: Withdraw processed.  Hash: {}".format(
-                    datetime.now(), send_hash))
+                    receiver_account = message['dm_array'][2].lower()
+
+                if rpc.validate_account_number(receiver_account) == 0:
+                    invalid_account_text = (
+                        "The account number you provided is invalid.  Please double check and "
+                        "resend your request.")
+                    social.send_dm(message['sender_id'], invalid_account_text)
+                    logging.info(
+                        "{}: The nollar account number is invalid: {}".format(
+                            datetime.now(), receiver_account))
+
+                elif balance_return['balance'] == 0:
+                    no_balance_text = (
+                        "You have 0 balance in your account.  Please deposit to your address {} to "
+                        "send more tips!".format(sender_account))
+                    social.send_dm(message['sender_id'], no_balance_text)
+                    logging.info(
+                        "{}: The user tried to withdraw with 0 balance".format(
+                            datetime.now()))
+
+                else:
+                    if len(message['dm_array']) == 3:
+                        try:
+                            withdraw_amount = Decimal(message['dm_array'][1])
+                        except Exception as e:
+                            logging.info("{}: withdraw no number ERROR: {}".format(
+                                datetime.now(), e))
+                            invalid_amount_text = (
+                                "You did not send a number to withdraw.  Please resend with the format"
+                                "!withdraw <account> or !withdraw <amount> <account>"
+                            )
+                            social.send_dm(message['sender_id'],
+                                           invalid_amount_text)
+                            return
+                        withdraw_amount_raw = int(
+                            withdraw_amount * raw_denominator)
+                        if Decimal(withdraw_amount_raw) > Decimal(
+                                balance_return['balance']):
+                            not_enough_balance_text = (
+                                "You do not have that much NOLLAR in your account.  To withdraw your "
+                                "full amount, send !withdraw <account>")
+                            social.send_dm(message['sender_id'],
+                                           not_enough_balance_text)
+                            return
+                    else:
+                        withdraw_amount_raw = balance_return['balance']
+                        withdraw_amount = balance_return[
+                            'balance'] / raw_denominator
+                    # send the total balance to the provided account
+                    if ledger.LEDGER_MODE:
+                        try:
+                            send_hash = ledger.withdraw(
+                                int(message['sender_id']), sender_account,
+                                receiver_account, int(withdraw_amount_raw),
+                                "withdraw-{}".format(message['dm_id']))
+                        except ledger.InsufficientBalance:
+                            # A concurrent tip spent the ledger balance after it was checked; the debit refused this
+                            not_enough_balance_text = (
+                                "You do not have that much NOLLAR in your account.  To withdraw your "
+                                "full amount, send !withdraw <account>")
+                            social.send_dm(message['sender_id'],
+                                           not_enough_balance_text)
+                            return
+                        withdraw_text = (
+                            "You have successfully withdrawn {} NOLLAR!".format(
+                                withdraw_amount))
+                        social.send_dm(message['sender_id'], withdraw_text)
+                        logging.info("{}: Withdraw processed.  Hash: {}".format(
+                            datetime.now(), send_hash))
+                        return
+                    work = currency.get_pow(sender_account)
+                    try:
+                        if work == '':
+                            logging.info("{}: processed without work".format(
+                                datetime.now()))
+                            send_hash = rpc.send(
+                                wallet="{}".format(WALLET),
+                                source="{}".format(sender_account),
+                                destination="{}".format(receiver_account),
+                                amount=withdraw_amount_raw,
+                                id="withdraw-{}".format(message['dm_id']))
+                        else:
+                            logging.info("{}: processed with work: {}".format(
+                                datetime.now(), work))
+                            send_hash = rpc.send(
+                                wallet="{}".format(WALLET),
+                                source="{}".format(sender_account),
+                                destination="{}".format(receiver_account),
+                                amount=withdraw_amount_raw,
+                                work=work,
+                                id="withdraw-{}".format(message['dm_id']))
+                    except Exception:
+                        chain.invalidate(sender_account)
+                        raise
+                    chain.record_send(sender_account, send_hash,
+                                      withdraw_amount_raw)
+                    logging.info("{}: send_hash = {}".format(
+                        datetime.now(), send_hash))
+                    currency.precompute_work(sender_account, send_hash)
+                    # respond that the withdraw has been processed
+                    withdraw_text = ("You have successfully withdrawn {} NOLLAR!".
+                                     format(withdraw_amount))
+                    social.send_dm(message['sender_id'], withdraw_text)
+                    logging.info("{}: Withdraw processed.  Hash: {}".format(
+                        datetime.now(), send_hash))
     else:
         incorrect_withdraw_text = (
             "I didn't understand your withdraw request.  Please resend with !withdraw "
@@ -403,12 +436,23 @@ def tip_process(message, users_to_tip):
     if message['sender_account'] is None or message['tip_amount'] <= 0:
         return
 
-    message = social.validate_total_tip_amount(message)
-    if message['tip_amount'] <= 0:
-        return
-
-    for t_index in range(0, len(users_to_tip)):
-        currency.send_tip(message, users_to_tip, t_index)
+    with _queued_while_node_busy(
+            lambda text: social.send_reply(message, text),
+            'tip'), _chain_lane(message['sender_account']):
+        # Another tip or withdrawal may have spent from the account while this one waited for the lane, so the
+        # balance is checked against what it left behind and reserved until the sends are recorded
+        message = social.set_sender_balance(message)
+        unpaid = social.skip_recorded_tips(message, users_to_tip)
+        message = social.validate_total_tip_amount(message)
+        if message['tip_amount'] <= 0:
+            return
+
+        try:
+            currency.send_tips(message, unpaid)
+        except ledger.LedgerError:
+            # A concurrent tip spent the ledger balance first; the debit refused this one
+            social.refuse_tip_amount(message)
+            return
 
     # Inform the user that all tips were sent.
     if len(users_to_tip) >= 2:
@@ -421,3 +465,18 @@ def tip_process(message, users_to_tip):
         tip_success = ("You have successfully sent your {} NOLLAR tip.".format(
             Decimal(message['tip_amount_text'])))
         social.send_reply(message, tip_success)
+
+
+# Processes run by the job consumers, keyed by the job kind passed to submit_process
+JOB_PROCESSES = {
+    'help': help_process,
+    'balance': balance_process,
+    'register': register_process,
+    'tip_redirect': tip_redirect_process,
+    'withdraw': withdraw_process,
+    'account': account_process,
+    'unrecognized': unrecognized_process,
+    'tip': tip_process,
+    'receive': currency.receive_pending_accounts,
+    'notify': currency.notify_process,
+}
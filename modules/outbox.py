@@ -0,0 +1,347 @@
+import configparser
+import heapq
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import telegram
+
+from . import db, metrics
+
+# Read config and parse constants
+config = configparser.ConfigParser()
+config.read(os.environ['MY_CONF_DIR'] + '/webhooks.ini')
+logging.basicConfig(handlers=[logging.StreamHandler()], level=logging.INFO)
+
+# Telegram API
+TELEGRAM_KEY = config.get('webhooks', 'telegram_key')
+TELEGRAM_BASE_URL = config.get('webhooks', 'telegram_base_url',
+                               fallback='https://api.telegram.org/bot')
+
+# Telegram allows about 30 messages per second overall, one per second to a private chat and 20 per minute to a group
+OUTBOX_GLOBAL_RATE = float(
+    config.get('webhooks', 'outbox_global_rate', fallback='25'))
+OUTBOX_GLOBAL_BURST = int(
+    config.get('webhooks', 'outbox_global_burst', fallback='25'))
+OUTBOX_PRIVATE_RATE = float(
+    config.get('webhooks', 'outbox_private_rate', fallback='1'))
+OUTBOX_GROUP_RATE = float(
+    config.get('webhooks', 'outbox_group_rate', fallback='0.33'))
+OUTBOX_CHAT_BURST = int(
+    config.get('webhooks', 'outbox_chat_burst', fallback='3'))
+# Dispatcher settings
+OUTBOX_SEND_THREADS = int(
+    config.get('webhooks', 'outbox_send_threads', fallback='8'))
+OUTBOX_LEASE_SECONDS = int(
+    config.get('webhooks', 'outbox_lease_seconds', fallback='60'))
+OUTBOX_LEASE_BATCH = int(
+    config.get('webhooks', 'outbox_lease_batch', fallback='50'))
+OUTBOX_POLL_INTERVAL = float(
+    config.get('webhooks', 'outbox_poll_interval', fallback='0.2'))
+OUTBOX_MAX_ATTEMPTS = int(
+    config.get('webhooks', 'outbox_max_attempts', fallback='8'))
+OUTBOX_BACKOFF_MAX = int(
+    config.get('webhooks', 'outbox_backoff_max', fallback='300'))
+OUTBOX_STATS_INTERVAL = float(
+    config.get('webhooks', 'outbox_stats_interval', fallback='60'))
+
+# Priorities, lower is sent first.  Answers in a group chat go before DMs, DMs before tip notifications.
+PRIORITY_REPLY = 0
+PRIORITY_DM = 1
+PRIORITY_NOTIFICATION = 2
+
+# Message states, same meaning as in job_queue
+OUTBOX_PENDING = 0
+OUTBOX_LEASED = 1
+OUTBOX_DEAD = 3
+
+# Errors retrying cannot fix: the user blocked the bot, the chat is gone, the text is invalid
+PERMANENT_ERRORS = (telegram.error.BadRequest, telegram.error.Unauthorized,
+                    telegram.error.ChatMigrated)
+
+# Connect to Telegram
+telegram_bot = telegram.Bot(token=TELEGRAM_KEY, base_url=TELEGRAM_BASE_URL)
+
+# Token buckets kept as the time the next token is due (GCRA), per chat and one for the whole bot.  Only the
+# dispatcher process uses them.
+_chat_buckets = {}
+_global_bucket = [0.0]
+_dispatch_lock = threading.Lock()
+# Leased messages waiting for their chat's next token: (due, priority, id, message)
+_waiting = []
+_in_flight = [0]
+_outbox_stats = {
+    'sent': 0,
+    'throttled': 0,
+    'retry_after': 0,
+    'retried': 0,
+    'dead': 0,
+    'latency_total': 0.0,
+    'latency_max': 0.0
+}
+
+
+def _reset_after_fork():
+    global telegram_bot, _dispatch_lock
+    telegram_bot = telegram.Bot(token=TELEGRAM_KEY, base_url=TELEGRAM_BASE_URL)
+    _dispatch_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def send(chat_id, text, priority=PRIORITY_DM, cursor=None):
+    """
+    Queue a message for the dispatcher.  Returns as soon as the row is stored, delivery and retries happen in the
+    outbox_dispatcher process.  Pass the cursor of a db.transaction() to queue the message only if it commits.
+    """
+    send_call = (
+        "INSERT INTO outbox (chat_id, text, priority, status, attempts, available_at, created_at) "
+        "VALUES (%s, %s, %s, %s, 0, NOW(6), NOW(6))")
+    arguments = (chat_id, text, priority, OUTBOX_PENDING)
+    if cursor is not None:
+        cursor.execute(send_call, arguments)
+        return
+    db.set_db_data(send_call, arguments)
+
+
+def _chat_rate(chat_id):
+    return OUTBOX_GROUP_RATE if int(chat_id) < 0 else OUTBOX_PRIVATE_RATE
+
+
+def _reserve(bucket, rate, burst, now):
+    """
+    Take the next token from a bucket holding up to burst tokens refilled at rate per second.  Returns the time the
+    token is available, which is now unless the bucket is empty.
+    """
+    interval = 1.0 / rate
+    due = max(now, bucket[0] - (burst - 1) * interval)
+    bucket[0] = max(bucket[0], due) + interval
+    return due
+
+
+def lease(count):
+    """
+    Claim up to count due messages, highest priority first, for OUTBOX_LEASE_SECONDS.
+    """
+    owner = "{}-{}-{}".format(socket.gethostname()[:32], os.getpid(),
+                              uuid.uuid4().hex[:12])
+    lease_call = (
+        "UPDATE outbox SET status = %s, lease_owner = %s, lease_expires = NOW(6) + INTERVAL %s SECOND, "
+        "attempts = attempts + 1 "
+        "WHERE (status = %s AND available_at <= NOW(6)) OR (status = %s AND lease_expires < NOW(6)) "
+        "ORDER BY priority, id LIMIT %s")
+    arguments = (OUTBOX_LEASED, owner, OUTBOX_LEASE_SECONDS, OUTBOX_PENDING,
+                 OUTBOX_LEASED, count)
+    db.set_db_data(lease_call, arguments)
+
+    # Time queued so far is measured on the DB's clock, which created_at was written with
+    leased_call = (
+        "SELECT id, chat_id, text, priority, attempts, lease_owner, "
+        "TIMESTAMPDIFF(MICROSECOND, created_at, NOW(6)) FROM outbox "
+        "WHERE lease_owner = %s AND status = %s ORDER BY priority, id")
+    rows = db.get_db_data(leased_call, (owner, OUTBOX_LEASED))
+    leased_at = time.monotonic()
+    return [{
+        'id': row[0],
+        'chat_id': row[1],
+        'text': row[2],
+        'priority': row[3],
+        'attempts': row[4],
+        'lease_owner': row[5],
+        'queued_seconds': row[6] / 1e6,
+        'leased_at': leased_at
+    } for row in rows]
+
+
+def _delivered(message):
+    delivered_call = "DELETE FROM outbox WHERE id = %s AND lease_owner = %s"
+    db.set_db_data(delivered_call, (message['id'], message['lease_owner']))
+    latency = message['queued_seconds'] + time.monotonic(
+    ) - message['leased_at']
+    _outbox_stats['sent'] += 1
+    metrics.TELEGRAM_MESSAGES.labels('sent').inc()
+    metrics.OUTBOX_LATENCY.observe(latency)
+    _outbox_stats['latency_total'] += latency
+    _outbox_stats['latency_max'] = max(_outbox_stats['latency_max'], latency)
+
+
+def _defer(message, delay, attempt_failed, error=None):
+    """
+    Hand a leased message back to the queue, due in delay seconds.  Throttling does not count as an attempt.
+    """
+    defer_call = (
+        "UPDATE outbox SET status = %s, lease_owner = NULL, attempts = attempts - %s, last_error = %s, "
+        "available_at = NOW(6) + INTERVAL %s SECOND WHERE id = %s AND lease_owner = %s"
+    )
+    arguments = (OUTBOX_PENDING, 0 if attempt_failed else 1,
+                 None if error is None else str(error), delay, message['id'],
+                 message['lease_owner'])
+    db.set_db_data(defer_call, arguments)
+
+
+def _dead(message, error):
+    logging.info("{}: message {} to {} dead after {} attempts: {}".format(
+        datetime.now(), message['id'], message['chat_id'],
+        message['attempts'], error))
+    dead_call = "UPDATE outbox SET status = %s, lease_owner = NULL, last_error = %s WHERE id = %s AND lease_owner = %s"
+    db.set_db_data(dead_call, (OUTBOX_DEAD, str(error), message['id'],
+                               message['lease_owner']))
+    _outbox_stats['dead'] += 1
+    metrics.TELEGRAM_MESSAGES.labels('dead').inc()
+
+
+def _schedule(message):
+    """
+    Book the message a token from its chat's bucket.  Messages due soon wait in memory; ones due after the lease
+    would run out go back to the table, due when their token is.
+    """
+    now = time.monotonic()
+    bucket = _chat_buckets.setdefault(message['chat_id'], [now])
+    previous = bucket[0]
+    due = _reserve(bucket, _chat_rate(message['chat_id']), OUTBOX_CHAT_BURST,
+                   now)
+    if due - now < OUTBOX_LEASE_SECONDS / 2:
+        heapq.heappush(_waiting,
+                       (due, message['priority'], message['id'], message))
+        return
+    # Give the token back, the message books a new one when it is leased again
+    bucket[0] = previous
+    _outbox_stats['throttled'] += 1
+    metrics.TELEGRAM_MESSAGES.labels('throttled').inc()
+    _defer(message, int(due - now) + 1, attempt_failed=False)
+
+
+def _deliver(message):
+    """
+    Send one message and record the outcome.  Runs on the send threads.
+    """
+    try:
+        with metrics.TELEGRAM_SECONDS.time():
+            telegram_bot.sendMessage(chat_id=message['chat_id'],
+                                     text=message['text'])
+    except telegram.error.RetryAfter as e:
+        # Flood control: nothing more for this chat until Telegram says so
+        _outbox_stats['retry_after'] += 1
+        metrics.TELEGRAM_MESSAGES.labels('retry_after').inc()
+        logging.info("{}: flood limit for chat {}, retrying in {}s".format(
+            datetime.now(), message['chat_id'], e.retry_after))
+        with _dispatch_lock:
+            # Pushed back far enough that no burst is allowed before retry_after has passed
+            _chat_buckets[message['chat_id']] = [
+                time.monotonic() + e.retry_after +
+                (OUTBOX_CHAT_BURST - 1) / _chat_rate(message['chat_id'])
+            ]
+            message['attempts'] -= 1
+            _schedule(message)
+        return
+    except PERMANENT_ERRORS as e:
+        _dead(message, e)
+        return
+    except Exception as e:
+        if message['attempts'] >= OUTBOX_MAX_ATTEMPTS:
+            _dead(message, e)
+            return
+        backoff = min(2**message['attempts'], OUTBOX_BACKOFF_MAX)
+        logging.info("{}: message {} to {} failed, retrying in {}s: {}".format(
+            datetime.now(), message['id'], message['chat_id'], backoff, e))
+        _outbox_stats['retried'] += 1
+        metrics.TELEGRAM_MESSAGES.labels('retried').inc()
+        _defer(message, backoff, attempt_failed=True, error=e)
+        return
+    finally:
+        with _dispatch_lock:
+            _in_flight[0] -= 1
+    _delivered(message)
+
+
+def _deliver_safely(message):
+    try:
+        _deliver(message)
+    except Exception as e:
+        # The DB write failed, the lease expires and the message is sent again
+        logging.info("{}: Failed recording message {}: {}".format(
+            datetime.now(), message['id'], e))
+
+
+def dispatch():
+    """
+    Lease queued messages and send them within the per-chat and global limits, highest priority first.  One
+    dispatcher per bot token, since the buckets are kept in memory.
+    """
+    executor = ThreadPoolExecutor(max_workers=OUTBOX_SEND_THREADS)
+    last_stats = time.monotonic()
+    logging.info("{}: dispatching outbox".format(datetime.now()))
+    while True:
+        with _dispatch_lock:
+            held = len(_waiting) + _in_flight[0]
+        free = OUTBOX_LEASE_BATCH - held
+        leased = lease(free) if free > 0 else []
+        with _dispatch_lock:
+            for message in leased:
+                _schedule(message)
+
+        # Everything whose chat token is due, in priority order
+        now = time.monotonic()
+        ready = []
+        with _dispatch_lock:
+            while _waiting and _waiting[0][0] <= now:
+                ready.append(heapq.heappop(_waiting))
+        ready.sort(key=lambda entry: (entry[1], entry[2]))
+        for entry in ready:
+            message = entry[3]
+            due = _reserve(_global_bucket, OUTBOX_GLOBAL_RATE,
+                           OUTBOX_GLOBAL_BURST, time.monotonic())
+            time.sleep(max(due - time.monotonic(), 0))
+            with _dispatch_lock:
+                _in_flight[0] += 1
+            executor.submit(_deliver_safely, message)
+
+        if time.monotonic() - last_stats > OUTBOX_STATS_INTERVAL:
+            last_stats = time.monotonic()
+            with _dispatch_lock:
+                # Buckets that refilled completely hold no state worth keeping
+                for chat_id in [
+                        chat_id for chat_id, bucket in _chat_buckets.items()
+                        if bucket[0] < last_stats
+                ]:
+                    del _chat_buckets[chat_id]
+            logging.info("{}: outbox {}".format(datetime.now(),
+                                                outbox_stats()))
+        if not leased and not ready:
+            with _dispatch_lock:
+                next_due = _waiting[0][0] if _waiting else None
+            wait = OUTBOX_POLL_INTERVAL
+            if next_due is not None:
+                wait = min(wait, max(next_due - time.monotonic(), 0))
+            time.sleep(wait)
+
+
+def requeue_dead():
+    """
+    Move every dead-lettered message back to pending with a fresh attempt count.
+    """
+    requeue_call = "UPDATE outbox SET status = %s, attempts = 0, available_at = NOW(6) WHERE status = %s"
+    db.set_db_data(requeue_call, (OUTBOX_PENDING, OUTBOX_DEAD))
+
+
+def outbox_stats():
+    """
+    Return delivery counters, mean and max latency from queueing to delivery, the messages waiting in memory and the
+    backlog in the table.
+    """
+    stats = dict(_outbox_stats)
+    backlog_call = "SELECT status, COUNT(*) FROM outbox GROUP BY status"
+    backlog = dict(db.get_db_data(backlog_call, ()))
+    stats['pending'] = backlog.get(OUTBOX_PENDING, 0)
+    stats['dead_letters'] = backlog.get(OUTBOX_DEAD, 0)
+    stats['latency_mean'] = stats['latency_total'] / stats[
+        'sent'] if stats['sent'] else 0
+    stats['waiting'] = len(_waiting)
+    stats['in_flight'] = _in_flight[0]
+    return stats
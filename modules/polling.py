@@ -0,0 +1,175 @@
+import configparser
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from http import HTTPStatus
+
+import requests
+
+from . import capture, db, ingest, social
+
+# Read config and parse constants
+config = configparser.ConfigParser()
+config.read(os.environ['MY_CONF_DIR'] + '/webhooks.ini')
+logging.basicConfig(handlers=[logging.StreamHandler()], level=logging.INFO)
+
+# Telegram API
+TELEGRAM_KEY = config.get('webhooks', 'telegram_key')
+TELEGRAM_BASE_URL = config.get('webhooks', 'telegram_base_url',
+                               fallback='https://api.telegram.org/bot')
+BOT_ID_TELEGRAM = config.get('webhooks', 'bot_id_telegram')
+# Long polling: seconds Telegram holds an empty getUpdates open, updates per batch (at most 100), threads handling
+# one batch, and the pause after a failed getUpdates
+POLL_TIMEOUT = int(config.get('webhooks', 'poll_timeout', fallback='30'))
+POLL_BATCH_SIZE = int(
+    config.get('webhooks', 'poll_batch_size', fallback='100'))
+POLL_THREADS = int(config.get('webhooks', 'poll_threads', fallback='8'))
+POLL_RETRY_INTERVAL = float(
+    config.get('webhooks', 'poll_retry_interval', fallback='5'))
+
+_session = requests.Session()
+
+
+def _api(method, params, timeout):
+    response = _session.post('{}{}/{}'.format(TELEGRAM_BASE_URL, TELEGRAM_KEY,
+                                             method),
+                             json=params,
+                             timeout=timeout)
+    body = response.json()
+    if not body.get('ok'):
+        raise requests.RequestException("{} failed: {} {}".format(
+            method, body.get('error_code'), body.get('description')))
+    return body['result']
+
+
+def load_offset():
+    """
+    Return the offset of the first update not handled yet, as stored by save_offset.
+    """
+    offset_call = "SELECT update_offset FROM telegram_offsets WHERE bot_id = %s"
+    offset_data = db.get_db_data(offset_call, (BOT_ID_TELEGRAM))
+    return offset_data[0][0] if offset_data else 0
+
+
+def save_offset(offset):
+    offset_call = (
+        "INSERT INTO telegram_offsets (bot_id, update_offset, updated_at) VALUES (%s, %s, NOW(6)) "
+        "ON DUPLICATE KEY UPDATE update_offset = VALUES(update_offset), updated_at = VALUES(updated_at)"
+    )
+    db.set_db_data(offset_call, (BOT_ID_TELEGRAM, offset))
+
+
+def _handle_chat(updates):
+    """
+    Handle one chat's updates in order and return {update_id: status}.  Stops at the first update whose command
+    could not be queued, leaving the chat's later updates unhandled so they are not run ahead of it.
+    """
+    statuses = {}
+    for request_json in updates:
+        try:
+            response = ingest.handle_update(request_json)
+        except Exception as e:
+            logging.error("{}: Failed handling update {}: {}".format(
+                datetime.now(), request_json.get('update_id'), e))
+            response = 'ok'
+        status = response[1] if isinstance(response, tuple) else HTTPStatus.OK
+        statuses[request_json['update_id']] = status
+        if status == HTTPStatus.SERVICE_UNAVAILABLE:
+            break
+    return statuses
+
+
+def handle_batch(updates, executor, handled=()):
+    """
+    Run a batch of updates through the webhook's processing path.  Plain group chatter only refreshes membership;
+    updates with a command or a membership change are handled on the executor, in order within each chat, and the
+    members seen in the whole batch are then written with one flush.  Updates whose id is in handled are skipped.
+    Returns {update_id: status} for the updates handled; an update whose command could not be queued gets 503, and
+    the later updates of its chat are left out.
+    """
+    arrival = time.time()
+    statuses = {}
+    by_chat = {}
+    for request_json in updates:
+        if request_json['update_id'] in handled:
+            continue
+        try:
+            update_class = ingest.classify(request_json)
+            if update_class == 'member':
+                ingest.refresh_member(request_json)
+            elif update_class == 'process':
+                chat_id = request_json['message']['chat']['id']
+                by_chat.setdefault(chat_id, []).append(request_json)
+                continue
+        except Exception as e:
+            logging.error("{}: Failed handling update {}: {}".format(
+                datetime.now(), request_json.get('update_id'), e))
+        statuses[request_json['update_id']] = HTTPStatus.OK
+    for future in [
+            executor.submit(_handle_chat, chat_updates)
+            for chat_updates in by_chat.values()
+    ]:
+        statuses.update(future.result())
+    social.flush_members()
+    duration = time.time() - arrival
+    for request_json in updates:
+        if request_json['update_id'] in statuses:
+            capture.record(arrival, duration,
+                           statuses[request_json['update_id']], request_json)
+    return statuses
+
+
+def poll():
+    """
+    Pull updates with getUpdates instead of receiving them on the webhook, which is removed.  The next batch is only
+    requested once the current one is handled, and its offset is stored after that, so a restart resumes after the
+    last handled batch.  If a command cannot be queued, the offset stops at its update, which is fetched again after
+    POLL_RETRY_INTERVAL; the updates after it that were handled are remembered and skipped.  Run exactly one per bot
+    token; Telegram rejects concurrent getUpdates.
+    """
+    executor = ThreadPoolExecutor(max_workers=POLL_THREADS)
+    # Updates past the offset that are already handled, while an earlier one waits to be queued
+    handled = set()
+    _api('deleteWebhook', {}, 10)
+    offset = load_offset()
+    logging.info("{}: polling Telegram for updates from offset {}".format(
+        datetime.now(), offset))
+    while True:
+        try:
+            updates = _api(
+                'getUpdates', {
+                    'offset': offset,
+                    'limit': POLL_BATCH_SIZE,
+                    'timeout': POLL_TIMEOUT,
+                    'allowed_updates': ['message']
+                }, POLL_TIMEOUT + 10)
+        except (requests.RequestException, ValueError) as e:
+            logging.error("{}: getUpdates failed: {}".format(
+                datetime.now(), e))
+            time.sleep(POLL_RETRY_INTERVAL)
+            continue
+        if not updates:
+            continue
+        statuses = handle_batch(updates, executor, handled)
+        unqueued = [
+            update_id for update_id, status in statuses.items()
+            if status == HTTPStatus.SERVICE_UNAVAILABLE
+        ]
+        if unqueued:
+            offset = min(unqueued)
+            handled.update(update_id for update_id, status in statuses.items()
+                           if status != HTTPStatus.SERVICE_UNAVAILABLE)
+            logging.error("{}: could not queue update {}, retrying from it".format(
+                datetime.now(), offset))
+            time.sleep(POLL_RETRY_INTERVAL)
+        else:
+            offset = updates[-1]['update_id'] + 1
+            handled.clear()
+        try:
+            save_offset(offset)
+        except Exception as e:
+            # Telegram also drops the batch once the next getUpdates passes the offset
+            logging.error("{}: Failed storing offset {}: {}".format(
+                datetime.now(), offset, e))
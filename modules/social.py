@@ -1,14 +1,17 @@
+import atexit
 import configparser
 import logging
 import os
+import threading
+import time
+from collections import OrderedDict
 from datetime import datetime
 from decimal import Decimal, getcontext
 
-import nano
 import pyqrcode
 import telegram
 
-from . import currency, db
+from . import chain, currency, db, jobs, ledger, mentions, node, outbox
 
 # Read config and parse constants
 config = configparser.ConfigParser()
@@ -19,27 +22,64 @@ TELEGRAM_KEY = config.get('webhooks', 'telegram_key')
 
 # Constants
 MIN_TIP = config.get('webhooks', 'min_tip')
-NODE_IP = config.get('webhooks', 'node_ip')
 BOTNAME = config.get('webhooks', 'bot_id_telegram')
-
-# Connect to Telegram
-telegram_bot = telegram.Bot(token=TELEGRAM_KEY)
+# Chat membership cache
+MEMBER_CACHE_SIZE = int(
+    config.get('webhooks', 'member_cache_size', fallback='10000'))
+MEMBER_CACHE_TTL = float(
+    config.get('webhooks', 'member_cache_ttl', fallback='3600'))
+MEMBER_FLUSH_SIZE = int(
+    config.get('webhooks', 'member_flush_size', fallback='50'))
+MEMBER_FLUSH_INTERVAL = float(
+    config.get('webhooks', 'member_flush_interval', fallback='1'))
+# Seconds a process trusts its copy of a chat's membership generation, which every departure bumps in the DB.  A
+# member who left is dropped from every process's cache within this time.
+MEMBER_GENERATION_TTL = float(
+    config.get('webhooks', 'member_generation_ttl', fallback='2'))
 
 # Connect to node
-rpc = nano.rpc.Client(NODE_IP)
+rpc = node.rpc
+
+
+# LRU caches of chat members keyed by (chat_id, lowercased member_name) and (chat_id, member_id), entries expire
+# after MEMBER_CACHE_TTL.  New members are queued in _pending_members and written behind by the flusher thread.
+_members_by_name = OrderedDict()
+_members_by_id = OrderedDict()
+# chat_id -> (membership generation, monotonic time it was read)
+_chat_generations = {}
+_member_lock = threading.RLock()
+_pending_members = {}
+_member_flush_event = threading.Event()
+_member_flusher_pid = None
+_member_stats = {'hits': 0, 'misses': 0, 'written': 0}
+
+
+def _reset_clients_after_fork():
+    """
+    The member write-behind queue belongs to the parent.
+    """
+    global _member_lock, _member_flush_event, _pending_members
+    _member_lock = threading.RLock()
+    _member_flush_event = threading.Event()
+    _pending_members = {}
+
+
+os.register_at_fork(after_in_child=_reset_clients_after_fork)
+atexit.register(lambda: flush_members())
 raw_denominator = 10**2
 getcontext().prec = 3
 
 
-def send_dm(receiver, message):
+def send_dm(receiver, message, priority=outbox.PRIORITY_DM):
     """
-    Send the provided message to the provided receiver
+    Send the provided message to the provided receiver.  The message is queued for the outbox dispatcher, which keeps
+    within Telegram's rate limits and retries failed deliveries.
     """
 
     try:
-        telegram_bot.sendMessage(chat_id=receiver, text=message)
+        outbox.send(receiver, message, priority)
     except Exception as e:
-        logging.info("{}: Send DM - Telegram ERROR: {}".format(
+        logging.info("{}: Send DM - outbox ERROR: {}".format(
             datetime.now(), e))
         pass
 
@@ -115,45 +155,59 @@ def validate_tip_amount(message):
 
 def set_tip_list(message, users_to_tip):
     """
-    Loop through the message starting after the tip amount and identify any users that were tagged for a tip.  Add the
-    user object to the users_to_tip dict to process the tips.
+    Identify the users tagged for a tip after the tip amount and add them to users_to_tip.  Recipients come from the
+    message entities: users picked without a username already carry their id, and the usernames are resolved together
+    with one lookup.  A user tagged twice is tipped once.  Each receiver gets its tip_id here, so a retried job sends
+    under the same ids whichever receivers it still has to pay.
     """
     logging.info("{}: in set_tip_list.".format(datetime.now()))
 
-    logging.info("trying to set tiplist in telegram: {}".format(message))
-    for t_index in range(message['starting_point'] + 1, len(message['text'])):
-        if len(message['text'][t_index]) > 0:
-            if str(message['text'][t_index][0]) == "@" and str(
-                    message['text'][t_index]).lower() != (
-                        "@" + str(message['sender_screen_name']).lower()):
-                check_user_call = "SELECT member_id, member_name FROM telegram_chat_members WHERE chat_id = %s and member_name = %s"
-                arguments = (message['chat_id'], message['text'][t_index][1:])
-
-                user_check_data = db.get_db_data(check_user_call, arguments)
-                if user_check_data:
-                    receiver_id = user_check_data[0][0]
-                    receiver_screen_name = user_check_data[0][1]
-
-                    user_dict = {
-                        'receiver_id': receiver_id,
-                        'receiver_screen_name': receiver_screen_name,
-                        'receiver_account': None,
-                        'receiver_register': None
-                    }
-                    users_to_tip.append(user_dict)
-                else:
-                    logging.info(
-                        "User not found in DB: chat ID:{} - member name:{}".
-                        format(message['chat_id'],
-                               message['text'][t_index][1:]))
-                    missing_user_message = (
-                        "{} not found in our records.  In order to tip them, they need to be a "
-                        "member of the channel.  If they are in the channel, please have them "
-                        "send a message in the chat so I can add them. They also need to have Telegram username set up."
-                        .format(message['text'][t_index]))
-                    send_reply(message, missing_user_message)
-                    users_to_tip.clear()
-                    return message, users_to_tip
+    if message.get('entities'):
+        recipients = mentions.tip_mentions(message['raw_text'],
+                                           message['entities'])
+    else:
+        recipients = mentions.token_mentions(
+            message['text'][message['starting_point'] + 1:])
+    sender_name = str(message['sender_screen_name']).lower()
+    recipients = [(receiver_id, receiver_name)
+                  for receiver_id, receiver_name in recipients
+                  if receiver_id != message['sender_id'] and (
+                      receiver_id is not None
+                      or receiver_name.lower() != sender_name)]
+
+    members = lookup_members(message['chat_id'], [
+        receiver_name for receiver_id, receiver_name in recipients
+        if receiver_id is None
+    ])
+    for receiver_id, receiver_name in recipients:
+        if receiver_id is None:
+            member = members.get(receiver_name.lower())
+            if member is None:
+                logging.info(
+                    "User not found in DB: chat ID:{} - member name:{}".format(
+                        message['chat_id'], receiver_name))
+                missing_user_message = (
+                    "@{} not found in our records.  In order to tip them, they need to be a "
+                    "member of the channel.  If they are in the channel, please have them "
+                    "send a message in the chat so I can add them. They also need to have Telegram username set up."
+                    .format(receiver_name))
+                send_reply(message, missing_user_message)
+                users_to_tip.clear()
+                return message, users_to_tip
+            receiver_id, receiver_name = member
+        if int(receiver_id) in [
+                int(receiver['receiver_id']) for receiver in users_to_tip
+        ]:
+            continue
+
+        user_dict = {
+            'tip_id': "{}{}".format(message['id'], len(users_to_tip)),
+            'receiver_id': receiver_id,
+            'receiver_screen_name': receiver_name,
+            'receiver_account': None,
+            'receiver_register': None
+        }
+        users_to_tip.append(user_dict)
 
     logging.info("{}: Users_to_tip: {}".format(datetime.now(), users_to_tip))
     message['total_tip_amount'] = message['tip_amount']
@@ -193,14 +247,48 @@ def validate_sender(message):
         db.set_db_data(db_call, arguments)
 
     currency.receive_pending(message['sender_account'])
-    message['sender_balance_raw'] = rpc.account_balance(
-        account='{}'.format(message['sender_account']))
+    return set_sender_balance(message)
+
+
+def set_sender_balance(message):
+    """
+    Read the sender's current balance into the message.
+    """
+    if ledger.LEDGER_MODE:
+        sender_balance = ledger.get_balance(message['sender_id'],
+                                            message['sender_account'])
+    else:
+        sender_balance = chain.get_balance(message['sender_account'])
+    message['sender_balance_raw'] = {'balance': sender_balance}
     message['sender_balance'] = message['sender_balance_raw'][
         'balance'] / raw_denominator
 
     return message
 
 
+def skip_recorded_tips(message, users_to_tip):
+    """
+    On a retried tip job, drop the receivers an earlier attempt already paid and size total_tip_amount for the rest, so
+    the balance is only checked against tips still to send.  Returns the receivers left to pay.
+    """
+    if jobs.first_attempt():
+        return users_to_tip
+    recorded_call = "SELECT receiver_id FROM tip_list WHERE dm_id = %s"
+    recorded = {
+        int(row[0])
+        for row in db.get_db_data(recorded_call, (message['id']))
+    }
+    remaining = [
+        receiver for receiver in users_to_tip
+        if int(receiver['receiver_id']) not in recorded
+    ]
+    logging.info("{}: {} of {} tips already sent by an earlier attempt".format(
+        datetime.now(),
+        len(users_to_tip) - len(remaining), len(users_to_tip)))
+    message['total_tip_amount'] = message['tip_amount'] * len(remaining)
+    return remaining
+
+
 def validate_total_tip_amount(message):
     """
     Validate that the sender has enough Nano to cover the tip to all users
@@ -209,45 +297,268 @@ def validate_total_tip_amount(message):
     message['total_tip_amount'] = round(message['total_tip_amount'], 2)
     if message['sender_balance_raw']['balance'] < (
             message['total_tip_amount'] * raw_denominator):
-        not_enough_text = (
-            "You do not have enough NOLLAR to cover this {} NOLLAR tip.  Please check your balance by "
-            "sending a DM to me with !balance and retry.".format(
-                Decimal(message['total_tip_amount']) / Decimal("1")))
-        send_reply(message, not_enough_text)
+        return refuse_tip_amount(message)
 
-        logging.info(
-            "{}: User tried to send more than in their account.".format(
-                datetime.now()))
-        message['tip_amount'] = -1
-        return message
+    return message
 
+
+def refuse_tip_amount(message):
+    """
+    Tell the sender their balance does not cover the tip, and mark the tip as not to be sent.
+    """
+    not_enough_text = (
+        "You do not have enough NOLLAR to cover this {} NOLLAR tip.  Please check your balance by "
+        "sending a DM to me with !balance and retry.".format(
+            Decimal(message['total_tip_amount']) / Decimal("1")))
+    send_reply(message, not_enough_text)
+
+    logging.info("{}: User tried to send more than in their account.".format(
+        datetime.now()))
+    message['tip_amount'] = -1
     return message
 
 
 def send_reply(message, text):
-    telegram_bot.sendMessage(chat_id=message['chat_id'], text=text)
+    """
+    Answer in the chat the message came from, ahead of queued DMs and notifications.
+    """
+    try:
+        outbox.send(message['chat_id'], text, outbox.PRIORITY_REPLY)
+    except Exception as e:
+        logging.info("{}: Send reply - outbox ERROR: {}".format(
+            datetime.now(), e))
+
+
+def _chat_generation(chat_id):
+    """
+    Return the chat's membership generation, read from the DB at most every MEMBER_GENERATION_TTL seconds.
+    """
+    cached = _chat_generations.get(chat_id)
+    if cached is not None and time.monotonic() - cached[1] < MEMBER_GENERATION_TTL:
+        return cached[0]
+    generation_call = "SELECT generation FROM telegram_chat_generations WHERE chat_id = %s"
+    try:
+        generation_data = db.get_db_data(generation_call, (chat_id))
+        generation = generation_data[0][0] if generation_data else 0
+    except Exception as e:
+        # Keep answering from the cache while the DB is unreachable
+        logging.info("{}: Failed reading membership generation of {}: {}".format(
+            datetime.now(), chat_id, e))
+        generation = cached[0] if cached is not None else 0
+    _chat_generations[chat_id] = (generation, time.monotonic())
+    return generation
+
+
+def _bump_generation(chat_id):
+    bump_call = (
+        "INSERT INTO telegram_chat_generations (chat_id, generation) VALUES (%s, 1) "
+        "ON DUPLICATE KEY UPDATE generation = generation + 1")
+    db.set_db_data(bump_call, (chat_id))
+    _chat_generations.pop(chat_id, None)
+
+
+def _cache_member(chat_id, member_id, member_name, generation):
+    """
+    Cache a member as of the chat's membership generation, which must be read before the membership itself.
+    """
+    expires = time.monotonic() + MEMBER_CACHE_TTL
+    with _member_lock:
+        old_name = _members_by_id.pop((chat_id, member_id), (None, ))[0]
+        if old_name is not None:
+            _members_by_name.pop((chat_id, old_name.lower()), None)
+        _members_by_id[(chat_id, member_id)] = (member_name, generation,
+                                                expires)
+        if member_name is not None:
+            _members_by_name[(chat_id, member_name.lower())] = (member_id,
+                                                               member_name,
+                                                               generation,
+                                                               expires)
+        while len(_members_by_id) > MEMBER_CACHE_SIZE:
+            evicted_key, evicted = _members_by_id.popitem(last=False)
+            if evicted[0] is not None:
+                _members_by_name.pop((evicted_key[0], evicted[0].lower()),
+                                     None)
+        while len(_members_by_name) > MEMBER_CACHE_SIZE:
+            _members_by_name.popitem(last=False)
+
+
+def _cached_member(index, key):
+    """
+    Return the cache entry for key, or None if there is none, it expired, or a member left the chat since it was
+    cached.
+    """
+    generation = _chat_generation(key[0])
+    with _member_lock:
+        cached = index.get(key)
+        if cached is None:
+            return None
+        if cached[-1] < time.monotonic() or cached[-2] != generation:
+            del index[key]
+            return None
+        index.move_to_end(key)
+        return cached
+
+
+def lookup_members(chat_id, member_names):
+    """
+    Return {lowercased username: (member_id, member_name)} for the given usernames that are members of the chat.  Names
+    missing from the membership cache are looked up together in one query.
+    """
+    members = {}
+    missing = []
+    for member_name in member_names:
+        cached = _cached_member(_members_by_name,
+                                (chat_id, member_name.lower()))
+        if cached is not None:
+            _member_stats['hits'] += 1
+            members[member_name.lower()] = (cached[0], cached[1])
+        elif member_name.lower() not in missing:
+            _member_stats['misses'] += 1
+            missing.append(member_name.lower())
+    if not missing:
+        return members
+
+    generation = _chat_generation(chat_id)
+    members_call = "SELECT member_id, member_name FROM telegram_chat_members WHERE chat_id = %s and member_name IN ({})".format(
+        ', '.join(['%s'] * len(missing)))
+    for member_id, member_name in db.get_db_data(members_call,
+                                                 [chat_id] + missing):
+        _cache_member(chat_id, member_id, member_name, generation)
+        members[member_name.lower()] = (member_id, member_name)
+    return members
 
 
 def check_telegram_member(chat_id, chat_name, member_id, member_name):
-    check_user_call = "SELECT member_id, member_name FROM telegram_chat_members WHERE chat_id = %s and member_name = %s"
-    arguments = (chat_id, member_name)
-    user_check_data = db.get_db_data(check_user_call, arguments)
-
-    logging.info("checking if user exists")
-    if not user_check_data:
-        logging.info("{}: User {}-{} not found in DB, inserting".format(
-            datetime.now(), chat_id, member_name))
-        new_chat_member_call = "INSERT INTO telegram_chat_members (chat_id, chat_name, member_id, member_name) VALUES (%s, %s, %s, %s)"
-        arguments = (chat_id, chat_name, member_id, member_name)
-        db.set_db_data(new_chat_member_call, arguments)
+    """
+    Make sure the member is recorded for the chat.  Known members are answered from the cache; new ones are written
+    behind in batches by the member flusher.
+    """
+    cached = _cached_member(_members_by_id, (chat_id, member_id))
+    if cached is not None and cached[0] == member_name:
+        _member_stats['hits'] += 1
+        return
+
+    _member_stats['misses'] += 1
+    # The member just spoke in the chat, so is a member as of the current generation
+    _cache_member(chat_id, member_id, member_name, _chat_generation(chat_id))
+    logging.info("{}: User {}-{} not cached, queueing DB write".format(
+        datetime.now(), chat_id, member_name))
+    with _member_lock:
+        _pending_members[(chat_id, member_id)] = (chat_id, chat_name,
+                                                  member_id, member_name)
+        pending = len(_pending_members)
+    _start_member_flusher()
+    if pending >= MEMBER_FLUSH_SIZE:
+        _member_flush_event.set()
 
     return
 
 
+def add_telegram_member(chat_id, chat_name, member_id, member_name):
+    """
+    Record a member who joined the chat, written through to the DB rather than behind: a member who left and rejoined
+    may still be cached as present in this process.
+    """
+    with _member_lock:
+        _pending_members.pop((chat_id, member_id), None)
+    new_chat_member_call = (
+        "INSERT INTO telegram_chat_members (chat_id, chat_name, member_id, member_name) VALUES (%s, %s, %s, %s) "
+        "ON DUPLICATE KEY UPDATE member_name = VALUES(member_name)")
+    db.set_db_data(new_chat_member_call,
+                   (chat_id, chat_name, member_id, member_name))
+    _cache_member(chat_id, member_id, member_name, _chat_generation(chat_id))
+
+
+def remove_telegram_member(chat_id, member_id):
+    """
+    Forget a member who left the chat, in the cache, the write-behind queue and the DB, and bump the chat's
+    membership generation so other processes drop their cached copy.
+    """
+    with _member_lock:
+        _pending_members.pop((chat_id, member_id), None)
+        cached = _members_by_id.pop((chat_id, member_id), None)
+        if cached is not None and cached[0] is not None:
+            _members_by_name.pop((chat_id, cached[0].lower()), None)
+    remove_member_call = "DELETE FROM telegram_chat_members WHERE chat_id = %s AND member_id = %s"
+    db.set_db_data(remove_member_call, (chat_id, member_id))
+    _bump_generation(chat_id)
+
+
+def flush_members():
+    """
+    Write queued members to the DB: one query finds the ones already stored, renamed members are updated and the rest
+    inserted with one multi-row INSERT.
+    """
+    global _pending_members
+    with _member_lock:
+        pending = _pending_members
+        _pending_members = {}
+    if not pending:
+        return
+
+    try:
+        existing_call = "SELECT chat_id, member_id, member_name FROM telegram_chat_members WHERE {}".format(
+            ' OR '.join(['(chat_id = %s AND member_id = %s)'] * len(pending)))
+        arguments = [value for key in pending for value in key]
+        existing = {(row[0], row[1]): row[2]
+                    for row in db.get_db_data(existing_call, arguments)}
+
+        new_members = [
+            member for key, member in pending.items() if key not in existing
+        ]
+        renamed_members = [(member[3], member[0], member[2])
+                           for key, member in pending.items()
+                           if key in existing and existing[key] != member[3]]
+        if new_members:
+            # Another process may have stored the member since the SELECT
+            new_chat_member_call = (
+                "INSERT INTO telegram_chat_members (chat_id, chat_name, member_id, member_name) VALUES (%s, %s, %s, %s) "
+                "ON DUPLICATE KEY UPDATE member_name = VALUES(member_name)")
+            db.set_db_data_many(new_chat_member_call, new_members)
+        if renamed_members:
+            rename_member_call = "UPDATE telegram_chat_members SET member_name = %s WHERE chat_id = %s AND member_id = %s"
+            db.set_db_data_many(rename_member_call, renamed_members)
+        _member_stats['written'] += len(new_members) + len(renamed_members)
+    except Exception as e:
+        logging.info("{}: Failed writing {} members, requeueing: {}".format(
+            datetime.now(), len(pending), e))
+        with _member_lock:
+            for key, member in pending.items():
+                _pending_members.setdefault(key, member)
+
+
+def _member_flusher():
+    while _member_flusher_pid == os.getpid():
+        _member_flush_event.wait(MEMBER_FLUSH_INTERVAL)
+        _member_flush_event.clear()
+        flush_members()
+
+
+def _start_member_flusher():
+    global _member_flusher_pid
+    with _member_lock:
+        if _member_flusher_pid == os.getpid():
+            return
+        _member_flusher_pid = os.getpid()
+    threading.Thread(target=_member_flusher, daemon=True).start()
+
+
+def member_cache_stats():
+    """
+    Return membership cache hits, misses, hit rate and the number of queued writes.
+    """
+    stats = dict(_member_stats)
+    lookups = stats['hits'] + stats['misses']
+    stats['hit_rate'] = stats['hits'] / lookups if lookups else 0
+    stats['pending_writes'] = len(_pending_members)
+    stats['cached'] = len(_members_by_id)
+    return stats
+
+
 def send_account_message(account_text, message, account):
     """
-    Send a message to the user with their account information.
+    Send a message to the user with their account information.  One message, so the account cannot arrive before the
+    text introducing it; it stays on its own line to be easy to copy.
     """
 
-    send_dm(message['sender_id'], account_text)
-    send_dm(message['sender_id'], account)
+    send_dm(message['sender_id'], "{}\n\n{}".format(account_text, account))
@@ -0,0 +1,225 @@
+import configparser
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import random
+import threading
+from datetime import datetime
+from hashlib import blake2b
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Read config and parse constants
+config = configparser.ConfigParser()
+config.read(os.environ['MY_CONF_DIR'] + '/webhooks.ini')
+logging.basicConfig(handlers=[logging.StreamHandler()], level=logging.INFO)
+
+# Work is valid when its value reaches the threshold: the network's send threshold by default, lower for test
+# networks and offline runs
+WORK_THRESHOLD = config.get('webhooks', 'work_threshold',
+                            fallback='fffffff800000000')
+WORK_PROCESSES = int(
+    config.get('webhooks', 'work_processes',
+               fallback=str(os.cpu_count() or 1)))
+# Nonces one process tries before checking back, which bounds how long a cancelled or solved search keeps a core busy
+WORK_CHUNK = int(config.get('webhooks', 'work_chunk', fallback='65536'))
+WORK_SERVER_HOST = config.get('webhooks', 'work_server_host',
+                              fallback='127.0.0.1')
+WORK_SERVER_PORT = int(
+    config.get('webhooks', 'work_server_port', fallback='7090'))
+
+_NONCE_SPACE = 2**64
+
+
+class WorkCancelled(Exception):
+    pass
+
+
+def work_value(block_hash, work):
+    """
+    The value of work for a block hash (or an account's public key, for its opening block): blake2b-64 of the nonce,
+    little-endian, followed by the hash, read as a little-endian integer.
+    """
+    nonce = int(work, 16).to_bytes(8, 'little')
+    digest = blake2b(nonce + bytes.fromhex(block_hash), digest_size=8).digest()
+    return int.from_bytes(digest, 'little')
+
+
+def multiplier(value, threshold):
+    return (_NONCE_SPACE - threshold) / (_NONCE_SPACE - value)
+
+
+def _search(root, threshold, start, count):
+    """
+    Try count nonces from start, in a pool process.  Returns the first nonce whose value reaches threshold, or None.
+    """
+    for nonce in range(start, start + count):
+        digest = blake2b(nonce.to_bytes(8, 'little') + root,
+                         digest_size=8).digest()
+        if int.from_bytes(digest, 'little') >= threshold:
+            return nonce
+    return None
+
+
+class Generator:
+    """
+    Searches nonces on a pool of processes.  Any number of threads can generate at once; their chunks share the pool.
+    """
+
+    def __init__(self, processes=WORK_PROCESSES, chunk=WORK_CHUNK):
+        self.processes = processes
+        self.chunk = chunk
+        self.pool = multiprocessing.get_context('fork').Pool(processes)
+        self._lock = threading.Lock()
+        # block hash -> cancel events of the searches running for it
+        self._running = {}
+
+    def generate(self, block_hash, threshold=None):
+        """
+        Return work for block_hash reaching threshold (a hex string, WORK_THRESHOLD by default).  Raises WorkCancelled
+        if cancel(block_hash) is called first.
+        """
+        block_hash = block_hash.upper()
+        threshold = int(threshold or WORK_THRESHOLD, 16)
+        root = bytes.fromhex(block_hash)
+        cancelled = threading.Event()
+        with self._lock:
+            self._running.setdefault(block_hash, set()).add(cancelled)
+        results = queue.Queue()
+        nonce = random.randrange(_NONCE_SPACE)
+        try:
+            # Two chunks per process, so each process has the next one queued when it finishes
+            for _ in range(self.processes * 2):
+                self._submit(root, threshold, nonce, results)
+                nonce = (nonce + self.chunk) % _NONCE_SPACE
+            while True:
+                found = results.get()
+                if isinstance(found, Exception):
+                    raise found
+                if found is not None:
+                    return '{:016x}'.format(found)
+                if cancelled.is_set():
+                    raise WorkCancelled(block_hash)
+                self._submit(root, threshold, nonce, results)
+                nonce = (nonce + self.chunk) % _NONCE_SPACE
+        finally:
+            with self._lock:
+                self._running[block_hash].discard(cancelled)
+                if not self._running[block_hash]:
+                    del self._running[block_hash]
+
+    def _submit(self, root, threshold, start, results):
+        self.pool.apply_async(_search,
+                              (root, threshold, start,
+                               min(self.chunk, _NONCE_SPACE - start)),
+                              callback=results.put,
+                              error_callback=results.put)
+
+    def cancel(self, block_hash):
+        """
+        Stop every search for block_hash, e.g. when the account's frontier moved on.  Returns whether one was running.
+        """
+        with self._lock:
+            running = self._running.get(block_hash.upper(), set())
+            for cancelled in running:
+                cancelled.set()
+        return bool(running)
+
+    def close(self):
+        self.pool.terminate()
+
+
+_generator = None
+_generator_lock = threading.Lock()
+
+
+def _reset_after_fork():
+    # The parent's pool processes are not this process's children
+    global _generator, _generator_lock
+    _generator = None
+    _generator_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def generator():
+    """
+    The process-wide Generator, created on first use.
+    """
+    global _generator
+    with _generator_lock:
+        if _generator is None:
+            _generator = Generator()
+        return _generator
+
+
+def handle(request):
+    """
+    Answer a node RPC request, for the work actions only: work_generate (with an optional hex difficulty),
+    work_cancel and work_validate.
+    """
+    action = request.get('action')
+    try:
+        if action == 'work_generate':
+            threshold = request.get('difficulty', WORK_THRESHOLD)
+            work = generator().generate(request['hash'], threshold)
+            value = work_value(request['hash'], work)
+            return {
+                'work': work,
+                'difficulty': '{:016x}'.format(value),
+                'multiplier': str(multiplier(value, int(WORK_THRESHOLD, 16))),
+                'hash': request['hash']
+            }
+        if action == 'work_cancel':
+            generator().cancel(request['hash'])
+            return {}
+        if action == 'work_validate':
+            threshold = int(request.get('difficulty', WORK_THRESHOLD), 16)
+            value = work_value(request['hash'], request['work'])
+            return {
+                'valid': '1' if value >= threshold else '0',
+                'difficulty': '{:016x}'.format(value),
+                'multiplier': str(multiplier(value, int(WORK_THRESHOLD, 16)))
+            }
+    except WorkCancelled:
+        return {'error': 'Cancelled'}
+    except (KeyError, ValueError) as e:
+        return {'error': 'Bad request: {}'.format(e)}
+    return {'error': 'Unknown command'}
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        try:
+            body = self.rfile.read(int(self.headers['Content-Length']))
+            request = json.loads(body)
+            if not isinstance(request, dict):
+                raise ValueError('not an object')
+        except (TypeError, ValueError):
+            # A missing Content-Length, or a body that is not a JSON object
+            request = None
+        response = json.dumps({'error': 'Bad request'} if request is None
+                              else handle(request)).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(host=WORK_SERVER_HOST, port=WORK_SERVER_PORT):
+    """
+    Serve work_generate, work_cancel and work_validate over HTTP the way the node's RPC does, so work_node_ip can point
+    at this server instead of the node.  Blocks.
+    """
+    generator()
+    server = ThreadingHTTPServer((host, port), _Handler)
+    server.daemon_threads = True
+    logging.info("{}: work server on {}:{} with {} processes, threshold {}".format(
+        datetime.now(), host, port, WORK_PROCESSES, WORK_THRESHOLD))
+    server.serve_forever()
@@ -0,0 +1,145 @@
+import configparser
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from datetime import datetime
+
+from . import metrics
+
+# Read config and parse constants
+config = configparser.ConfigParser()
+config.read(os.environ['MY_CONF_DIR'] + '/webhooks.ini')
+logging.basicConfig(handlers=[logging.StreamHandler()], level=logging.INFO)
+
+# Worker pool settings
+WORKER_COUNT = int(config.get('webhooks', 'worker_count', fallback='4'))
+WORKER_QUEUE_SIZE = int(
+    config.get('webhooks', 'worker_queue_size', fallback='100'))
+WORKER_SUPERVISE_INTERVAL = float(
+    config.get('webhooks', 'worker_supervise_interval', fallback='1'))
+
+# Workers are forked so they start with every module already imported and the RPC/Telegram clients built.
+_context = multiprocessing.get_context('fork')
+_pool_lock = threading.Lock()
+_pool_pid = None
+_tasks = None
+_workers = []
+# One flag per worker slot, set while the worker runs a task
+_busy = None
+_stats = {'submitted': 0, 'rejected': 0, 'restarted': 0}
+
+
+def _worker_main(tasks, busy, slot):
+    """
+    Run tasks from the shared queue until the pool shuts down.  A failing task is logged and the worker moves on.
+    """
+    logging.info("{}: worker {} started".format(datetime.now(), os.getpid()))
+    while True:
+        task = tasks.get()
+        if task is None:
+            return
+        process, args = task
+        busy[slot] = 1
+        try:
+            process(*args)
+        except Exception as e:
+            logging.info("{}: Exception in {}: {}".format(
+                datetime.now(), process.__name__, e))
+        finally:
+            busy[slot] = 0
+
+
+def _spawn(slot):
+    worker = _context.Process(
+        target=_worker_main, args=(_tasks, _busy, slot), daemon=True)
+    worker.start()
+    return worker
+
+
+def _supervise():
+    """
+    Reap workers that exited and start replacements so the pool stays at WORKER_COUNT.
+    """
+    while _pool_pid == os.getpid():
+        time.sleep(WORKER_SUPERVISE_INTERVAL)
+        with _pool_lock:
+            for index, worker in enumerate(_workers):
+                # is_alive() waits on the child, so dead workers never linger as zombies
+                if not worker.is_alive():
+                    logging.info(
+                        "{}: worker {} exited with code {}, restarting".format(
+                            datetime.now(), worker.pid, worker.exitcode))
+                    metrics.mark_dead(worker.pid)
+                    worker.close()
+                    # A worker that died mid-task left its slot marked busy
+                    _busy[index] = 0
+                    _workers[index] = _spawn(index)
+                    _stats['restarted'] += 1
+
+
+def start():
+    """
+    Fork the worker processes and the supervisor thread.  Safe to call repeatedly; a forked child that calls it gets
+    its own pool.
+    """
+    global _pool_pid, _tasks, _workers, _busy
+    with _pool_lock:
+        if _pool_pid == os.getpid():
+            return
+        _tasks = _context.Queue(WORKER_QUEUE_SIZE)
+        _busy = _context.Array('b', WORKER_COUNT, lock=False)
+        _workers = [_spawn(slot) for slot in range(WORKER_COUNT)]
+        _pool_pid = os.getpid()
+    threading.Thread(target=_supervise, daemon=True).start()
+    logging.info("{}: started {} workers".format(datetime.now(),
+                                                  WORKER_COUNT))
+
+
+def submit(process, *args):
+    """
+    Queue process(*args) for a worker.  Returns False without blocking when the queue is full.
+    """
+    start()
+    try:
+        _tasks.put_nowait((process, args))
+    except queue.Full:
+        _stats['rejected'] += 1
+        logging.info("{}: worker queue full ({} tasks), rejected {}".format(
+            datetime.now(), WORKER_QUEUE_SIZE, process.__name__))
+        return False
+    _stats['submitted'] += 1
+    return True
+
+
+def queue_depth():
+    """
+    Return the number of tasks waiting for a worker.
+    """
+    if _pool_pid != os.getpid():
+        return 0
+    return _tasks.qsize()
+
+
+def idle():
+    """
+    Return the number of workers that would start a task submitted now: those not running one, less the tasks already
+    waiting.
+    """
+    start()
+    return WORKER_COUNT - sum(_busy) - queue_depth()
+
+
+def stats():
+    """
+    Return the pool counters, current queue depth and number of live workers.
+    """
+    pool_stats = dict(_stats)
+    pool_stats['queue_depth'] = queue_depth()
+    with _pool_lock:
+        pool_stats['workers'] = sum(1 for worker in _workers
+                                    if _pool_pid == os.getpid()
+                                    and worker.is_alive())
+    return pool_stats
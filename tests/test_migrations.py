@@ -0,0 +1,115 @@
+"""
+Migrations and the query plans of the hot queries on a scratch schema.  The tests that need a MySQL or MariaDB
+server are skipped when none is reachable.  The server is read from TIPBOT_TEST_DB_HOST, TIPBOT_TEST_DB_PORT, TIPBOT_TEST_DB_USER and
+TIPBOT_TEST_DB_PASSWORD (127.0.0.1, 3306, root and no password by default).
+
+Usage: python -m pytest tests
+"""
+import configparser
+import os
+import tempfile
+
+import pymysql
+import pytest
+
+DB_HOST = os.environ.get('TIPBOT_TEST_DB_HOST', '127.0.0.1')
+DB_PORT = int(os.environ.get('TIPBOT_TEST_DB_PORT', '3306'))
+DB_USER = os.environ.get('TIPBOT_TEST_DB_USER', 'root')
+DB_PASSWORD = os.environ.get('TIPBOT_TEST_DB_PASSWORD', '')
+DB_SCHEMA = 'tipbot_test_{}'.format(os.getpid())
+
+# Enough rows that the optimizer prefers an index to reading the whole table
+ROWS = 2000
+CHATS = 20
+
+# The modules read their settings when imported, so the scratch schema is configured first
+_config = configparser.ConfigParser()
+_config.read(
+    os.path.join(os.path.dirname(__file__), '..', 'config',
+                 'example_config.ini'))
+_config['webhooks'].update({
+    'host': DB_HOST,
+    'port': str(DB_PORT),
+    'user': DB_USER,
+    'password': DB_PASSWORD,
+    'schema': DB_SCHEMA,
+    'metrics_dir': tempfile.mkdtemp(prefix='tipbot_test_metrics_')
+})
+_directory = tempfile.mkdtemp(prefix='tipbot_test_')
+with open(os.path.join(_directory, 'webhooks.ini'), 'w') as config_file:
+    _config.write(config_file)
+os.environ['MY_CONF_DIR'] = _directory
+
+from modules import db, migrations  # noqa: E402
+
+
+def _seed():
+    db.set_db_data_many(
+        "INSERT INTO users (user_id, user_name, account, register) VALUES (%s, %s, %s, 1)",
+        [(user_id, 'user{}'.format(user_id), 'usd_{:060d}'.format(user_id))
+         for user_id in range(1, ROWS + 1)])
+    db.set_db_data_many(
+        "INSERT INTO telegram_chat_members (chat_id, chat_name, member_id, member_name) VALUES (%s, %s, %s, %s)",
+        [(-(member_id % CHATS) - 1, 'chat', member_id,
+          'user{}'.format(member_id)) for member_id in range(1, ROWS + 1)])
+    db.set_db_data_many(
+        "INSERT INTO tip_list (dm_id, tx_id, processed, sender_id, receiver_id, dm_text, amount) "
+        "VALUES (%s, %s, 2, %s, %s, 'tip', 1)",
+        [(dm_id, dm_id * 10, dm_id % 50 + 1, dm_id % 500 + 1)
+         for dm_id in range(1, ROWS + 1)])
+    db.set_db_data_many(
+        "INSERT INTO telegram_chat_generations (chat_id, generation) VALUES (%s, 1)",
+        [(-chat - 1, ) for chat in range(CHATS)])
+    for table in ('users', 'telegram_chat_members', 'tip_list',
+                  'telegram_chat_generations'):
+        db.execute_sql('ANALYZE TABLE {}'.format(table))
+
+
+def _server():
+    return pymysql.connect(host=DB_HOST, port=DB_PORT, user=DB_USER,
+                           password=DB_PASSWORD)
+
+
+@pytest.fixture(scope='module')
+def migrated():
+    try:
+        _server().close()
+    except pymysql.MySQLError as e:
+        pytest.skip('no MySQL server at {}:{}: {}'.format(DB_HOST, DB_PORT, e))
+    db.create_db()
+    try:
+        db.create_tables()
+        migrations.migrate()
+        _seed()
+        yield
+    finally:
+        connection = _server()
+        try:
+            connection.cursor().execute(
+                'DROP DATABASE IF EXISTS {}'.format(DB_SCHEMA))
+        finally:
+            connection.close()
+
+
+def test_migrate_reaches_latest_version(migrated):
+    assert migrations.current_version() == migrations.MIGRATIONS[-1][0]
+
+
+def test_hot_queries_use_an_index(migrated):
+    plans = migrations.explain_hot_queries()
+    assert {plan[0] for plan in plans} == {
+        name for name, query, arguments in migrations.HOT_QUERIES
+    }
+    assert migrations.full_scans(plans) == []
+
+
+def test_full_scans_flags_unused_keys():
+    assert migrations.full_scans([
+        ('scan', 'users', 'ALL', None, None),
+        ('ignored key', 'users', 'ALL', 'uq_users_user_id', None),
+        ('indexed', 'users', 'ref', 'uq_users_user_id', 'uq_users_user_id'),
+        ('const', None, None, None, None),
+    ]) == [
+        ('scan', 'users', 'ALL', None, None),
+        ('ignored key', 'users', 'ALL', 'uq_users_user_id', None),
+    ]
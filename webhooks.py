@@ -1,10 +1,16 @@
+import hmac
+import json
 import os
 import re
+import time
 from http import HTTPStatus
 
 import click
+import requests
 from flask import Flask, render_template, request
 
+from modules import (account_pool, capture, ingest, jobs, ledger, metrics,
+                     migrations, outbox, polling, work)
 from modules.db import *
 from modules.orchestration import *
 from modules.social import *
@@ -16,11 +22,23 @@ logging.basicConfig(handlers=[logging.StreamHandler()], level=logging.INFO)
 
 # Telegram API
 TELEGRAM_KEY = config.get('webhooks', 'telegram_key')
+TELEGRAM_BASE_URL = config.get('webhooks', 'telegram_base_url',
+                               fallback='https://api.telegram.org/bot')
 
 # IDs
 BOT_ID_TELEGRAM = config.get('webhooks', 'bot_id_telegram')
 SERVER_URL = config.get('webhooks', 'server_url')
 
+# Node callbacks are only accepted with node_callback_secret as the secret query parameter (set callback_target to
+# /node_callback?secret=...), or when no secret is set, only from the addresses in node_callback_addresses
+NODE_CALLBACK_SECRET = config.get('webhooks', 'node_callback_secret',
+                                  fallback='')
+NODE_CALLBACK_ADDRESSES = [
+    address.strip() for address in config.get(
+        'webhooks', 'node_callback_addresses', fallback='127.0.0.1').split(',')
+    if address.strip()
+]
+
 # Set up Flask routing
 app = Flask(__name__)
 
@@ -32,6 +50,7 @@ def db_init():
     logging.info('Succesfully deleted old database.')
     create_db()
     create_tables()
+    migrations.migrate()
     logging.info('Succesfully initiated database.')
 
 
@@ -39,9 +58,29 @@ def db_init():
 def db_init_no_delete():
     create_db()
     create_tables()
+    migrations.migrate()
     logging.info('Succesfully initiated database.')
 
 
+@app.cli.command('db_migrate')
+def db_migrate():
+    # Bring an existing database up to the latest schema version
+    migrations.migrate()
+
+
+@app.cli.command('db_explain')
+def db_explain():
+    # Fails when a hot query would scan a table instead of using an index
+    plans = migrations.explain_hot_queries()
+    for name, table, access_type, possible_keys, key in plans:
+        logging.info("{}: table {} access {} key {}".format(
+            name, table, access_type, key))
+    unindexed = migrations.full_scans(plans)
+    if unindexed:
+        raise click.ClickException('{} hot queries are not indexed: {}'.format(
+            len(unindexed), ', '.join(plan[0] for plan in unindexed)))
+
+
 @app.cli.command('db_create_tables')
 def db_create_tables():
     create_tables()
@@ -54,8 +93,77 @@ def db_drop_table(name):
     drop_table(name)
 
 
+@app.cli.command('job_consumer')
+def job_consumer():
+    # Run jobs queued by the webhook on the worker pool, any number of consumers can share the queue
+    jobs.consume(JOB_PROCESSES)
+
+
+@app.cli.command('job_requeue_dead')
+def job_requeue_dead():
+    jobs.requeue_dead()
+    logging.info('Requeued dead jobs.')
+
+
+@app.cli.command('metrics_reset')
+def metrics_reset():
+    # Run before the bot's other processes start, so /metrics does not add up samples from the previous run
+    logging.info('Removed {} metrics files from {}.'.format(
+        metrics.reset(), os.environ['PROMETHEUS_MULTIPROC_DIR']))
+
+
+@app.cli.command('outbox_dispatcher')
+def outbox_dispatcher():
+    # Deliver queued Telegram messages within the flood limits, run exactly one per bot token
+    outbox.dispatch()
+
+
+@app.cli.command('outbox_requeue_dead')
+def outbox_requeue_dead():
+    outbox.requeue_dead()
+    logging.info('Requeued dead messages.')
+
+
+@app.cli.command('receive_pending')
+@click.argument('accounts', nargs=-1)
+@click.option('--all', 'all_accounts', is_flag=True,
+              help='Receive for every account in the users table.')
+def receive_pending_cli(accounts, all_accounts):
+    # Clear pending deposits for many accounts in one go
+    accounts = list(accounts)
+    if all_accounts:
+        accounts += [
+            row[0] for row in get_db_data("SELECT account FROM users", ())
+        ]
+    accounts = list(dict.fromkeys(accounts))
+    received = currency.receive_pending_accounts(accounts)
+    logging.info('Received {} blocks for {} accounts.'.format(
+        received, len(accounts)))
+
+
+@app.cli.command('ledger_settle')
+@click.option('--every', default=0, type=float,
+              help='Keep settling, every this many seconds.')
+def ledger_settle(every):
+    # Net the internal ledger against the chain balances of the custodial accounts
+    while True:
+        ledger.settle()
+        if not every:
+            break
+        time.sleep(every)
+
+
+@app.cli.command('ledger_reconcile')
+def ledger_reconcile():
+    report = ledger.reconcile()
+    for key, value in report.items():
+        logging.info("{}: {}".format(key, value))
+    if not report['ok']:
+        raise click.ClickException('Ledger does not reconcile')
+
+
 # Connect to Telegram
-telegram_bot = telegram.Bot(token=TELEGRAM_KEY)
+telegram_bot = telegram.Bot(token=TELEGRAM_KEY, base_url=TELEGRAM_BASE_URL)
 
 
 @app.cli.command('telegram_webhook')
@@ -69,162 +177,105 @@ def telegram_webhook():
     return response
 
 
+@app.cli.command('telegram_poll')
+def telegram_poll():
+    # Alternative to telegram_webhook: pull updates with getUpdates, removes the webhook
+    polling.poll()
+
+
+@app.cli.command('account_pool_refill')
+def account_pool_refill():
+    # Keep accounts created ahead of time for new users, see modules/account_pool.py
+    account_pool.refill_forever()
+
+
+@app.cli.command('work_server')
+@click.option('--host', default=work.WORK_SERVER_HOST)
+@click.option('--port', default=work.WORK_SERVER_PORT, type=int)
+def work_server(host, port):
+    # Local multi-core PoW answering work_generate like the node, point work_node_ip at it
+    work.serve(host, port)
+
+
+@app.cli.command('fake_node_callback')
+@click.argument('account')
+@click.option('--url', default='http://127.0.0.1:5000/node_callback',
+              help='Callback route of the running bot.')
+@click.option('--secret', default=NODE_CALLBACK_SECRET,
+              help='node_callback_secret of the running bot.')
+def fake_node_callback(account, url, secret):
+    # Post the callback a node sends for a state send block to account, for testing without a node
+    callback = {
+        'account': 'usd_1111111111111111111111111111111111111111111111111111hifc8npp',
+        'hash': '0' * 64,
+        'block': json.dumps({
+            'type': 'state',
+            'link_as_account': account,
+        }),
+        'amount': '100',
+        'is_send': 'true',
+        'subtype': 'send'
+    }
+    response = requests.post(url, json=callback,
+                             params={'secret': secret} if secret else None)
+    logging.info("Callback answered {}".format(response.status_code))
+
+
 # Flask routing
+@app.route('/node_callback', methods=["POST"])
+def node_callback():
+    """
+    HTTP callback from the Nano node for every confirmed block.  Sends to a bot account are received right away so
+    balances are settled before the user asks for them.  Sends between bot accounts are left out: tips are received
+    by their notify job.
+    """
+    if NODE_CALLBACK_SECRET:
+        if not hmac.compare_digest(request.args.get('secret', ''),
+                                   NODE_CALLBACK_SECRET):
+            return '', HTTPStatus.FORBIDDEN
+    elif request.remote_addr not in NODE_CALLBACK_ADDRESSES:
+        return '', HTTPStatus.FORBIDDEN
+    try:
+        callback = request.get_json(force=True)
+        destination = currency.callback_destination(callback)
+        if destination is not None and currency.is_custodial_account(
+                destination) and not currency.is_custodial_account(
+                    callback.get('account')):
+            logging.info("{}: deposit {} to {}, queueing receive".format(
+                datetime.now(), callback.get('hash'), destination))
+            jobs.enqueue('receive', [destination])
+    except Exception as e:
+        logging.error('Node callback error: {}'.format(e))
+        return '', HTTPStatus.SERVICE_UNAVAILABLE
+    return '', HTTPStatus.OK
+
+
+@app.route('/metrics', methods=["GET"])
+def metrics_endpoint():
+    """
+    Latency histograms and counters of every bot process, in the Prometheus text format.
+    """
+    body, content_type = metrics.render()
+    return body, HTTPStatus.OK, {'Content-Type': content_type}
+
+
 @app.route('/', defaults={'path': ''}, methods=["POST"])
 @app.route('/<path:path>', methods=["POST"])
 def telegram_event(path):
+    arrival = time.time()
+    request_json = request.get_json()
+    response = 'ok'
     try:
-        message = {
-            # id:                     ID of the received message - Error logged through None value
-            # text:                   A list containing the text of the received message, split by ' '
-            # sender_account:         Nano account of sender - Error logged through None value
-            # sender_register:        Registration status with Tip Bot of sender account
-            # sender_balance_raw:     Amount of Nano in sender's account, stored in raw
-            # sender_balance:         Amount of Nano in sender's account, stored in Nano
-
-            # action_index:           Location of key action value *(currently !tip only)
-            # action:                 Action found in the received message - Error logged through None value
-
-            # starting_point:         Location of action sent via message (currently !tip only)
-
-            # tip_amount:             Value of tip to be sent to receiver(s) - Error logged through -1
-            # tip_amount_text:        Value of the tip stored in a string to prevent formatting issues
-            # total_tip_amount:       Equal to the tip amount * number of users to tip
-            # tip_id:                 ID of the tip, used to prevent double sending of tips.  Comprised of
-            #                         message['id'] + index of user in users_to_tip
-            # send_hash:              Hash of the send RPC transaction
-        }
-
-        users_to_tip = [
-            # List including dictionaries for each user to send a tip.  Each index will include
-            # the below parameters
-            #    receiver_account:       Nano account of receiver
-            #    receiver_register:      Registration status with Tip Bot of receiver account
-        ]
-
-        request_json = request.get_json()
-        logging.info("request_json: {}".format(request_json))
-
-        if 'message' in request_json.keys():
-            if request_json['message']['chat']['type'] == 'private':
-                logging.info(
-                    "Direct message received in Telegram.  Processing.")
-                message['sender_id'] = request_json['message']['from']['id']
-
-                message['sender_screen_name'] = request_json['message'][
-                    'from']['username']
-
-                message['dm_id'] = request_json['update_id']
-                message['text'] = request_json['message']['text']
-                message['dm_array'] = message['text'].split(" ")
-                message['dm_action'] = message['dm_array'][0].lower(
-                )  # TODO: use regex!
-
-                logging.info("{}: action identified: {}".format(
-                    datetime.now(), message['dm_action']))
-
-                parse_action(message)
-
-            elif (request_json['message']['chat']['type'] == 'supergroup'
-                  or request_json['message']['chat']['type'] == 'group'):
-                if 'text' in request_json['message']:
-                    message['sender_id'] = request_json['message']['from'][
-                        'id']
-
-                    message['sender_screen_name'] = request_json['message'][
-                        'from']['username']
-
-                    message['id'] = request_json['message']['message_id']
-                    message['chat_id'] = request_json['message']['chat']['id']
-                    chat_name = re.sub(
-                        '\W+', ' ', request_json['message']['chat']['title'])
-                    message['chat_name'] = chat_name
-                    check_telegram_member(
-                        message['chat_id'], message['chat_name'],
-                        message['sender_id'], message['sender_screen_name'])
-
-                    message['text'] = request_json['message']['text']
-                    message['text'] = message['text'].replace('\n', ' ')
-                    message['text'] = message['text'].lower()
-                    message['text'] = message['text'].split(' ')
-
-                    message = check_message_action(message)
-                    if message['action'] is None:
-                        logging.debug(
-                            "{}: Mention of nano tip bot without a !tip command."
-                            .format(datetime.now()))
-                        return '', HTTPStatus.OK
-
-                    message = validate_tip_amount(message)
-                    if message['tip_amount'] <= 0:
-                        return '', HTTPStatus.OK
-
-                    if message['action'] != -1 and str(
-                            message['sender_id']) != str(BOT_ID_TELEGRAM):
-                        new_pid = os.fork()
-                        if new_pid == 0:
-                            try:
-                                tip_process(message, users_to_tip)
-                            except Exception as e:
-                                logging.info("Exception: {}".format(e))
-                                raise e
-
-                            os._exit(0)
-                        else:
-                            return '', HTTPStatus.OK
-
-                elif 'new_chat_member' in request_json['message']:
-                    logging.info("new member joined chat, adding to DB")
-                    chat_id = request_json['message']['chat']['id']
-                    chat_name = request_json['message']['chat']['title']
-                    member_id = request_json['message']['new_chat_member'][
-                        'id']
-                    member_name = request_json['message']['new_chat_member'][
-                        'username']
-
-                    new_chat_member_call = "INSERT INTO telegram_chat_members (chat_id, chat_name, member_id, member_name) VALUES (%s, %s, %s, %s)"
-                    arguments = (chat_id, chat_name, member_id, member_name)
-                    set_db_data(new_chat_member_call, arguments)
-
-                elif 'left_chat_member' in request_json['message']:
-                    chat_id = request_json['message']['chat']['id']
-                    chat_name = request_json['message']['chat']['title']
-                    member_id = request_json['message']['left_chat_member'][
-                        'id']
-                    member_name = request_json['message']['left_chat_member'][
-                        'username']
-
-                    logging.info(
-                        "member {}-{} left chat {}-{}, removing from DB.".
-                        format(member_id, member_name, chat_id, chat_name))
-
-                    remove_member_call = "DELETE FROM telegram_chat_members WHERE chat_id = %s AND member_id = %s"
-                    argunents = (chat_id, member_id)
-                    set_db_data(remove_member_call, arguments)
-
-                elif 'group_chat_created' in request_json['message']:
-                    chat_id = request_json['message']['chat']['id']
-                    chat_name = request_json['message']['chat']['title']
-                    member_id = request_json['message']['from']['id']
-                    member_name = request_json['message']['from']['username']
-
-                    logging.info(
-                        "member {} created chat {}, inserting creator into DB."
-                        .format(member_name, chat_name))
-
-                    new_chat_call = "INSERT INTO telegram_chat_members (chat_id, chat_name, member_id, member_name) VALUES (%s, %s, %s, %s)"
-                    arguments = (chat_id, chat_name, member_id, member_name)
-                    set_db_data(new_chat_call, arguments)
-
-            else:
-                logging.info("In try: request: {}".format(request_json))
-
+        update_class = ingest.classify(request_json)
+        if update_class == 'member':
+            ingest.refresh_member(request_json)
+        elif update_class == 'process':
+            response = ingest.handle_update(request_json)
     except Exception as e:
-        logging.info("In error: request: {}".format(request_json))
         logging.error('Fatal error: {}'.format(e))
-    finally:
-        logging.info("In finally: request: {}".format(request_json))
-        return 'ok'
+    status = response[1] if isinstance(response, tuple) else HTTPStatus.OK
+    capture.record(arrival, time.time() - arrival, status, request_json)
+    return response
 
 
 if __name__ == "__main__":